@@ -1,11 +1,17 @@
 """
 AnimeKai Downloader Application Package
 """
-from flask import Flask
 import os
 
-def create_app():
-    """Application factory pattern"""
+def create_app(start_background_services=True):
+    """
+    Application factory pattern
+    Background services (worker processes, subscription poller) are only started when requested,
+    so the dev server's reloader parent process does not run them too.
+    """
+    # Imported here so that importing the package (e.g. app.importtime) stays cheap
+    from flask import Flask
+
     # Get the parent directory (Ani-Downloader) for templates and static files
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
     
@@ -18,10 +24,24 @@ def create_app():
     app.config['DOWNLOAD_FOLDER'] = download_folder
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024  # 16GB max
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+    # Number of separate download worker processes (0 = run jobs as threads in this process)
+    app.config['DOWNLOAD_WORKERS'] = int(os.environ.get('DOWNLOAD_WORKERS', '0'))
+    # Share job state through the download folder so several server processes can serve the API
+    app.config['SHARED_JOB_STATE'] = os.environ.get('SHARED_JOB_STATE', '0') == '1'
+    
+    # Compression, ETags and fingerprinted static URLs
+    from app.caching import init_http_caching
+    init_http_caching(app)
     
     # Create downloads folder
     from app.utils import create_download_folder
     create_download_folder(app.config['DOWNLOAD_FOLDER'])
+
+    # Partial downloads left behind by processes that have exited
+    from app.staging import cleanup_orphaned_staging
+    removed = cleanup_orphaned_staging(app.config['DOWNLOAD_FOLDER'])
+    if removed:
+        print(f"Removed {removed} orphaned staging folder(s)")
     
     # Register blueprints
     from app.routes.auth import auth_bp
@@ -29,11 +49,56 @@ def create_app():
     from app.routes.library import library_bp
     from app.routes.download import download_bp
     from app.routes.search import search_bp
+    from app.routes.subscriptions import subscriptions_bp
+    from app.routes.system import system_bp
+    from app.routes.cluster import cluster_bp
     
     app.register_blueprint(auth_bp)
     app.register_blueprint(pages_bp)
     app.register_blueprint(library_bp)
     app.register_blueprint(download_bp)
     app.register_blueprint(search_bp)
+    app.register_blueprint(subscriptions_bp)
+    app.register_blueprint(system_bp)
+    app.register_blueprint(cluster_bp)
+
+    # Job state shared between HTTP worker processes
+    if app.config['SHARED_JOB_STATE']:
+        from app.routes.download import download_jobs
+        from app.utils import get_app_data_folder
+        download_jobs.enable_shared_folder(get_app_data_folder(app.config['DOWNLOAD_FOLDER'], 'jobs'))
+
+    # Download worker processes
+    if start_background_services and app.config['DOWNLOAD_WORKERS'] > 0:
+        from app.workers import init_worker_pool
+        from app.routes.download import download_jobs
+        init_worker_pool(app.config['DOWNLOAD_WORKERS'], download_jobs)
+
+    # Subscriptions for airing series
+    from app.subscriptions import init_subscriptions
+    from app.routes.download import enqueue_subscription_episodes, is_job_active
+    init_subscriptions(
+        app.config['DOWNLOAD_FOLDER'],
+        enqueue_subscription_episodes,
+        is_job_active,
+        start_poller=start_background_services,
+    )
+
+    # Offline search catalog, optionally filled by crawling the browse pages
+    if start_background_services:
+        from app.catalog import init_catalog_crawler
+        init_catalog_crawler(app.config['DOWNLOAD_FOLDER'])
+
+    # Upstream cookies (Cloudflare clearance) shared by all processes and kept across restarts
+    from app.upstream import configure_upstream, start_warm_up
+    configure_upstream(app.config['DOWNLOAD_FOLDER'])
+
+    # Key signing poster URLs served through the thumbnail cache
+    from app.thumbnails import configure_thumbnails
+    configure_thumbnails(app.config['DOWNLOAD_FOLDER'])
+
+    # Solve the upstream challenge before the first user request needs it
+    if start_background_services:
+        start_warm_up()
     
     return app
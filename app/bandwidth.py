@@ -0,0 +1,345 @@
+"""
+Bandwidth Budget
+Caps the total download rate of all yt-dlp transfers (BANDWIDTH_LIMIT_MBPS, with
+optional time-of-day overrides in BANDWIDTH_SCHEDULE) and splits it between the
+active episode downloads by job priority.
+
+yt-dlp's own --limit-rate is fixed when it starts, so instead each transfer gets a
+byte allowance that refills at its current share of the budget; a transfer that
+runs ahead of its allowance is paused (SIGSTOP) until the allowance catches up.
+Shares are recomputed several times per second as downloads start, finish or
+turn out to be limited elsewhere (weighted max-min fairness), so bandwidth
+a slow download can't use goes to the others.
+
+With a state folder, every process publishes its transfers there so the budget
+is split across all server and worker processes; without one (or on platforms
+without SIGSTOP) the throughput is still measured and reported.
+"""
+import json
+import os
+import signal
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.inflight import pid_alive
+
+# Mbit/s for all downloads together (0 = unlimited)
+BANDWIDTH_LIMIT_MBPS = float(os.environ.get("BANDWIDTH_LIMIT_MBPS", "0"))
+
+# Time-of-day overrides, e.g. "08:00-18:00=50,23:00-07:00=0" (local time, Mbit/s, 0 = unlimited)
+BANDWIDTH_SCHEDULE = os.environ.get("BANDWIDTH_SCHEDULE", "")
+
+PRIORITY_WEIGHTS = {"low": 1, "normal": 2, "high": 4}
+
+# Seconds between allowance checks
+CONTROL_INTERVAL = 0.25
+
+# Seconds between publishing and reading the state of other processes
+SHARE_INTERVAL = 1.0
+
+# Seconds of its rate a transfer may run ahead before it is paused
+BURST_SECONDS = 1.0
+
+# Smoothing of measured transfer rates
+RATE_SMOOTHING = 0.3
+
+# A transfer using less than this fraction of its share is treated as limited elsewhere
+UNDERUSE_RATIO = 0.8
+
+# State published by other processes is ignored once it is this old
+STALE_STATE_SECONDS = 5
+
+CAN_PAUSE = hasattr(signal, "SIGSTOP") and hasattr(os, "killpg")
+
+
+def mbps_to_bytes(mbps: float) -> float:
+    return mbps * 1_000_000 / 8
+
+
+def bytes_to_mbps(rate: float) -> float:
+    return round(rate * 8 / 1_000_000, 2)
+
+
+def parse_schedule(spec: str) -> List[Tuple[int, int, float]]:
+    """Parse "HH:MM-HH:MM=mbps,..." into (start minute, end minute, Mbit/s) windows"""
+    def minutes(hhmm: str) -> int:
+        hours, _, mins = hhmm.strip().partition(":")
+        return (int(hours) * 60 + int(mins or 0)) % (24 * 60)
+
+    windows = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            span, _, mbps = item.partition("=")
+            start, _, end = span.partition("-")
+            windows.append((minutes(start), minutes(end), float(mbps)))
+        except ValueError:
+            print(f"Ignoring invalid bandwidth schedule entry '{item}'")
+    return windows
+
+
+def scheduled_limit(windows: List[Tuple[int, int, float]], default: float,
+                    now: Optional[float] = None) -> float:
+    """Limit in Mbit/s at a given time: the first matching window, else the default"""
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    for start, end, mbps in windows:
+        inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+        if inside:
+            return mbps
+    return default
+
+
+def fair_shares(budget: float, transfers: List[Tuple[Any, float, float]]) -> Dict[Any, float]:
+    """
+    Weighted max-min split of a budget between (key, weight, demand) transfers.
+    Transfers demanding less than their weighted share get their demand and the rest
+    is split again between the others.
+    """
+    shares = {}
+    active = list(transfers)
+    remaining = budget
+    while active:
+        total_weight = sum(weight for _, weight, _ in active)
+        limited = [t for t in active if t[2] < remaining * t[1] / total_weight]
+        if not limited:
+            for key, weight, _ in active:
+                shares[key] = remaining * weight / total_weight
+            break
+        for t in limited:
+            shares[t[0]] = t[2]
+            remaining -= t[2]
+            active.remove(t)
+    return shares
+
+
+class Transfer:
+    """One running yt-dlp download under the bandwidth budget"""
+    def __init__(self, process, weight: int, label: str):
+        self.process = process
+        self.weight = weight
+        self.label = label
+        self.bytes = 0
+        self.rate = 0.0
+        self.allowed = 0.0  # bytes/s, 0 = unlimited
+        self.allowance = 0.0
+        self.paused = False
+        self.started = time.time()
+        self._counter: Optional[int] = None  # last downloaded_bytes reported by yt-dlp
+        self._measured_bytes = 0
+        self._measured_at = self.started
+
+    def update(self, downloaded_bytes: int):
+        """Record yt-dlp's cumulative byte count for the current file"""
+        if self._counter is None:
+            # The first count includes whatever a resumed download already had on disk
+            self._counter = downloaded_bytes
+            return
+        delta = downloaded_bytes - self._counter
+        if delta < 0:  # yt-dlp moved on to another file (e.g. separate audio)
+            delta = downloaded_bytes
+        self._counter = downloaded_bytes
+        self.bytes += delta
+        self.allowance -= delta
+
+    def _measure(self, now: float):
+        elapsed = now - self._measured_at
+        if elapsed <= 0:
+            return
+        instant = (self.bytes - self._measured_bytes) / elapsed
+        self.rate = instant if self.rate == 0 else (
+            RATE_SMOOTHING * instant + (1 - RATE_SMOOTHING) * self.rate
+        )
+        self._measured_bytes = self.bytes
+        self._measured_at = now
+
+    def _signal(self, sig) -> bool:
+        try:
+            os.killpg(self.process.pid, sig)
+            return True
+        except OSError:
+            return False
+
+    def pause(self):
+        if CAN_PAUSE and not self.paused and self._signal(signal.SIGSTOP):
+            self.paused = True
+
+    def resume(self):
+        if self.paused:
+            self._signal(signal.SIGCONT)
+            self.paused = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "label": self.label,
+            "weight": self.weight,
+            "rate_mbps": bytes_to_mbps(self.rate),
+            "allowed_mbps": bytes_to_mbps(self.allowed) if self.allowed else None,
+            "paused": self.paused,
+            "downloaded_mb": round(self.bytes / (1024 * 1024), 1),
+        }
+
+
+class BandwidthManager:
+    """Splits the global bandwidth budget between active transfers"""
+    def __init__(self, limit_mbps: float, schedule: List[Tuple[int, int, float]]):
+        self.limit_mbps = limit_mbps
+        self.schedule = schedule
+        self.state_folder: Optional[str] = None
+        self._transfers: List[Transfer] = []
+        self._lock = threading.Lock()
+        self._controller: Optional[threading.Thread] = None
+        self._remote: List[Dict[str, Any]] = []
+        self._last_share = 0.0
+        self._last_read = 0.0
+
+    def share_state(self, folder: str):
+        """Split the budget with every process publishing to this folder"""
+        os.makedirs(folder, exist_ok=True)
+        self.state_folder = folder
+
+    def current_limit_mbps(self) -> float:
+        return scheduled_limit(self.schedule, self.limit_mbps)
+
+    def register(self, process, priority: str = "normal", label: str = "") -> Transfer:
+        """Put a started download process (its own process group) under the budget"""
+        transfer = Transfer(process, PRIORITY_WEIGHTS.get(priority, PRIORITY_WEIGHTS["normal"]), label)
+        with self._lock:
+            self._transfers.append(transfer)
+            if not self._controller:
+                self._controller = threading.Thread(target=self._control_loop, name="bandwidth", daemon=True)
+                self._controller.start()
+        return transfer
+
+    def unregister(self, transfer: Transfer):
+        with self._lock:
+            if transfer in self._transfers:
+                self._transfers.remove(transfer)
+        transfer.resume()
+
+    def _state_file(self) -> str:
+        return os.path.join(self.state_folder, f"{os.getpid()}.json")
+
+    def _share(self, transfers: List[Transfer], budget: float, now: float):
+        """Publish this process's transfers and read those of the other processes"""
+        try:
+            if transfers:
+                tmp_file = f"{self._state_file()}.tmp"
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump({
+                        "weight": sum(t.weight for t in transfers),
+                        "rate": sum(t.rate for t in transfers),
+                        "budget": budget,
+                        "transfers": [t.to_dict() for t in transfers],
+                    }, f)
+                os.replace(tmp_file, self._state_file())
+            elif os.path.exists(self._state_file()):
+                os.remove(self._state_file())
+        except OSError as e:
+            print(f"Could not publish bandwidth state: {e}")
+        self._read_remote(now)
+
+    def _read_remote(self, now: float):
+        """Read the transfers other processes published"""
+        remote = []
+        for name in os.listdir(self.state_folder):
+            if not name.endswith(".json") or name == f"{os.getpid()}.json":
+                continue
+            path = os.path.join(self.state_folder, name)
+            try:
+                if now - os.path.getmtime(path) > STALE_STATE_SECONDS or not pid_alive(int(name[:-5])):
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    remote.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        self._remote = remote
+
+    def _process_budget(self, transfers: List[Transfer], cap: float) -> float:
+        """
+        This process's part of the cap: its weighted share, plus the unused share of
+        other processes split with the ones that are using all of theirs
+        """
+        local_weight = sum(t.weight for t in transfers)
+        total_weight = local_weight + sum(r["weight"] for r in self._remote)
+        share = cap * local_weight / total_weight
+        spare, hungry_weight = 0.0, local_weight
+        for r in self._remote:
+            remote_share = cap * r["weight"] / total_weight
+            if r["rate"] < remote_share * UNDERUSE_RATIO:
+                spare += remote_share - r["rate"]
+            else:
+                hungry_weight += r["weight"]
+        return share + spare * local_weight / hungry_weight
+
+    def _control_loop(self):
+        last = time.time()
+        while True:
+            time.sleep(CONTROL_INTERVAL)
+            now = time.time()
+            elapsed, last = now - last, now
+            with self._lock:
+                transfers = list(self._transfers)
+            for t in transfers:
+                t._measure(now)
+
+            cap = mbps_to_bytes(self.current_limit_mbps())
+            budget = self._process_budget(transfers, cap) if cap and transfers else 0.0
+            if self.state_folder and now - self._last_share >= SHARE_INTERVAL:
+                self._last_share = now
+                self._share(transfers, budget, now)
+
+            if not cap:
+                for t in transfers:
+                    t.allowed = 0.0
+                    t.resume()
+                continue
+
+            # A transfer well below its share while running is limited elsewhere (server, disk)
+            demands = [
+                (t, t.weight, t.rate / UNDERUSE_RATIO
+                 if t.allowed and not t.paused and t.rate < t.allowed * UNDERUSE_RATIO else float("inf"))
+                for t in transfers
+            ]
+            shares = fair_shares(budget, demands)
+            for t in transfers:
+                t.allowed = shares.get(t, 0.0)
+                t.allowance = min(t.allowance + t.allowed * elapsed, t.allowed * BURST_SECONDS)
+                if t.allowance < 0:
+                    t.pause()
+                else:
+                    t.resume()
+
+    def report(self) -> Dict[str, Any]:
+        """Aggregate throughput of all processes against the current cap"""
+        with self._lock:
+            local = [t.to_dict() for t in self._transfers]
+            local_rate = sum(t.rate for t in self._transfers)
+        if self.state_folder:
+            # Processes without transfers of their own (e.g. the HTTP server) run no control loop
+            now = time.time()
+            if now - max(self._last_share, self._last_read) >= SHARE_INTERVAL:
+                self._last_read = now
+                try:
+                    self._read_remote(now)
+                except OSError as e:
+                    print(f"Could not read bandwidth state: {e}")
+        remote = self._remote if self.state_folder else []
+        limit = self.current_limit_mbps()
+        throughput = bytes_to_mbps(local_rate + sum(r["rate"] for r in remote))
+        return {
+            "limit_mbps": limit or None,
+            "default_limit_mbps": self.limit_mbps or None,
+            "schedule": [
+                {"start": f"{s // 60:02d}:{s % 60:02d}", "end": f"{e // 60:02d}:{e % 60:02d}", "limit_mbps": mbps or None}
+                for s, e, mbps in self.schedule
+            ],
+            "throughput_mbps": throughput,
+            "utilization_percent": round(throughput / limit * 100, 1) if limit else None,
+            "enforced": CAN_PAUSE,
+            "processes": (1 if local else 0) + len(remote),
+            "transfers": local + [t for r in remote for t in r["transfers"]],
+        }
+
+
+bandwidth_manager = BandwidthManager(BANDWIDTH_LIMIT_MBPS, parse_schedule(BANDWIDTH_SCHEDULE))
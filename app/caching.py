@@ -0,0 +1,154 @@
+"""
+HTTP Caching and Compression
+- gzip/brotli negotiation for text responses above a size threshold
+- strong ETags with 304 handling for JSON API responses
+- content-hashed static URLs served with immutable caching
+Brotli is used when the `brotli` package is installed.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/javascript",
+    "text/javascript",
+    "text/css",
+    "text/html",
+    "text/plain",
+    "image/svg+xml",
+}
+
+# Fingerprinted static files never change under the same URL
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY_DYNAMIC = 5
+BROTLI_QUALITY_STATIC = 11
+
+_static_hashes: Dict[str, Tuple[float, str]] = {}
+_static_compressed: Dict[Tuple[str, float, str], bytes] = {}
+_lock = threading.Lock()
+
+
+def static_fingerprint(static_folder: str, filename: str) -> Optional[str]:
+    """Short content hash of a static file, cached until the file changes"""
+    path = os.path.join(static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _lock:
+        cached = _static_hashes.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    with _lock:
+        _static_hashes[path] = (mtime, digest)
+    return digest
+
+
+def choose_encoding() -> Optional[str]:
+    """Pick the best content encoding the client accepts"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"] > 0:
+        return "br"
+    if accepted["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+def compress(data: bytes, encoding: str, static: bool = False) -> bytes:
+    if encoding == "br":
+        quality = BROTLI_QUALITY_STATIC if static else BROTLI_QUALITY_DYNAMIC
+        return brotli.compress(data, quality=quality)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_static(path: str, data: bytes, encoding: str) -> bytes:
+    """Compress a static file once per version and encoding"""
+    key = (path, os.path.getmtime(path), encoding)
+    with _lock:
+        cached = _static_compressed.get(key)
+    if cached is None:
+        cached = compress(data, encoding, static=True)
+        with _lock:
+            _static_compressed[key] = cached
+    return cached
+
+
+def init_http_caching(app):
+    """Register static URL fingerprinting and the caching/compression response hook"""
+
+    @app.url_defaults
+    def add_static_fingerprint(endpoint, values):
+        if endpoint == "static" and "filename" in values and "v" not in values:
+            fingerprint = static_fingerprint(app.static_folder, values["filename"])
+            if fingerprint:
+                values["v"] = fingerprint
+
+    @app.after_request
+    def cache_and_compress(response):
+        if request.method not in ("GET", "HEAD") or response.status_code != 200:
+            return response
+        if "Content-Encoding" in response.headers or "Content-Range" in response.headers:
+            return response
+
+        is_static = request.endpoint == "static"
+        if is_static and request.args.get("v"):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+
+        is_json = response.mimetype == "application/json"
+        compressible = response.mimetype in COMPRESSIBLE_MIMETYPES
+        if not compressible:
+            return response
+        # Static files are small; other streamed bodies (e.g. generators) are left alone
+        if response.is_streamed and not is_static:
+            return response
+
+        response.direct_passthrough = False
+        data = response.get_data()
+        encoding = choose_encoding() if len(data) >= COMPRESS_MIN_BYTES else None
+        response.vary.add("Accept-Encoding")
+
+        # Strong ETag per representation, so revalidation of unchanged JSON costs a 304
+        if is_json:
+            etag = hashlib.sha1(data).hexdigest()
+            response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response
+
+        if encoding:
+            if is_static:
+                path = os.path.join(app.static_folder, request.view_args["filename"])
+                body = compress_static(path, data, encoding)
+                etag, _ = response.get_etag()
+                if etag:
+                    response.set_etag(f"{etag}-{encoding}")
+            else:
+                body = compress(data, encoding)
+            response.set_data(body)
+            response.headers["Content-Encoding"] = encoding
+            if is_static:
+                # send_file matched If-None-Match against the uncompressed ETag
+                response.make_conditional(request)
+        return response
@@ -0,0 +1,248 @@
+"""
+Job Cancellation
+Cooperative cancellation of download jobs. Cancelling a job writes a marker
+file under the download folder's app data, so it reaches the job whichever
+server or worker process runs it. The job checks its token between stages
+and while sleeping, and raises JobCancelled to unwind; child processes
+registered with the token (yt-dlp, ffmpeg) are terminated right away, first
+with SIGTERM and after CANCEL_GRACE_SECONDS with SIGKILL.
+
+The token of a job is bound to the thread running it, like the tracer, so
+instrumented code calls check() and start_process() without passing it around.
+"""
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set
+
+# Seconds children get to exit after SIGTERM before they are killed
+CANCEL_GRACE_SECONDS = 5
+
+# How often cancel markers are checked
+CANCEL_POLL_SECONDS = 0.5
+
+_local = threading.local()
+
+
+class JobCancelled(BaseException):
+    """
+    Raised inside a job once it has been cancelled. A BaseException (like
+    KeyboardInterrupt) so the downloader's `except Exception` handlers let it through.
+    """
+
+
+class CancelToken:
+    """Cancellation state of one job and the child processes it is running"""
+    def __init__(self, job_id: int, marker_path: Optional[str] = None):
+        self.job_id = job_id
+        self.marker_path = marker_path
+        self._event = threading.Event()
+        self._processes: Set[subprocess.Popen] = set()
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self.marker_path:
+            now = time.time()
+            if now - self._last_check >= CANCEL_POLL_SECONDS:
+                self._last_check = now
+                if os.path.exists(self.marker_path):
+                    self._event.set()
+        return self._event.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.job_id} was cancelled")
+
+    def sleep(self, seconds: float):
+        """Sleep, raising JobCancelled as soon as the job is cancelled"""
+        deadline = time.time() + seconds
+        while True:
+            self.check()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self._event.wait(min(remaining, CANCEL_POLL_SECONDS))
+
+    def register(self, process: subprocess.Popen):
+        """Terminate this process group (see start_process) when the job is cancelled"""
+        with self._lock:
+            self._processes.add(process)
+        _watcher.watch(self)
+
+    def unregister(self, process: subprocess.Popen):
+        with self._lock:
+            self._processes.discard(process)
+
+    def processes(self) -> List[subprocess.Popen]:
+        with self._lock:
+            return [p for p in self._processes if p.poll() is None]
+
+    def terminate_processes(self):
+        terminate_process_groups(self.processes())
+
+
+def _signal_group(process: subprocess.Popen, sig):
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, sig)
+        else:
+            process.send_signal(sig)
+    except OSError:
+        pass
+
+
+def terminate_process_groups(processes: List[subprocess.Popen], grace: float = CANCEL_GRACE_SECONDS):
+    """SIGTERM the process groups (see start_process), then SIGKILL those still running after the grace period"""
+    running = [p for p in processes if p.poll() is None]
+    for process in running:
+        _signal_group(process, signal.SIGTERM)
+        if hasattr(signal, "SIGCONT"):
+            # A group paused by the bandwidth manager only handles SIGTERM once resumed
+            _signal_group(process, signal.SIGCONT)
+    deadline = time.time() + grace
+    while running and time.time() < deadline:
+        time.sleep(0.1)
+        running = [p for p in running if p.poll() is None]
+    for process in running:
+        _signal_group(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+
+class _Watcher:
+    """Background thread terminating the children of cancelled jobs"""
+    def __init__(self):
+        self._tokens: Set[CancelToken] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, token: CancelToken):
+        with self._lock:
+            self._tokens.add(token)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._loop, name="cancel-watcher", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(CANCEL_POLL_SECONDS)
+            with self._lock:
+                tokens = list(self._tokens)
+            for token in tokens:
+                if not token.processes():
+                    with self._lock:
+                        self._tokens.discard(token)
+                elif token.cancelled:
+                    token.terminate_processes()
+
+
+_watcher = _Watcher()
+
+# Tokens of the jobs running in this process
+_tokens: Dict[int, CancelToken] = {}
+_tokens_lock = threading.Lock()
+
+
+def marker_path(cancel_folder: str, job_id: int) -> str:
+    return os.path.join(cancel_folder, str(job_id))
+
+
+def request_cancel(job_id: int, cancel_folder: str):
+    """Cancel a job wherever it runs: set its local token and leave a marker for other processes"""
+    os.makedirs(cancel_folder, exist_ok=True)
+    with open(marker_path(cancel_folder, job_id), "w", encoding="utf-8") as f:
+        f.write(str(time.time()))
+    with _tokens_lock:
+        token = _tokens.get(job_id)
+    if token is not None:
+        token.cancel()
+
+
+def cancel_running():
+    """Cancel every job running in this process (e.g. on Ctrl+C in the batch CLI)"""
+    with _tokens_lock:
+        tokens = list(_tokens.values())
+    for token in tokens:
+        token.cancel()
+
+
+def clear_cancel(job_id: int, cancel_folder: str):
+    """Remove a job's cancel marker (job ids can be reused after a restart)"""
+    try:
+        os.remove(marker_path(cancel_folder, job_id))
+    except OSError:
+        pass
+
+
+@contextmanager
+def activate(token: CancelToken) -> Iterator[CancelToken]:
+    """Bind a job's token to the current thread for the duration of the job"""
+    previous = current_token()
+    _local.token = token
+    with _tokens_lock:
+        _tokens[token.job_id] = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+        with _tokens_lock:
+            if _tokens.get(token.job_id) is token:
+                del _tokens[token.job_id]
+
+
+def current_token() -> Optional[CancelToken]:
+    return getattr(_local, "token", None)
+
+
+def check():
+    """Raise JobCancelled if the job running in this thread was cancelled"""
+    token = current_token()
+    if token is not None:
+        token.check()
+
+
+def sleep(seconds: float):
+    """time.sleep that ends early with JobCancelled when the current job is cancelled"""
+    token = current_token()
+    if token is None:
+        time.sleep(seconds)
+    else:
+        token.sleep(seconds)
+
+
+def start_process(cmd: List[str], token: Optional[CancelToken] = None, **kwargs) -> subprocess.Popen:
+    """
+    Start a child in its own process group, registered with a job's token (default:
+    the current thread's) so cancelling the job terminates it and its children
+    """
+    token = token or current_token()
+    if token is not None:
+        token.check()
+    process = subprocess.Popen(cmd, start_new_session=os.name != "nt", **kwargs)
+    if token is not None:
+        token.register(process)
+    return process
+
+
+def finish_process(process: subprocess.Popen, token: Optional[CancelToken] = None):
+    """Unregister a finished child started by start_process"""
+    token = token or current_token()
+    if token is not None:
+        token.unregister(process)
+
+
+def run_process(cmd: List[str]) -> subprocess.CompletedProcess:
+    """subprocess.run(cmd, capture_output=True, text=True) that is terminated when the job is cancelled"""
+    process = start_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        stdout, stderr = process.communicate()
+    finally:
+        finish_process(process)
+    check()
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
@@ -0,0 +1,388 @@
+"""
+Anime Catalog
+Local store of the series seen upstream (title, URL, id, poster, episode
+count), filled from search results, download jobs and optionally a crawler of
+the browse pages. A trigram index answers searches from memory and tolerates
+typos, so /api/search/anime no longer waits for upstream on every keystroke;
+a query is only searched upstream again, in the background, once its last
+upstream search is older than CATALOG_SEARCH_TTL_HOURS.
+
+The catalog is a JSON file under the download folder's app data. Changes are
+made under a file lock and other processes reload the file when it changes.
+"""
+import collections
+import json
+import os
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from app.mirrors import mirror_pool
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process only
+    fcntl = None
+
+# Hours before a query is searched upstream again
+CATALOG_SEARCH_TTL_HOURS = float(os.environ.get("CATALOG_SEARCH_TTL_HOURS", "24"))
+
+# Browse pages crawled into the catalog (0 = no crawler)
+CATALOG_CRAWL_PAGES = int(os.environ.get("CATALOG_CRAWL_PAGES", "0"))
+
+# Hours between two crawls
+CATALOG_CRAWL_INTERVAL_HOURS = float(os.environ.get("CATALOG_CRAWL_INTERVAL_HOURS", "24"))
+
+# Seconds between two crawled pages
+CRAWL_PAGE_SPACING_SECONDS = 5
+
+# Seconds between attempts of a non-crawling process to take over the crawler
+CRAWLER_LOCK_RETRY_SECONDS = 60
+
+# Lowest score of a fuzzy match (share of the query's trigrams found in a title)
+MIN_MATCH_SCORE = 0.4
+
+# Upstream queries remembered with their result order; the oldest are forgotten first
+MAX_CACHED_QUERIES = 2000
+
+# Seconds between checks whether another process changed the catalog file
+RELOAD_CHECK_SECONDS = 1.0
+
+
+def normalize(text: str) -> str:
+    """Lowercase words without accents or punctuation"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join("".join(c if c.isalnum() else " " for c in text).split())
+
+
+def trigrams(text: str) -> Set[str]:
+    """Trigrams of every word, padded so word starts and ends weigh more (like pg_trgm)"""
+    grams = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def canonical_url(url: str) -> str:
+    """Series URL on the canonical mirror without query, fragment or trailing slash, used as the catalog key"""
+    parts = urlsplit(mirror_pool.rewrite(url.strip(), mirror_pool.canonical))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path.rstrip("/"), "", ""))
+
+
+class TrigramIndex:
+    """Inverted index from trigrams to the keys whose text contains them"""
+    def __init__(self):
+        self._postings: Dict[str, Set[str]] = collections.defaultdict(set)
+        self._grams: Dict[str, Set[str]] = {}
+
+    def add(self, key: str, text: str):
+        self.remove(key)
+        grams = trigrams(text)
+        self._grams[key] = grams
+        for gram in grams:
+            self._postings[gram].add(key)
+
+    def remove(self, key: str):
+        for gram in self._grams.pop(key, ()):
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+
+    def search(self, query: str, limit: int, min_score: float = MIN_MATCH_SCORE) -> List[Tuple[str, float]]:
+        """
+        Keys ranked by how much of the query they contain, ties broken towards
+        texts of similar length (Dice similarity)
+        """
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+        shared: Dict[str, int] = collections.Counter()
+        for gram in query_grams:
+            for key in self._postings.get(gram, ()):
+                shared[key] += 1
+        scored = []
+        for key, count in shared.items():
+            containment = count / len(query_grams)
+            if containment < min_score:
+                continue
+            dice = 2 * count / (len(query_grams) + len(self._grams[key]))
+            scored.append((key, round(0.8 * containment + 0.2 * dice, 3)))
+        scored.sort(key=lambda item: -item[1])
+        return scored[:limit]
+
+    def __len__(self) -> int:
+        return len(self._grams)
+
+
+class Catalog:
+    """Series entries, the upstream queries they came from and their trigram index"""
+    def __init__(self, folder: str):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, "catalog.json")
+        self._lock = threading.RLock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._queries: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+        self._meta: Dict[str, Any] = {}
+        self._index = TrigramIndex()
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._refreshing: Set[str] = set()
+        self._reload(force=True)
+
+    def _reload(self, force: bool = False):
+        """Load the file if another process (or this one, before start) changed it"""
+        now = time.time()
+        if not force and now - self._checked < RELOAD_CHECK_SECONDS:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load catalog: {e}")
+            return
+        self._mtime = mtime
+        self._entries = data.get("entries", {})
+        self._queries = collections.OrderedDict(data.get("queries", {}))
+        self._meta = data.get("meta", {})
+        self._index = TrigramIndex()
+        for url, entry in self._entries.items():
+            self._index.add(url, entry["title"])
+
+    @contextmanager
+    def _update(self) -> Iterator[None]:
+        """Change the catalog under the process and file locks, then write it"""
+        with self._lock, open(f"{self.path}.lock", "a+") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._reload(force=True)
+                yield
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"entries": self._entries, "queries": self._queries, "meta": self._meta}, f)
+                os.replace(tmp_path, self.path)
+                self._mtime = os.path.getmtime(self.path)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _merge(self, item: Dict[str, Any], source: str, now: float) -> Optional[str]:
+        url = canonical_url(item.get("url") or "")
+        title = (item.get("title") or "").strip()
+        if not url or not title:
+            return None
+        entry = self._entries.get(url) or {"url": url, "first_seen": now, "sources": []}
+        entry.update(
+            title=title,
+            anime_id=item.get("anime_id") or entry.get("anime_id") or url.rsplit("/", 1)[-1],
+            image_source=item.get("image_source") or entry.get("image_source") or "",
+            episodes=item.get("episodes") or entry.get("episodes"),
+            updated=now,
+        )
+        if source not in entry["sources"]:
+            entry["sources"].append(source)
+        self._entries[url] = entry
+        self._index.add(url, title)
+        return url
+
+    def add_results(self, items: List[Dict[str, Any]], source: str, query: Optional[str] = None):
+        """
+        Merge search-result-like dicts (title, url, anime_id, image_source, episodes);
+        with a query, also remember which results upstream returned for it
+        """
+        now = time.time()
+        with self._update():
+            urls = [url for url in (self._merge(item, source, now) for item in items) if url]
+            if query is not None:
+                key = normalize(query)
+                self._queries.pop(key, None)
+                self._queries[key] = {"refreshed": now, "urls": urls}
+                while len(self._queries) > MAX_CACHED_QUERIES:
+                    self._queries.popitem(last=False)
+
+    def record_series(self, url: str, title: str, episodes: Optional[int] = None):
+        """Add or update a series seen by a download job"""
+        self.add_results([{"url": url, "title": title, "episodes": episodes}], "job")
+
+    def _result(self, url: str, score: Optional[float]) -> Dict[str, Any]:
+        from app.thumbnails import thumbnail_url
+
+        entry = self._entries[url]
+        return {
+            "title": entry["title"],
+            "url": entry["url"],
+            "image": thumbnail_url(entry["image_source"]) if entry.get("image_source") else "",
+            "image_source": entry.get("image_source", ""),
+            "anime_id": entry["anime_id"],
+            "episodes": entry.get("episodes"),
+            "score": score,
+        }
+
+    def search(self, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Results upstream returned for this query last time (in their order),
+        followed by fuzzy matches from the rest of the catalog
+        """
+        with self._lock:
+            self._reload()
+            cached = self._queries.get(normalize(query))
+            urls = [url for url in (cached or {}).get("urls", []) if url in self._entries]
+            results = [self._result(url, None) for url in urls[:limit]]
+            seen = set(urls)
+            for url, score in self._index.search(query, limit):
+                if len(results) >= limit:
+                    break
+                if url not in seen:
+                    results.append(self._result(url, score))
+            return results
+
+    def last_refreshed(self, query: str) -> Optional[float]:
+        with self._lock:
+            self._reload()
+            cached = self._queries.get(normalize(query))
+            return cached["refreshed"] if cached else None
+
+    def is_stale(self, query: str) -> bool:
+        refreshed = self.last_refreshed(query)
+        return refreshed is None or time.time() - refreshed > CATALOG_SEARCH_TTL_HOURS * 3600
+
+    def refresh(self, query: str, fetch: Callable[[str], List[Dict[str, Any]]]):
+        """Search upstream now and store the results"""
+        results = fetch(query)
+        # An empty answer may just be an upstream error: keep the older results and ask again next time
+        if results:
+            self.add_results(results, "search", query)
+
+    def refresh_in_background(self, query: str, fetch: Callable[[str], List[Dict[str, Any]]]):
+        """Start refreshing a query unless that is already underway"""
+        key = normalize(query)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self.refresh(query, fetch)
+            except Exception as e:
+                print(f"Catalog refresh of '{query}' failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name="catalog-refresh", daemon=True).start()
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            self._reload()
+            return self._meta.get(key, default)
+
+    def set_meta(self, key: str, value):
+        with self._update():
+            self._meta[key] = value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._reload()
+            sources: Dict[str, int] = collections.Counter(
+                source for entry in self._entries.values() for source in entry.get("sources", [])
+            )
+            return {
+                "series": len(self._entries),
+                "cached_queries": len(self._queries),
+                "sources": dict(sources),
+                "last_crawl": self._meta.get("last_crawl"),
+                "search_ttl_hours": CATALOG_SEARCH_TTL_HOURS,
+                "crawl_pages": CATALOG_CRAWL_PAGES,
+            }
+
+
+class CatalogCrawler:
+    """Background thread adding the first CATALOG_CRAWL_PAGES browse pages to the catalog"""
+    def __init__(self, catalog: Catalog, download_folder: str,
+                 fetch_page: Callable[[int], List[Dict[str, Any]]]):
+        self.catalog = catalog
+        self.download_folder = download_folder
+        self.fetch_page = fetch_page
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if CATALOG_CRAWL_PAGES <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, name="catalog-crawler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        from app.utils import get_app_data_folder, try_acquire_process_lock
+
+        # With several server processes only the one holding the lock crawls
+        lock_path = os.path.join(get_app_data_folder(self.download_folder, "catalog"), "crawler.lock")
+        lock = None
+        while lock is None:
+            lock = try_acquire_process_lock(lock_path)
+            if lock is None:
+                time.sleep(CRAWLER_LOCK_RETRY_SECONDS)
+
+        interval = CATALOG_CRAWL_INTERVAL_HOURS * 3600
+        while True:
+            wait = (self.catalog.get_meta("last_crawl") or 0) + interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            self.crawl()
+
+    def crawl(self):
+        added = 0
+        for page in range(1, CATALOG_CRAWL_PAGES + 1):
+            try:
+                items = self.fetch_page(page)
+            except Exception as e:
+                print(f"Catalog crawl of page {page} failed: {e}")
+                break
+            if not items:
+                break
+            self.catalog.add_results(items, "crawl")
+            added += len(items)
+            time.sleep(CRAWL_PAGE_SPACING_SECONDS)
+        self.catalog.set_meta("last_crawl", time.time())
+        print(f"Catalog crawl finished: {added} series from up to {CATALOG_CRAWL_PAGES} page(s)")
+
+
+_catalogs: Dict[str, Catalog] = {}
+_catalogs_lock = threading.Lock()
+
+def get_catalog(download_folder: str) -> Catalog:
+    """Return the catalog of a download folder, loading it on first use"""
+    from app.utils import get_app_data_folder
+
+    folder = get_app_data_folder(download_folder, "catalog")
+    with _catalogs_lock:
+        if folder not in _catalogs:
+            _catalogs[folder] = Catalog(folder)
+        return _catalogs[folder]
+
+
+catalog_crawler: Optional[CatalogCrawler] = None
+
+def init_catalog_crawler(download_folder: str) -> CatalogCrawler:
+    """Start the browse page crawler (a no-op unless CATALOG_CRAWL_PAGES is set)"""
+    from app.search import browse_page
+
+    global catalog_crawler
+    catalog_crawler = CatalogCrawler(get_catalog(download_folder), download_folder, browse_page)
+    catalog_crawler.start()
+    return catalog_crawler
@@ -0,0 +1,263 @@
+"""
+Headless Batch Downloads
+Runs download jobs from a file of anime URLs without the web server, using the
+same job code as the API, and streams newline-delimited JSON progress to stdout.
+
+Each line of the batch file is an anime URL, optionally followed by an episode
+selection (5, 1-12 or 1,3,7) and key=value options named like the fields of
+/api/download/start, e.g.
+
+    https://anikai.to/watch/some-anime 1-12 prefer_type="Hard Sub" merge_episodes=true
+
+A line may also be a JSON object with anime_url and the same options. Blank
+lines and lines starting with # are ignored.
+
+Usage: python batch.py urls.txt [--parallel N] [--download-folder DIR]
+Exit status: 0 when every job completed with all its episodes, 1 otherwise,
+2 when the batch file is invalid.
+"""
+import argparse
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from app import cancellation
+from app.jobs import build_job_config, job_config_error, run_download_job
+from app.models import DownloadJob
+
+# Options whose values are parsed as integers or booleans
+INT_OPTIONS = ("max_retries", "timeout", "max_workers", "season_number")
+BOOL_OPTIONS = ("merge_episodes", "keep_individual_files", "sync_mode")
+
+# Job fields included in every progress event
+PROGRESS_FIELDS = (
+    "status", "progress", "current_episode", "total_episodes", "completed_episodes",
+    "skipped_episodes", "anime_title", "season", "error",
+)
+
+
+class BatchError(ValueError):
+    """Invalid line in a batch file"""
+
+
+def parse_option(key: str, value: str) -> Any:
+    if key in INT_OPTIONS:
+        try:
+            return int(value)
+        except ValueError:
+            raise BatchError(f"{key} must be a number, got '{value}'")
+    if key in BOOL_OPTIONS:
+        if value.lower() not in ("1", "0", "true", "false", "yes", "no"):
+            raise BatchError(f"{key} must be true or false, got '{value}'")
+        return value.lower() in ("1", "true", "yes")
+    return value
+
+
+def parse_selection(token: str) -> Dict[str, Any]:
+    """Episode selection token -> download mode options"""
+    if "," in token:
+        return {"download_mode": "Episode List", "episode_ids": [e.strip() for e in token.split(",") if e.strip()]}
+    if "-" in token:
+        start, _, end = token.partition("-")
+        return {"download_mode": "Episode Range", "start_episode": start, "end_episode": end}
+    return {"download_mode": "Single Episode", "single_episode": token}
+
+
+def parse_batch_line(line: str) -> Dict[str, Any]:
+    """Parse one batch file line into start_download request data"""
+    if line.startswith("{"):
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise BatchError(f"invalid JSON: {e}")
+        if not isinstance(data, dict) or not data.get("anime_url"):
+            raise BatchError("JSON line needs an anime_url")
+        return data
+
+    try:
+        tokens = shlex.split(line)
+    except ValueError as e:
+        raise BatchError(str(e))
+    data = {"anime_url": tokens[0]}
+    for token in tokens[1:]:
+        if "=" in token:
+            key, _, value = token.partition("=")
+            data[key] = parse_option(key, value)
+        else:
+            data.update(parse_selection(token))
+    return data
+
+
+def read_batch_file(path: str) -> List[Tuple[int, Dict[str, Any]]]:
+    """Return (line number, request data) for every entry, raising BatchError on the first bad line"""
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, raw in enumerate(f, 1):
+            line = raw.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                data = parse_batch_line(line)
+                error = job_config_error(data)
+                if error:
+                    raise BatchError(error)
+            except BatchError as e:
+                raise BatchError(f"{path}:{number}: {e}")
+            entries.append((number, data))
+    return entries
+
+
+class EventWriter:
+    """Writes one JSON object per line, safely from several job threads"""
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, event: str, **fields):
+        line = json.dumps({"event": event, "time": datetime.now().isoformat(timespec="seconds"), **fields},
+                          default=str, ensure_ascii=False)
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+class BatchJob(DownloadJob):
+    """DownloadJob that reports every log entry and state change as an event"""
+    def __init__(self, job_id, anime_url, config, events: EventWriter):
+        self._events = events
+        super().__init__(job_id, anime_url, config)
+
+    def _state(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in PROGRESS_FIELDS}
+
+    def add_log(self, level, message):
+        super().add_log(level, message)
+        self._events.emit("log", job_id=self.job_id, level=level, message=message, **self._state())
+
+    def publish(self, log_entry=None):
+        self._events.emit("progress", job_id=self.job_id, transcode_progress=self.transcode_progress, **self._state())
+
+
+def run_batch(entries: List[Tuple[int, Dict[str, Any]]], download_folder: str,
+              parallel: int, events: EventWriter, trace_folder: str = None) -> Dict[str, Any]:
+    """
+    Run the batch entries, at most `parallel` jobs at a time, and return the summary.
+    Ctrl+C cancels the running jobs and skips the rest.
+    """
+    from app.utils import get_app_data_folder
+
+    # Batch job ids restart at 1, so keep their cancel markers apart from the server's jobs
+    cancel_folder = get_app_data_folder(download_folder, "cancel", f"batch-{os.getpid()}")
+    jobs: List[BatchJob] = []
+    pending = list(enumerate(entries, 1))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                job_id, (line, data) = pending.pop(0)
+            job = BatchJob(job_id, data["anime_url"], build_job_config(data), events)
+            with lock:
+                jobs.append(job)
+            events.emit("started", job_id=job_id, line=line, anime_url=job.anime_url, config=job.config)
+            try:
+                run_download_job(job, download_folder, trace_folder, cancel_folder)
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                job.end_time = datetime.now()
+            events.emit("finished", **job.to_dict())
+
+    started = time.time()
+    threads = [
+        threading.Thread(target=worker, name=f"batch-{i}", daemon=True)
+        for i in range(max(1, min(parallel, len(entries))))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        # Children run in their own process groups and don't see the terminal's SIGINT
+        print("Interrupted, cancelling running jobs...")
+        with lock:
+            pending.clear()
+        cancellation.cancel_running()
+        for thread in threads:
+            thread.join()
+    try:
+        os.rmdir(cancel_folder)
+    except OSError:
+        pass
+
+    jobs.sort(key=lambda j: j.job_id)
+    incomplete = [j for j in jobs if j.status != "completed" or j.completed_episodes < j.total_episodes]
+    return {
+        "jobs": len(jobs),
+        "completed": len(jobs) - len(incomplete),
+        "failed": len(incomplete),
+        "failed_jobs": [{"job_id": j.job_id, "anime_url": j.anime_url, "error": j.error} for j in incomplete],
+        # Episodes already in the library are counted as completed too
+        "episodes_downloaded": sum(j.completed_episodes - j.skipped_episodes for j in jobs),
+        "episodes_skipped": sum(j.skipped_episodes for j in jobs),
+        "episodes_failed": sum(max(0, j.total_episodes - j.completed_episodes) for j in jobs),
+        "elapsed_seconds": round(time.time() - started, 1),
+    }
+
+
+def main(argv=None) -> int:
+    default_folder = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")), "downloads")
+    parser = argparse.ArgumentParser(description="Download anime listed in a batch file without the web interface")
+    parser.add_argument("batch_file", help="file with one anime URL (plus selection and options) per line")
+    parser.add_argument("--parallel", "-p", type=int, default=int(os.environ.get("BATCH_PARALLEL", "2")),
+                        help="jobs to run at the same time (default: 2)")
+    parser.add_argument("--download-folder", default=os.environ.get("DOWNLOAD_FOLDER", default_folder),
+                        help="library folder to download into (default: DOWNLOAD_FOLDER)")
+    parser.add_argument("--trace-dir", help="write a Chrome trace of every job to DIR/<job>.json "
+                                            "(default: .appdata/traces/batch-<start time> in the download folder)")
+    args = parser.parse_args(argv)
+
+    # stdout carries only the JSON events; the downloader's own messages go to stderr
+    events = EventWriter(sys.stdout)
+    sys.stdout = sys.stderr
+
+    try:
+        entries = read_batch_file(args.batch_file)
+    except (OSError, BatchError) as e:
+        events.emit("error", message=str(e))
+        return 2
+
+    from app.staging import cleanup_orphaned_staging
+    from app.upstream import configure_upstream, start_warm_up
+    from app.utils import create_download_folder, get_app_data_folder
+
+    create_download_folder(args.download_folder)
+    cleanup_orphaned_staging(args.download_folder)
+    configure_upstream(args.download_folder)
+    start_warm_up()
+
+    trace_folder = args.trace_dir or get_app_data_folder(
+        args.download_folder, "traces", datetime.now().strftime("batch-%Y%m%d-%H%M%S")
+    )
+
+    summary = run_batch(entries, args.download_folder, args.parallel, events, trace_folder)
+    summary["trace_folder"] = trace_folder
+    events.emit("summary", **summary)
+    print(
+        f"Batch finished: {summary['completed']}/{summary['jobs']} job(s) completed, "
+        f"{summary['episodes_downloaded']} episode(s) downloaded, {summary['episodes_failed']} failed "
+        f"in {summary['elapsed_seconds']}s"
+    )
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,436 @@
+"""
+Distributed Downloads
+Coordinator/worker mode for spreading the episodes of download jobs over
+several machines. With CLUSTER_DISTRIBUTE=1 the server (the coordinator) turns
+every episode of a job into a task on a task board. Remote workers (python
+worker.py, the same codebase) lease tasks over HTTP, resolve and download the
+episode themselves and report the result back.
+
+Leases are kept alive by worker heartbeats; a task whose lease expires (the
+worker died or lost the network) goes back to the board for another worker.
+Finished files either land directly on storage shared with the coordinator
+(--shared-storage) or are uploaded to the coordinator, which verifies and
+publishes them like a local download.
+
+The board is a JSON file under the download folder's app data, locked with
+flock for every change, so all server processes share it.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app import cancellation
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single coordinator process only
+    fcntl = None
+
+# Shared secret for the worker API (the API is disabled while unset)
+CLUSTER_TOKEN = os.environ.get("CLUSTER_TOKEN", "")
+
+# Hand episodes of new jobs to remote workers instead of downloading them here
+CLUSTER_DISTRIBUTE = os.environ.get("CLUSTER_DISTRIBUTE", "0") == "1"
+
+# Seconds a lease lasts without a heartbeat
+LEASE_SECONDS = int(os.environ.get("CLUSTER_LEASE_SECONDS", "60"))
+
+# Leases of one task before it is failed
+MAX_TASK_ATTEMPTS = 3
+
+# Finished tasks are removed from the board after this many seconds
+FINISHED_TASK_TTL = 3600
+
+# How often a job checks the board for results of its tasks
+RESULT_POLL_SECONDS = 1
+
+# Log lines kept per task and reported back to the job
+MAX_TASK_LOGS = 50
+
+# Episode job options a worker needs to download an episode
+TASK_CONFIG_KEYS = (
+    "prefer_type", "prefer_server", "download_method", "max_retries", "timeout", "max_workers", "priority",
+    "quality_policy",
+)
+
+ACTIVE_STATES = ("pending", "leased")
+
+
+class TaskBoard:
+    """Episode tasks and their leases, stored in a locked JSON file"""
+    def __init__(self, folder: str):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, "tasks.json")
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _state(self) -> Iterator[Dict[str, Any]]:
+        """Read-modify-write the board under the process and file locks"""
+        with self._lock, open(self.path, "a+", encoding="utf-8") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                state.setdefault("tasks", {})
+                state.setdefault("workers", {})
+                before = json.dumps(state, sort_keys=True)
+                yield state
+                if json.dumps(state, sort_keys=True) != before:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def submit(self, job_id: int, episode: Dict[str, Any], path: str, config: Dict[str, Any]) -> str:
+        """
+        Add a task for an episode file (relative to the download folder). A job asking
+        for a file another job's task is already producing shares that task.
+        """
+        with self._state() as state:
+            for task in state["tasks"].values():
+                if task["path"] == path and task["state"] in ACTIVE_STATES:
+                    task["jobs"].append(job_id)
+                    return task["task_id"]
+            task_id = uuid.uuid4().hex[:12]
+            state["tasks"][task_id] = {
+                "task_id": task_id,
+                "jobs": [job_id],
+                "episode": episode,
+                "path": path,
+                "config": {key: config[key] for key in TASK_CONFIG_KEYS if key in config},
+                "state": "pending",
+                "attempts": 0,
+                "worker": None,
+                "lease_expires": None,
+                "created": time.time(),
+                "finished": None,
+                "error": None,
+                "logs": [],
+            }
+            return task_id
+
+    def _expire(self, state: Dict[str, Any], now: float):
+        """Return tasks with expired leases to the board, failing those out of attempts"""
+        for task in state["tasks"].values():
+            if task["state"] != "leased" or task["lease_expires"] > now:
+                continue
+            message = f"Lease of worker {task['worker']} expired"
+            task["logs"] = (task["logs"] + [{"level": "WARN", "message": message}])[-MAX_TASK_LOGS:]
+            if task["attempts"] >= MAX_TASK_ATTEMPTS:
+                task.update(state="failed", finished=now, error=message)
+            else:
+                task.update(state="pending", worker=None, lease_expires=None)
+        for task_id in [t["task_id"] for t in state["tasks"].values()
+                        if t["finished"] and now - t["finished"] > FINISHED_TASK_TTL]:
+            del state["tasks"][task_id]
+        for worker_id in [w for w, info in state["workers"].items() if now - info["last_seen"] > FINISHED_TASK_TTL]:
+            del state["workers"][worker_id]
+
+    def lease(self, worker_id: str, max_tasks: int, info: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Lease up to max_tasks pending tasks (oldest first) to a worker"""
+        now = time.time()
+        with self._state() as state:
+            self._expire(state, now)
+            state["workers"][worker_id] = {**info, "last_seen": now}
+            pending = sorted(
+                (t for t in state["tasks"].values() if t["state"] == "pending"),
+                key=lambda t: t["created"],
+            )[:max(0, max_tasks)]
+            for task in pending:
+                task.update(state="leased", worker=worker_id, lease_expires=now + LEASE_SECONDS)
+                task["attempts"] += 1
+            return [
+                {key: task[key] for key in ("task_id", "episode", "path", "config", "attempts")}
+                for task in pending
+            ]
+
+    def heartbeat(self, worker_id: str, task_ids: List[str]) -> List[str]:
+        """Extend a worker's leases; returns the given tasks it no longer holds"""
+        now = time.time()
+        lost = []
+        with self._state() as state:
+            self._expire(state, now)
+            if worker_id in state["workers"]:
+                state["workers"][worker_id]["last_seen"] = now
+            for task_id in task_ids:
+                task = state["tasks"].get(task_id)
+                if task and task["state"] == "leased" and task["worker"] == worker_id:
+                    task["lease_expires"] = now + LEASE_SECONDS
+                else:
+                    lost.append(task_id)
+        return lost
+
+    def holds_lease(self, task_id: str, worker_id: str) -> Optional[Dict[str, Any]]:
+        """The task if it is currently leased to the worker"""
+        with self._state() as state:
+            task = state["tasks"].get(task_id)
+            if task and task["state"] == "leased" and task["worker"] == worker_id:
+                return dict(task)
+        return None
+
+    def complete(self, task_id: str, worker_id: str, ok: bool, error: Optional[str] = None,
+                 logs: Optional[List[Dict[str, str]]] = None) -> bool:
+        """
+        Record a worker's result. A failed attempt goes back to the board until the
+        task is out of attempts. Only the worker currently holding the lease may
+        report: results for tasks whose lease expired (and may be leased to another
+        worker by now) or that already finished are ignored.
+        """
+        now = time.time()
+        with self._state() as state:
+            self._expire(state, now)
+            task = state["tasks"].get(task_id)
+            if not task or task["state"] != "leased" or task["worker"] != worker_id:
+                return False
+            task["logs"] = (task["logs"] + [
+                {"level": entry.get("level", "INFO"), "message": f"[{worker_id}] {entry.get('message', '')}"}
+                for entry in (logs or [])
+            ])[-MAX_TASK_LOGS:]
+            if ok:
+                task.update(state="completed", finished=now, worker=worker_id, error=None)
+            elif task["attempts"] >= MAX_TASK_ATTEMPTS:
+                task.update(state="failed", finished=now, error=error or "Download failed")
+            else:
+                task.update(state="pending", worker=None, lease_expires=None, error=error)
+            return True
+
+    def withdraw(self, job_id: int, task_ids: List[str]):
+        """
+        Detach a cancelled job from its unfinished tasks. Tasks no other job is
+        waiting for are cancelled; a worker holding one loses its lease on the next heartbeat.
+        """
+        now = time.time()
+        with self._state() as state:
+            for task_id in task_ids:
+                task = state["tasks"].get(task_id)
+                if not task or task["finished"]:
+                    continue
+                task["jobs"] = [j for j in task["jobs"] if j != job_id]
+                if not task["jobs"]:
+                    task.update(state="cancelled", finished=now, worker=None, lease_expires=None,
+                                error=f"Job {job_id} was cancelled")
+
+    def tasks(self, task_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        with self._state() as state:
+            self._expire(state, time.time())
+            return {task_id: dict(state["tasks"][task_id]) for task_id in task_ids if task_id in state["tasks"]}
+
+    def status(self) -> Dict[str, Any]:
+        """Task counts by state and the workers seen recently"""
+        now = time.time()
+        with self._state() as state:
+            self._expire(state, now)
+            counts: Dict[str, int] = {}
+            for task in state["tasks"].values():
+                counts[task["state"]] = counts.get(task["state"], 0) + 1
+            return {
+                "tasks": counts,
+                "workers": [
+                    {
+                        "worker_id": worker_id,
+                        **info,
+                        "last_seen_seconds": round(now - info["last_seen"], 1),
+                        "active": now - info["last_seen"] < LEASE_SECONDS,
+                        "leased_tasks": sum(1 for t in state["tasks"].values()
+                                            if t["state"] == "leased" and t["worker"] == worker_id),
+                    }
+                    for worker_id, info in sorted(state["workers"].items())
+                ],
+                "lease_seconds": LEASE_SECONDS,
+            }
+
+
+_boards: Dict[str, TaskBoard] = {}
+_boards_lock = threading.Lock()
+
+def get_task_board(download_folder: str) -> TaskBoard:
+    """Return the task board of a download folder"""
+    from app.utils import get_app_data_folder
+
+    folder = get_app_data_folder(download_folder, "cluster")
+    with _boards_lock:
+        if folder not in _boards:
+            _boards[folder] = TaskBoard(folder)
+        return _boards[folder]
+
+
+def distribute_episodes(job, items: List[Tuple[Dict[str, Any], str]],
+                        download_folder: str) -> Iterator[Tuple[Dict[str, Any], str, bool]]:
+    """
+    Hand (episode, filepath) items of a job to remote workers and yield
+    (episode, filepath, success) as their tasks finish. Tasks still unfinished
+    when the job is cancelled are withdrawn from the board.
+    """
+    board = get_task_board(download_folder)
+    submitted = {}
+    for ep, filepath in items:
+        relative = os.path.relpath(filepath, download_folder).replace(os.sep, "/")
+        task_id = board.submit(job.job_id, ep, relative, job.config)
+        submitted[task_id] = (ep, filepath)
+    job.add_log("INFO", f"Queued {len(submitted)} episode(s) for remote workers")
+
+    seen = {}  # task_id -> (state, worker, log count)
+    try:
+        while submitted:
+            cancellation.sleep(RESULT_POLL_SECONDS)
+            for task_id, task in board.tasks(list(submitted)).items():
+                ep, filepath = submitted[task_id]
+                last_state, last_worker, logged = seen.get(task_id, (None, None, 0))
+                for entry in task["logs"][logged:]:
+                    job.add_log(entry["level"], f"Episode {ep['id']}: {entry['message']}")
+                if (task["state"], task["worker"]) != (last_state, last_worker) and task["state"] == "leased":
+                    job.current_episode = ep["id"]
+                    job.add_log("INFO", f"Episode {ep['id']} leased by worker {task['worker']} (attempt {task['attempts']})")
+                seen[task_id] = (task["state"], task["worker"], len(task["logs"]))
+                if task["state"] in ("completed", "failed", "cancelled"):
+                    del submitted[task_id]
+                    yield ep, filepath, task["state"] == "completed" and os.path.exists(filepath)
+            for task_id in [t for t in submitted if t not in seen]:
+                # Removed from the board (e.g. the board file was deleted)
+                ep, filepath = submitted.pop(task_id)
+                yield ep, filepath, False
+    finally:
+        if submitted:
+            board.withdraw(job.job_id, list(submitted))
+
+
+# Worker side
+
+class ClusterWorker:
+    """Leases episode tasks from a coordinator and downloads them"""
+    def __init__(self, coordinator_url: str, token: str, download_folder: str,
+                 concurrency: int = 2, shared_storage: bool = False, worker_id: Optional[str] = None):
+        self.coordinator_url = coordinator_url.rstrip("/")
+        self.token = token
+        self.download_folder = download_folder
+        self.concurrency = max(1, concurrency)
+        self.shared_storage = shared_storage
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._active: Dict[str, cancellation.CancelToken] = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._http = None
+
+    def _request(self, method: str, path: str, **kwargs):
+        if self._http is None:
+            import requests
+            self._http = requests.Session()
+            self._http.headers.update({"Authorization": f"Bearer {self.token}", "X-Worker-Id": self.worker_id})
+        response = self._http.request(method, f"{self.coordinator_url}/api/cluster{path}", timeout=60, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def log(self, message: str):
+        print(f"[worker {self.worker_id}] {message}", flush=True)
+
+    def _heartbeat_loop(self):
+        while not self._stopping.wait(max(1, LEASE_SECONDS // 3)):
+            with self._lock:
+                task_ids = list(self._active)
+            if not task_ids:
+                continue
+            try:
+                lost = self._request("POST", "/heartbeat", json={"worker_id": self.worker_id, "task_ids": task_ids})["lost"]
+                for task_id in lost:
+                    # Withdrawn or handed to another worker: stop downloading and free the slot
+                    self.log(f"Lease of task {task_id} was lost, stopping it")
+                    with self._lock:
+                        token = self._active.get(task_id)
+                    if token is not None:
+                        token.cancel()
+            except Exception as e:
+                self.log(f"Heartbeat failed: {e}")
+
+    def _run_task(self, task: Dict[str, Any]):
+        from app.downloader import AnimeDownloader
+        from app.jobs import resolve_and_download_episode
+        from app.models import DownloadJob
+        from app.staging import discard_staged, get_staging_folder
+
+        ep = task["episode"]
+        job = DownloadJob(0, "", task["config"])
+        downloader = AnimeDownloader(config=task["config"])
+        downloader.set_log_callback(job.add_log)
+        local_root = self.download_folder if self.shared_storage else get_staging_folder(self.download_folder)
+        filepath = os.path.join(local_root, *task["path"].split("/"))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        ok, error = False, None
+        try:
+            self.log(f"Task {task['task_id']}: episode {ep['id']} -> {task['path']}")
+            ok = resolve_and_download_episode(
+                job, downloader, ep, filepath, self.download_folder,
+                task["config"].get("prefer_type", "Soft Sub"), task["config"].get("prefer_server", "Server 1"),
+            )
+            if ok and not self.shared_storage:
+                with open(filepath, "rb") as f:
+                    self._request("PUT", f"/tasks/{task['task_id']}/file", data=f)
+        except Exception as e:
+            ok, error = False, str(e)
+        except cancellation.JobCancelled:
+            ok, error = False, "Task was withdrawn"
+        finally:
+            if not self.shared_storage:
+                discard_staged(filepath)
+        if not ok and error is None:
+            error = next((entry["message"] for entry in reversed(job.logs) if entry["level"] == "ERROR"), "Download failed")
+        try:
+            self._request("POST", f"/tasks/{task['task_id']}/complete", json={
+                "worker_id": self.worker_id, "ok": ok, "error": error,
+                "logs": [{"level": e["level"], "message": e["message"]} for e in job.logs if e["level"] != "INFO"],
+            })
+        except Exception as e:
+            self.log(f"Could not report task {task['task_id']}: {e}")
+        self.log(f"Task {task['task_id']}: {'done' if ok else 'failed: ' + error}")
+
+    def _task_thread(self, task: Dict[str, Any], token: cancellation.CancelToken):
+        try:
+            with cancellation.activate(token):
+                self._run_task(task)
+        finally:
+            with self._lock:
+                self._active.pop(task["task_id"], None)
+
+    def run(self, poll_seconds: float = 5):
+        """Lease and run tasks until stopped"""
+        from app.upstream import configure_upstream
+
+        configure_upstream(self.download_folder)
+        threading.Thread(target=self._heartbeat_loop, name="cluster-heartbeat", daemon=True).start()
+        self.log(f"Working for {self.coordinator_url} with {self.concurrency} slot(s)"
+                 f"{' on shared storage' if self.shared_storage else ''}")
+        while not self._stopping.is_set():
+            with self._lock:
+                free = self.concurrency - len(self._active)
+            tasks = []
+            if free > 0:
+                try:
+                    tasks = self._request("POST", "/lease", json={
+                        "worker_id": self.worker_id, "max_tasks": free,
+                        "host": socket.gethostname(), "slots": self.concurrency,
+                        "shared_storage": self.shared_storage,
+                    })["tasks"]
+                except Exception as e:
+                    self.log(f"Lease request failed: {e}")
+            for task in tasks:
+                token = cancellation.CancelToken(task["task_id"])
+                with self._lock:
+                    self._active[task["task_id"]] = token
+                threading.Thread(
+                    target=self._task_thread, args=(task, token), name=f"task-{task['task_id']}", daemon=True
+                ).start()
+            self._stopping.wait(0.5 if tasks else poll_seconds)
+
+    def stop(self):
+        self._stopping.set()
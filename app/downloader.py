@@ -3,28 +3,29 @@ AnimeKai Downloader Core Module
 Extracted from the Jupyter notebook for use in web applications
 """
 
-import requests
 import re
 import json
 import os
-import time
 import subprocess
+import collections
 from typing import List, Optional, Tuple, Dict, Any
-from bs4 import BeautifulSoup
-import cloudscraper
+from app import cancellation, tracing
+from app.bandwidth import bandwidth_manager
+from app.hls import DEFAULT_QUALITY_POLICY, choose_stream
+from app.parsing import get_parser
+from app.staging import write_preallocated
+from app.mirrors import mirror_pool
+from app.upstream import BASE_URL, get_session, user_agent
+from app.watchdog import STALL_MAX_RESTARTS, stall_watchdog
 from urllib.parse import urlparse
 import shutil
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class AnimeDownloader:
     def __init__(self, config: Dict[str, Any] = None):
-        self.BASE_URL = "https://anikai.to"
-        self.scraper = cloudscraper.create_scraper(
-            browser={"browser": "chrome", "platform": "windows", "desktop": True}
-        )
+        # Canonical site URLs; the upstream session routes them to the current mirror
+        self.BASE_URL = BASE_URL
+        # No User-Agent: the session's own one goes with its clearance cookies
         self.HEADERS = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
             "Referer": self.BASE_URL,
             "Accept": "*/*",
             "Accept-Language": "en-US,en;q=0.9",
@@ -39,12 +40,25 @@ class AnimeDownloader:
             "timeout": 300,
             "max_workers": 15,
             "chunk_size_mb": 15,
+            "priority": "normal",
+            "quality_policy": DEFAULT_QUALITY_POLICY,
         }
         if config:
             self.config.update(config)
         
         self.progress_callback = None
         self.log_callback = None
+        self.stall_callback = None
+
+    @property
+    def scraper(self):
+        """Shared upstream session of this process, created on first request"""
+        return get_session()
+
+    @property
+    def user_agent(self) -> str:
+        """User-Agent of the shared session, for tools making their own requests (yt-dlp)"""
+        return user_agent()
 
     def set_progress_callback(self, callback):
         """Set callback for progress updates"""
@@ -54,6 +68,10 @@ class AnimeDownloader:
         """Set callback for log messages"""
         self.log_callback = callback
 
+    def set_stall_callback(self, callback):
+        """Set callback receiving a dict for every stalled transfer (see app.watchdog)"""
+        self.stall_callback = callback
+
     def log(self, level: str, msg: str):
         """Log message"""
         message = f"[{level}] {msg}"
@@ -61,6 +79,7 @@ class AnimeDownloader:
         if self.log_callback:
             self.log_callback(level, msg)
 
+    @tracing.traced("downloader")
     def call_enc_dec_api(self, endpoint: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Call enc-dec.app API"""
         base = "https://enc-dec.app/api"
@@ -103,24 +122,15 @@ class AnimeDownloader:
             return None
         return data["result"]
 
+    @tracing.traced("downloader")
     def get_anime_details(self, url: str) -> Tuple[Optional[str], str]:
         """Get anime ID and title from URL"""
         try:
             r = self.scraper.get(url, headers=self.HEADERS, timeout=30)
             r.raise_for_status()
-            soup = BeautifulSoup(r.text, "html.parser")
-
-            anime_div = soup.select_one("div[data-id]")
-            anime_id = anime_div.get("data-id") if anime_div else None
-
-            title_elem = (
-                soup.select_one("div.title-wrapper h1.title span")
-                or soup.select_one("h1.title")
-                or soup.select_one(".anime-title")
-            )
-            title = title_elem.get("title") if title_elem and title_elem.get("title") else (
-                title_elem.text.strip() if title_elem else "Unknown"
-            )
+            anime_id, title = get_parser().anime_details(r.text)
+            if title is None:
+                title = "Unknown"
             title = re.sub(r'[<>:"/\\|?*]', "", title)
             return anime_id, title
         except Exception as e:
@@ -204,57 +214,58 @@ class AnimeDownloader:
             return main, frac
         return (10**9, 0.0)
 
+    @tracing.traced("downloader")
+    def episode_list_url(self, anime_id: str, enc: str) -> str:
+        """URL of the episode list, with anime_id encoded by enc_kai"""
+        return f"{self.BASE_URL}/ajax/episodes/list?ani_id={anime_id}&_={enc}"
+
     def get_episode_list(self, anime_id: str) -> List[Dict[str, Any]]:
         """Get list of available episodes"""
         try:
             enc = self.enc_kai(anime_id)
             if not enc:
                 return []
-            url = f"{self.BASE_URL}/ajax/episodes/list?ani_id={anime_id}&_={enc}"
-            r = self.scraper.get(url, headers=self.HEADERS, timeout=30)
+            r = self.scraper.get(self.episode_list_url(anime_id, enc), headers=self.HEADERS, timeout=30)
             r.raise_for_status()
             data = r.json()
             html = data.get("result", "")
             if not html:
                 return []
-
-            soup = BeautifulSoup(html, "html.parser")
-            episodes: List[Dict[str, Any]] = []
-            for ep in soup.select("div.eplist a"):
-                token = ep.get("token", "")
-                ep_id = ep.get("num", "").strip()
-                raw_title = (
-                    ep.get("title")
-                    or ep.get("data-title")
-                    or ep.get("data-name")
-                    or ep.get("data-ep-title")
-                    or " ".join(ep.stripped_strings)
-                )
-                langs = ep.get("langs", "0")
-                try:
-                    langs_int = int(langs)
-                except ValueError:
-                    langs_int = 0
-                if langs_int == 1:
-                    subdub = "Sub"
-                elif langs_int == 3:
-                    subdub = "Dub & Sub"
-                else:
-                    subdub = ""
-
-                episodes.append({
-                    "id": ep_id,
-                    "sort_key": self.safe_episode_key(ep_id),
-                    "token": token,
-                    "subdub": subdub,
-                    "title": self.clean_episode_title(ep_id, raw_title),
-                })
-            episodes.sort(key=lambda e: e["sort_key"])
-            return episodes
+            return self.parse_episode_list(html)
         except Exception as e:
             self.log("ERROR", f"Error getting episodes: {e}")
             return []
 
+    def parse_episode_list(self, html: str) -> List[Dict[str, Any]]:
+        """Episodes of an episode list response, sorted by number"""
+        episodes: List[Dict[str, Any]] = []
+        for ep in get_parser().episodes(html):
+            token = ep["token"]
+            ep_id = ep["num"].strip()
+            raw_title = ep["title"]
+            langs = ep["langs"]
+            try:
+                langs_int = int(langs)
+            except ValueError:
+                langs_int = 0
+            if langs_int == 1:
+                subdub = "Sub"
+            elif langs_int == 3:
+                subdub = "Dub & Sub"
+            else:
+                subdub = ""
+
+            episodes.append({
+                "id": ep_id,
+                "sort_key": self.safe_episode_key(ep_id),
+                "token": token,
+                "subdub": subdub,
+                "title": self.clean_episode_title(ep_id, raw_title),
+            })
+        episodes.sort(key=lambda e: e["sort_key"])
+        return episodes
+
+    @tracing.traced("downloader")
     def get_video_servers(self, token: str) -> List[Dict[str, str]]:
         """Get available video servers for episode"""
         try:
@@ -268,18 +279,7 @@ class AnimeDownloader:
             html = data.get("result", "")
             if not html:
                 return []
-            soup = BeautifulSoup(html, "html.parser")
-            servers: List[Dict[str, str]] = []
-            for type_div in soup.select("div.server-items[data-id]"):
-                type_id = type_div.get("data-id", "")
-                for server in type_div.select("span.server[data-lid]"):
-                    server_id = server.get("data-lid", "")
-                    server_name = server.text.strip()
-                    servers.append({
-                        "type": type_id,
-                        "server_id": server_id,
-                        "server_name": server_name
-                    })
+            servers: List[Dict[str, str]] = get_parser().servers(html)
             return servers
         except Exception as e:
             self.log("ERROR", f"Error getting servers: {e}")
@@ -315,6 +315,7 @@ class AnimeDownloader:
         # Return first available
         return servers[0] if servers else None
 
+    @tracing.traced("downloader")
     def get_video_data(self, server_id: str) -> Optional[Dict[str, Any]]:
         """Get video URL and subtitle tracks"""
         try:
@@ -346,7 +347,7 @@ class AnimeDownloader:
             if not mega_token:
                 return None
 
-            mega = self.dec_mega(mega_token, self.HEADERS["User-Agent"])
+            mega = self.dec_mega(mega_token, self.user_agent)
             if not mega:
                 return None
 
@@ -366,14 +367,36 @@ class AnimeDownloader:
                         "lang": track.get("label", "Unknown")
                     })
 
-            return {
+            video_data = {
                 "video_url": video_url,
-                "subtitles": subtitle_tracks
+                "subtitles": subtitle_tracks,
+                "format": None,
             }
+            if ".m3u8" in urlparse(video_url).path:
+                self.apply_quality_policy(video_data)
+            return video_data
         except Exception as e:
             self.log("ERROR", f"Error getting video data: {e}")
             return None
 
+    def apply_quality_policy(self, video_data: Dict[str, Any]):
+        """Point video_data at the HLS variant chosen by the quality policy, logging it and its expected size"""
+        policy = self.config["quality_policy"] or "best"
+        try:
+            stream = choose_stream(self.scraper, video_data["video_url"], self.HEADERS, policy)
+        except Exception as e:
+            self.log("WARN", f"Could not read HLS variants, letting yt-dlp choose: {e}")
+            return
+        if stream["variant"] is None:
+            return
+        expected = stream["expected_bytes"]
+        self.log(
+            "INFO",
+            f"Quality '{policy}': {stream['variant'].describe()} of {stream['variants']} variant(s), "
+            f"expected size {f'~{expected / (1024 * 1024):.0f} MB' if expected else 'unknown'}",
+        )
+        video_data.update(video_url=stream["url"], format=stream["format"], expected_bytes=expected)
+
     def generate_episode_filename(self, anime_title: str, season_num: int, ep_id: str, episode_title: str) -> str:
         """Generate a Jellyfin/Plex-friendly episode filename."""
         series_name = self.generate_anime_folder_name(anime_title)
@@ -385,6 +408,20 @@ class AnimeDownloader:
         )
         return f"{series_name} - S{season_code}E{episode_code} - {safe_episode_title}.mp4"
 
+    def find_existing_episodes(self, season_dir: str, season_num: int) -> Dict[str, str]:
+        """Map episode codes to episode files already present in a season folder."""
+        if not os.path.isdir(season_dir):
+            return {}
+        pattern = re.compile(
+            rf" - S{re.escape(self.format_season_number(season_num))}E(\d+(?:\.\d+)?) - .+\.mp4$"
+        )
+        existing = {}
+        for name in sorted(os.listdir(season_dir)):
+            m = pattern.search(name)
+            if m and not name.endswith("_temp.mp4"):
+                existing[m.group(1)] = os.path.join(season_dir, name)
+        return existing
+
     def generate_merged_filename(
         self,
         anime_title: str,
@@ -399,8 +436,63 @@ class AnimeDownloader:
         last_code = self.format_episode_number(last_ep_id)
         return f"{series_name} - S{season_code}E{first_code}-E{last_code} - Episodes {first_code}-{last_code}.mp4"
 
-    def download_with_ytdlp(self, url: str, output_file: str, episode_label: str, subtitles: List[Dict] = None) -> bool:
-        """Download with yt-dlp, optionally embedding subtitles"""
+    def run_ytdlp(self, cmd: List[str], episode_label: str) -> bool:
+        """
+        Run a yt-dlp command under the global bandwidth budget. A transfer stopped by
+        the stall watchdog is restarted (resuming its .part files) up to STALL_MAX_RESTARTS times.
+        """
+        for restart in range(STALL_MAX_RESTARTS + 1):
+            ok, stall = self.run_ytdlp_once(cmd, episode_label)
+            if not stall:
+                return ok
+            stall["restart"] = restart + 1
+            stall["action"] = "restarted" if restart < STALL_MAX_RESTARTS else "gave up"
+            if self.stall_callback:
+                self.stall_callback(stall)
+            if restart < STALL_MAX_RESTARTS:
+                self.log("WARN", f"⏳ Episode {episode_label} stalled at {stall['rate_kbps']} KB/s for "
+                                 f"{stall['window_seconds']}s, resuming the transfer ({restart + 1}/{STALL_MAX_RESTARTS})")
+        self.log("ERROR", f"Episode {episode_label} kept stalling, giving up this attempt")
+        return False
+
+    def run_ytdlp_once(self, cmd: List[str], episode_label: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Run yt-dlp once; returns whether it succeeded and the stall that stopped it, if any"""
+        with tracing.span("yt-dlp", "subprocess") as span:
+            # Own process group so the bandwidth manager can pause yt-dlp and its fragment
+            # downloads, and cancelling the job stops all of them
+            process = cancellation.start_process(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+            )
+            transfer = bandwidth_manager.register(process, self.config["priority"], f"Episode {episode_label}")
+            watch = stall_watchdog.watch(transfer, episode_label)
+            tail = collections.deque(maxlen=5)
+            try:
+                for line in process.stdout:
+                    if line.startswith("bw "):
+                        downloaded = line[3:].strip()
+                        if downloaded.isdigit():
+                            transfer.update(int(downloaded))
+                    elif line.strip():
+                        tail.append(line.strip())
+                process.wait()
+            finally:
+                stall_watchdog.unwatch(watch)
+                bandwidth_manager.unregister(transfer)
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                cancellation.finish_process(process)
+            span.update(exit_code=process.returncode, bytes=transfer.bytes, stalled=bool(watch.stall))
+        cancellation.check()
+        if watch.stall:
+            return False, watch.stall
+        if process.returncode != 0 and tail:
+            self.log("WARN", f"yt-dlp: {tail[-1]}")
+        return process.returncode == 0, None
+
+    def download_with_ytdlp(self, url: str, output_file: str, episode_label: str, subtitles: List[Dict] = None,
+                            video_format: str = None) -> bool:
+        """Download with yt-dlp, optionally embedding subtitles and choosing the format"""
         try:
             self.log("INFO", f"Downloading episode {episode_label} with yt-dlp")
 
@@ -414,10 +506,14 @@ class AnimeDownloader:
                 "--retries", str(self.config["max_retries"]),
                 "--fragment-retries", str(self.config["max_retries"]),
                 "--socket-timeout", str(self.config["timeout"]),
-                "--user-agent", self.HEADERS["User-Agent"],
-                "--referer", self.BASE_URL,
+                "--user-agent", self.user_agent,
+                "--referer", mirror_pool.current().base_url,
                 "--newline",
+                "--continue",
+                "--progress-template", "download:bw %(progress.downloaded_bytes)s",
             ]
+            if video_format:
+                cmd.extend(["-f", video_format])
 
             if subtitles:
                 self.log("INFO", f"Found {len(subtitles)} subtitle track(s)")
@@ -426,8 +522,7 @@ class AnimeDownloader:
                 cmd_copy[cmd_copy.index("-o") + 1] = temp_video
 
                 # Download video
-                result = subprocess.run(cmd_copy, capture_output=True, text=True)
-                if result.returncode != 0 or not os.path.exists(temp_video):
+                if not self.run_ytdlp(cmd_copy, episode_label) or not os.path.exists(temp_video):
                     self.log("ERROR", "Video download failed")
                     return False
 
@@ -438,8 +533,7 @@ class AnimeDownloader:
                     try:
                         r = self.scraper.get(sub['url'], headers=self.HEADERS, timeout=30)
                         r.raise_for_status()
-                        with open(sub_path, 'wb') as f:
-                            f.write(r.content)
+                        write_preallocated(sub_path, r.content)
                         sub_files.append((sub_path, sub['lang']))
                     except Exception as e:
                         self.log("WARN", f"Failed to download subtitle {sub['lang']}: {e}")
@@ -463,7 +557,8 @@ class AnimeDownloader:
                         "-y",
                         output_file
                     ])
-                    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
+                    with tracing.span("ffmpeg subtitles", "subprocess", tracks=len(sub_files)):
+                        result = cancellation.run_process(ffmpeg_cmd)
                     
                     # Cleanup
                     try:
@@ -483,15 +578,15 @@ class AnimeDownloader:
                     shutil.move(temp_video, output_file)
                     return True
             else:
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                return result.returncode == 0 and os.path.exists(output_file)
+                return self.run_ytdlp(cmd, episode_label) and os.path.exists(output_file)
 
         except Exception as e:
             self.log("ERROR", f"yt-dlp error: {e}")
             return False
 
+    @tracing.traced("downloader")
     def download_episode(self, video_data: Dict[str, Any], output_file: str, episode_label: str) -> bool:
-        """Download a single episode"""
+        """Download a single episode, noting the attempts it took in video_data["attempts"]"""
         url = video_data["video_url"]
         subtitles = video_data.get("subtitles", [])
 
@@ -501,17 +596,20 @@ class AnimeDownloader:
             if attempt > 1:
                 self.log("INFO", f"Retry {attempt}/{self.config['max_retries']} for episode {episode_label}")
             
-            if self.download_with_ytdlp(url, output_file, episode_label, subtitles):
-                self.log("INFO", f"✅ Successfully downloaded episode {episode_label}")
-                return True
-            
-            time.sleep(self.config["sleep_between"])
+            with tracing.context(attempt=attempt):
+                if self.download_with_ytdlp(url, output_file, episode_label, subtitles, video_data.get("format")):
+                    self.log("INFO", f"✅ Successfully downloaded episode {episode_label}")
+                    video_data["attempts"] = attempt
+                    return True
+                with tracing.span("retry sleep", "sleep", seconds=self.config["sleep_between"]):
+                    cancellation.sleep(self.config["sleep_between"])
         
         return False
 
+    @tracing.traced("downloader")
     def merge_videos(self, file_list: List[str], anime_title: str, season_num: int, 
-                    first_ep_id: str, last_ep_id: str) -> Optional[str]:
-        """Merge multiple video files into one"""
+                    first_ep_id: str, last_ep_id: str, work_dir: str = None) -> Optional[str]:
+        """Merge multiple video files into one, written to work_dir (default: next to the inputs)"""
         if not file_list:
             self.log("ERROR", "No files to merge")
             return None
@@ -527,11 +625,14 @@ class AnimeDownloader:
             first_ep_id,
             last_ep_id,
         )
-        merged_path = os.path.join(os.path.dirname(file_list[0]), merged_filename)
+        work_dir = work_dir or os.path.dirname(file_list[0])
+        merged_path = os.path.join(work_dir, merged_filename)
 
         self.log("INFO", f"Merging {len(valid_files)} files into {merged_filename}")
 
-        list_file = os.path.join(os.path.dirname(file_list[0]), "filelist_merge.txt")
+        # Named after the output: work_dir may be a staging folder shared by concurrent jobs
+        list_file = f"{merged_path}.filelist.txt"
+        merged = False
         try:
             with open(list_file, "w", encoding="utf-8") as f:
                 for vf in valid_files:
@@ -550,12 +651,14 @@ class AnimeDownloader:
                 merged_path,
             ]
             
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            with tracing.span("ffmpeg concat", "subprocess", files=len(valid_files)):
+                result = cancellation.run_process(cmd)
 
             if result.returncode != 0 or not os.path.exists(merged_path):
                 self.log("ERROR", "ffmpeg merge failed")
                 return None
 
+            merged = True
             self.log("INFO", f"✅ Successfully merged: {merged_filename}")
             return merged_path
         except Exception as e:
@@ -565,5 +668,8 @@ class AnimeDownloader:
             try:
                 if os.path.exists(list_file):
                     os.remove(list_file)
+                # Don't leave a partial merge behind after a failure or cancellation
+                if not merged and os.path.exists(merged_path):
+                    os.remove(merged_path)
             except Exception:
                 pass
@@ -0,0 +1,151 @@
+"""
+HLS Variant Selection
+Reads the variants of an HLS master playlist and picks one according to a job's
+quality policy, so a lower resolution can be downloaded deliberately instead of
+yt-dlp's default of the best variant.
+
+A policy is a comma-separated list of rules:
+    best                    highest bitrate (the default)
+    max_height=720          best variant at most 720 pixels high
+    max_bitrate=2500        best variant at most 2500 kbit/s
+    smallest_above=480      lowest bitrate variant at least 480 pixels high
+e.g. "max_height=1080,max_bitrate=4000". When no variant satisfies the limits
+the smallest variant is used.
+"""
+import os
+import re
+from typing import Any, Dict, List, Optional
+from urllib.parse import urljoin
+
+# Policy used by jobs that don't set one
+DEFAULT_QUALITY_POLICY = os.environ.get("QUALITY_POLICY", "best")
+
+POLICY_RULES = ("max_height", "max_bitrate", "smallest_above")
+
+# Choices offered in the download form: policy -> label
+QUALITY_PRESETS = {
+    "best": "Best available",
+    "max_height=1080": "Up to 1080p",
+    "max_height=720": "Up to 720p",
+    "max_height=480": "Up to 480p",
+    "smallest_above=720": "Smallest at 720p or more",
+    "smallest_above=480": "Smallest at 480p or more",
+}
+
+_ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class Variant:
+    """One stream of a master playlist"""
+    def __init__(self, url: str, bandwidth: int, width: Optional[int] = None,
+                 height: Optional[int] = None, audio_group: Optional[str] = None):
+        self.url = url
+        self.bandwidth = bandwidth
+        self.width = width
+        self.height = height
+        self.audio_group = audio_group
+
+    def describe(self) -> str:
+        resolution = f"{self.width}x{self.height}" if self.height else "unknown resolution"
+        return f"{resolution} @ {self.bandwidth / 1_000_000:.2f} Mbit/s"
+
+
+def parse_quality_policy(spec: Optional[str]) -> Dict[str, int]:
+    """Parse a policy string into {rule: value}; raises ValueError if it is invalid"""
+    policy = {}
+    for item in filter(None, (part.strip() for part in (spec or "best").split(","))):
+        if item == "best":
+            continue
+        rule, _, value = item.partition("=")
+        rule = rule.strip()
+        if rule not in POLICY_RULES:
+            raise ValueError(f"Unknown quality rule '{rule}' (use {', '.join(POLICY_RULES)} or best)")
+        try:
+            policy[rule] = int(value.strip().lower().rstrip("pk"))
+        except ValueError:
+            raise ValueError(f"Quality rule '{rule}' needs a number, got '{value}'")
+    return policy
+
+
+def parse_master_playlist(text: str, base_url: str) -> List[Variant]:
+    """Variants of a master playlist (empty for a media playlist)"""
+    variants = []
+    attributes = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attributes = {k: v.strip('"') for k, v in _ATTRIBUTE_RE.findall(line.split(":", 1)[1])}
+        elif line and not line.startswith("#") and attributes is not None:
+            width = height = None
+            if "x" in attributes.get("RESOLUTION", ""):
+                width, height = (int(n) for n in attributes["RESOLUTION"].split("x", 1))
+            bandwidth = int(attributes.get("AVERAGE-BANDWIDTH") or attributes.get("BANDWIDTH") or 0)
+            variants.append(Variant(urljoin(base_url, line), bandwidth, width, height, attributes.get("AUDIO")))
+            attributes = None
+    return variants
+
+
+def playlist_duration(text: str) -> float:
+    """Total segment duration of a media playlist in seconds"""
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith("#EXTINF:"):
+            try:
+                total += float(line[len("#EXTINF:"):].split(",", 1)[0])
+            except ValueError:
+                continue
+    return total
+
+
+def select_variant(variants: List[Variant], policy: Dict[str, int]) -> Optional[Variant]:
+    """Pick the variant a policy asks for; the smallest one if none satisfies it"""
+    if not variants:
+        return None
+    by_bandwidth = sorted(variants, key=lambda v: v.bandwidth)
+    allowed = [
+        v for v in by_bandwidth
+        if (not policy.get("max_height") or (v.height or 0) <= policy["max_height"])
+        and (not policy.get("max_bitrate") or v.bandwidth <= policy["max_bitrate"] * 1000)
+        and (not policy.get("smallest_above") or (v.height or 0) >= policy["smallest_above"])
+    ]
+    if not allowed:
+        return by_bandwidth[0]
+    return allowed[0] if policy.get("smallest_above") else allowed[-1]
+
+
+def describe_policy(policy: Dict[str, int]) -> str:
+    return ",".join(f"{rule}={value}" for rule, value in policy.items()) or "best"
+
+
+def ytdlp_format(variant: Variant) -> str:
+    """yt-dlp format selector for a variant whose audio is a separate rendition"""
+    return f"bv*[tbr<={variant.bandwidth / 1000 + 1:.0f}]+ba/b[tbr<={variant.bandwidth / 1000 + 1:.0f}]"
+
+
+def choose_stream(session, master_url: str, headers: Dict[str, str], policy_spec: Optional[str]) -> Dict[str, Any]:
+    """
+    Resolve a master playlist URL for a quality policy. Returns the URL (and,
+    for separate audio renditions, the yt-dlp format) to download, the chosen
+    variant, the number of variants and the expected size in bytes (None if unknown).
+    """
+    policy = parse_quality_policy(policy_spec)
+    result: Dict[str, Any] = {"url": master_url, "format": None, "variant": None, "variants": 0, "expected_bytes": None}
+    response = session.get(master_url, headers=headers, timeout=30)
+    response.raise_for_status()
+    variants = parse_master_playlist(response.text, master_url)
+    if not variants:
+        return result
+
+    variant = select_variant(variants, policy)
+    result.update(variant=variant, variants=len(variants))
+    if variant.audio_group:
+        result["format"] = ytdlp_format(variant)
+    else:
+        result["url"] = variant.url
+
+    media = session.get(variant.url, headers=headers, timeout=30)
+    media.raise_for_status()
+    duration = playlist_duration(media.text)
+    if duration and variant.bandwidth:
+        result["expected_bytes"] = int(duration * variant.bandwidth / 8)
+    return result
@@ -0,0 +1,94 @@
+"""
+Startup Import Timing
+In-process equivalent of `python -X importtime`: times every module executed
+while the timer is active (self and cumulative time, like -X importtime) so the
+startup banner can show where cold-start time goes.
+"""
+import sys
+import time
+from importlib.abc import MetaPathFinder
+from typing import Dict, List, Optional, Tuple
+
+
+class _TimedLoader:
+    """Wraps a module loader to time exec_module"""
+    def __init__(self, loader, timer: "ImportTimer"):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer._enter()
+        started = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer._exit(module.__name__, time.perf_counter() - started)
+
+
+class ImportTimer(MetaPathFinder):
+    """Context manager recording the import time of modules loaded inside it"""
+    def __init__(self):
+        self.timings: Dict[str, Tuple[float, float]] = {}  # module -> (self, cumulative) seconds
+        self.total_seconds = 0.0
+        self._child_time: List[float] = []
+        self._started = 0.0
+
+    def find_spec(self, fullname, path, target=None):
+        # Ask the remaining finders, then wrap whatever loader they return
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def _enter(self):
+        self._child_time.append(0.0)
+
+    def _exit(self, name: str, elapsed: float):
+        children = self._child_time.pop()
+        self.timings[name] = (elapsed - children, elapsed)
+        if self._child_time:
+            self._child_time[-1] += elapsed
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *exc):
+        sys.meta_path.remove(self)
+        self.total_seconds = time.perf_counter() - self._started
+        return False
+
+    def slowest(self, count: int = 8) -> List[Tuple[str, float, float]]:
+        """Top-level packages by cumulative import time: (name, self, cumulative)"""
+        top: Dict[str, Tuple[float, float]] = {}
+        for name, (self_time, cumulative) in self.timings.items():
+            root = name.split(".", 1)[0]
+            own, cum = top.get(root, (0.0, 0.0))
+            # A package's cumulative time already includes its submodules
+            top[root] = (own + self_time, cum if name != root else cumulative)
+        ranked = sorted(top.items(), key=lambda item: max(item[1][1], item[1][0]), reverse=True)
+        return [(name, own, max(cum, own)) for name, (own, cum) in ranked[:count]]
+
+    def report(self, count: int = 8, deferred: Optional[List[str]] = None) -> List[str]:
+        """Banner lines: total startup time, slowest imports and heavy modules not loaded yet"""
+        lines = [f"Startup: {self.total_seconds * 1000:.0f} ms ({len(self.timings)} modules imported)"]
+        lines.append(f"   {'self [ms]':>10} | {'cumulative':>10} | package")
+        for name, own, cumulative in self.slowest(count):
+            lines.append(f"   {own * 1000:>10.1f} | {cumulative * 1000:>10.1f} | {name}")
+        if deferred:
+            not_loaded = [name for name in deferred if name not in sys.modules]
+            if not_loaded:
+                lines.append(f"   Deferred until first use: {', '.join(not_loaded)}")
+        return lines
@@ -0,0 +1,179 @@
+"""
+In-flight Episode Registry
+Tracks episode output files that are currently being produced so that
+overlapping jobs share one download instead of racing on the same file.
+Jobs in the same process attach directly; other processes see a hidden
+marker file next to the target.
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple, Any
+
+# How often a job following another process's episode checks its marker file
+MARKER_POLL_SECONDS = 1
+
+
+class InflightEpisode:
+    """An episode output currently owned by a single download job"""
+    def __init__(self, key: str, owner_job_id: int, episode_id: str, marker_path: str = None):
+        self.key = key
+        self.marker_path = marker_path
+        self.owner_job_id = owner_job_id
+        self.episode_id = episode_id
+        self.status = "resolving"
+        self.attached_jobs: List[int] = []
+        self.success = False
+        self._done = threading.Event()
+
+    def set_status(self, status: str):
+        """Update the shared status seen by attached jobs"""
+        self.status = status
+
+    def finish(self, success: bool):
+        """Publish the final result to every attached job"""
+        self.success = success
+        self.status = "completed" if success else "failed"
+        self._done.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait for the owner to finish, returns True once the result is known"""
+        return self._done.wait(timeout)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "path": self.key,
+            "episode_id": self.episode_id,
+            "owner_job_id": self.owner_job_id,
+            "attached_jobs": list(self.attached_jobs),
+            "status": self.status,
+        }
+
+
+class RemoteInflightEpisode(InflightEpisode):
+    """An episode output owned by a job in another process, followed through its marker file"""
+    def __init__(self, key: str, owner_job_id: int, episode_id: str, marker_path: str, owner_pid: int):
+        super().__init__(key, owner_job_id, episode_id, marker_path)
+        self.owner_pid = owner_pid
+        self.status = "downloading"
+
+    def wait(self, timeout: float = None) -> bool:
+        deadline = time.time() + timeout if timeout is not None else None
+        while os.path.exists(self.marker_path) and pid_alive(self.owner_pid):
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(MARKER_POLL_SECONDS)
+        self.finish(os.path.exists(self.key))
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = super().to_dict()
+        data["owner_pid"] = self.owner_pid
+        return data
+
+
+def pid_alive(pid: int) -> bool:
+    """Whether a process with this pid still exists"""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class InflightRegistry:
+    """Registry of in-flight episode outputs keyed by target file path"""
+    def __init__(self):
+        self._entries: Dict[str, InflightEpisode] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(filepath: str) -> str:
+        """Normalize a target path so equivalent paths map to the same entry"""
+        return os.path.normcase(os.path.abspath(filepath))
+
+    @staticmethod
+    def marker_path(filepath: str) -> str:
+        """Hidden marker next to the target, so library scans skip it"""
+        folder, name = os.path.split(os.path.abspath(filepath))
+        return os.path.join(folder, f".{name}.inflight")
+
+    def _create_marker(self, marker_path: str, job_id: int):
+        """
+        Atomically create the marker file for a new owner.
+        Returns None on success, or the (pid, job_id) of a live owner in another process.
+        """
+        for _ in range(2):
+            try:
+                fd = os.open(marker_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileNotFoundError:
+                # Target folder does not exist yet, nobody else can be writing there
+                return None
+            except FileExistsError:
+                try:
+                    with open(marker_path, "r", encoding="utf-8") as f:
+                        owner = json.load(f)
+                except (OSError, ValueError):
+                    owner = {}
+                if pid_alive(owner.get("pid")):
+                    return owner.get("pid"), owner.get("job_id")
+                # Left behind by a crashed process
+                try:
+                    os.remove(marker_path)
+                except OSError:
+                    pass
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "job_id": job_id}, f)
+            return None
+        return None
+
+    def claim(self, filepath: str, job_id: int, episode_id: str) -> Tuple[InflightEpisode, bool]:
+        """
+        Claim an episode output for a job.
+        Returns the entry and whether the caller became its owner.
+        """
+        key = self.make_key(filepath)
+        marker_path = self.marker_path(filepath)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if job_id not in entry.attached_jobs:
+                    entry.attached_jobs.append(job_id)
+                return entry, False
+            owner = self._create_marker(marker_path, job_id)
+            if owner:
+                owner_pid, owner_job_id = owner
+                remote = RemoteInflightEpisode(key, owner_job_id, episode_id, marker_path, owner_pid)
+                remote.attached_jobs.append(job_id)
+                return remote, False
+            entry = InflightEpisode(key, job_id, episode_id, marker_path)
+            self._entries[key] = entry
+            return entry, True
+
+    def release(self, entry: InflightEpisode, success: bool):
+        """Remove an owned entry and wake up all attached jobs"""
+        with self._lock:
+            if self._entries.get(entry.key) is entry:
+                del self._entries[entry.key]
+                try:
+                    os.remove(entry.marker_path)
+                except OSError:
+                    pass
+        entry.finish(success)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Return the current in-flight episodes"""
+        with self._lock:
+            return [entry.to_dict() for entry in self._entries.values()]
+
+
+# Process-wide registry shared by all download jobs
+inflight_episodes = InflightRegistry()
@@ -0,0 +1,520 @@
+"""
+Download Job Execution
+Runs a download job end to end: resolution, episode downloads and merging.
+Independent of Flask so it can run in worker processes.
+"""
+import os
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+from app.downloader import AnimeDownloader
+from app.models import DownloadJob
+from app.inflight import InflightEpisode, inflight_episodes
+from app.probe import get_probe_cache, verify_media_file
+from app.staging import get_staging_folder, staging_path, publish_file, discard_staged
+from app.transcode import DEFAULT_PROFILE, PROFILES, get_transcode_queue
+from app.library_index import get_library_index
+from app.catalog import canonical_url, get_catalog
+from app.bandwidth import PRIORITY_WEIGHTS
+from app.hls import DEFAULT_QUALITY_POLICY, parse_quality_policy
+from app.stats import get_download_stats
+from app.utils import get_app_data_folder
+from app import cancellation, cluster, tracing
+
+# Stall events kept per job
+MAX_STALL_EVENTS = 50
+
+# How often an attached job reports the status of a shared episode
+SHARED_EPISODE_POLL_SECONDS = 5
+
+def build_job_config(data):
+    """Build a job configuration from request data, filling in defaults"""
+    return {
+        "download_mode": data.get("download_mode", "All Episodes"),
+        "single_episode": data.get("single_episode", "1"),
+        "start_episode": data.get("start_episode", "1"),
+        "end_episode": data.get("end_episode", "1"),
+        "episode_ids": data.get("episode_ids", []),
+        "prefer_type": data.get("prefer_type", "Soft Sub"),
+        "prefer_server": data.get("prefer_server", "Server 1"),
+        "download_method": data.get("download_method", "yt-dlp"),
+        "max_retries": data.get("max_retries", 7),
+        "timeout": data.get("timeout", 300),
+        "max_workers": data.get("max_workers", 15),
+        "merge_episodes": data.get("merge_episodes", False),
+        "season_number": data.get("season_number", 0),
+        "keep_individual_files": data.get("keep_individual_files", False),
+        "sync_mode": data.get("sync_mode", False),
+        "transcode_profile": data.get("transcode_profile") or None,
+        "priority": data.get("priority", "normal"),
+        "quality_policy": data.get("quality_policy") or DEFAULT_QUALITY_POLICY,
+    }
+
+def job_config_error(data):
+    """Describe the first invalid option in job request data, or None if it is valid"""
+    transcode_profile = data.get("transcode_profile")
+    if transcode_profile and transcode_profile not in PROFILES:
+        return f"Unknown transcode profile: {transcode_profile}"
+    if data.get("priority", "normal") not in PRIORITY_WEIGHTS:
+        return f"Unknown priority: {data.get('priority')}"
+    try:
+        parse_quality_policy(data.get("quality_policy"))
+    except ValueError as e:
+        return str(e)
+    return None
+
+def resolve_and_download_episode(job: DownloadJob, downloader: AnimeDownloader, ep, filepath,
+                                 download_folder, prefer_type, prefer_server,
+                                 entry: InflightEpisode = None):
+    """
+    Resolve the video source of an episode, download it into the staging area,
+    verify it and publish it to filepath
+    """
+    ep_id = ep["id"]
+    started = time.time()
+
+    # Get servers
+    cancellation.check()
+    servers = downloader.get_video_servers(ep["token"])
+    if not servers:
+        job.add_log("ERROR", f"No servers available for episode {ep_id}")
+        return False
+
+    # Choose server
+    server = downloader.choose_server(servers, prefer_type, prefer_server)
+    if not server:
+        job.add_log("ERROR", f"Could not choose server for episode {ep_id}")
+        return False
+
+    job.add_log("INFO", f"Using server: {server['server_name']}")
+
+    # Get video data
+    cancellation.check()
+    video_data = downloader.get_video_data(server["server_id"])
+    if not video_data:
+        job.add_log("ERROR", f"Could not resolve video data for episode {ep_id}")
+        return False
+
+    if entry:
+        entry.set_status("downloading")
+    staged = staging_path(download_folder, filepath)
+    try:
+        download_started = time.time()
+        if not downloader.download_episode(video_data, staged, ep_id):
+            return False
+        download_seconds = time.time() - download_started
+
+        if entry:
+            entry.set_status("verifying")
+        probe_cache = get_probe_cache(download_folder)
+        with tracing.span("verify", "subprocess"):
+            ok, reason = verify_media_file(staged, probe_cache)
+        if not ok:
+            job.add_log("ERROR", f"Episode {ep_id} failed verification: {reason}")
+            return False
+
+        with tracing.span("publish", "io"):
+            publish_file(staged, filepath)
+        probe_cache.move(staged, filepath)
+        record_episode_stats(job, ep_id, server, video_data, filepath, download_folder,
+                             time.time() - started, download_seconds)
+        return True
+    finally:
+        discard_staged(staged)
+
+def record_episode_stats(job: DownloadJob, ep_id, server, video_data, filepath, download_folder,
+                         seconds, download_seconds):
+    """Add a downloaded episode to the download statistics used for ETAs"""
+    try:
+        get_download_stats(download_folder).record_episode(
+            canonical_url(job.anime_url), ep_id, server["server_name"],
+            urlparse(video_data["video_url"]).hostname or "", os.path.getsize(filepath),
+            seconds, download_seconds, video_data.get("attempts", 1) - 1,
+        )
+    except OSError as e:
+        job.add_log("WARN", f"Could not record download stats: {e}")
+
+def update_eta(job: DownloadJob, remaining, download_folder):
+    """Estimate the seconds left for the remaining episodes from recent comparable downloads"""
+    per_episode = get_download_stats(download_folder).estimate_episode_seconds(
+        canonical_url(job.anime_url), job.config.get("prefer_server", "Server 1")
+    )
+    job.eta_seconds = int(per_episode * remaining) if per_episode is not None and remaining else None
+    job.publish()
+
+def wait_for_shared_episode(job: DownloadJob, entry: InflightEpisode):
+    """Follow an episode owned by another job and return its result"""
+    job.add_log("INFO", f"Episode {entry.episode_id} is already being downloaded by job #{entry.owner_job_id}, attaching to it")
+    last_status = None
+    while not entry.wait(SHARED_EPISODE_POLL_SECONDS):
+        cancellation.check()
+        if entry.status != last_status:
+            last_status = entry.status
+            job.add_log("INFO", f"Shared episode {entry.episode_id}: {last_status} (job #{entry.owner_job_id})")
+    return entry.success
+
+def download_episode_shared(job: DownloadJob, downloader: AnimeDownloader, ep, filepath,
+                            download_folder, prefer_type, prefer_server):
+    """
+    Download an episode unless another job is already producing the same file.
+    An attached job shares the owner's result and retries on its own if the owner fails.
+    """
+    for _ in range(2):
+        entry, is_owner = inflight_episodes.claim(filepath, job.job_id, ep["id"])
+        if not is_owner:
+            with tracing.span("shared episode", "wait", owner_job_id=entry.owner_job_id):
+                shared_ok = wait_for_shared_episode(job, entry)
+            if shared_ok:
+                return True
+            job.add_log("WARN", f"Job #{entry.owner_job_id} failed episode {ep['id']}, trying it here")
+            continue
+
+        success = False
+        try:
+            success = resolve_and_download_episode(
+                job, downloader, ep, filepath, download_folder, prefer_type, prefer_server, entry
+            )
+            return success
+        finally:
+            inflight_episodes.release(entry, success)
+    return False
+
+def download_episodes_locally(job: DownloadJob, downloader: AnimeDownloader, items, download_folder,
+                              prefer_type, prefer_server):
+    """Download (episode, filepath) items one by one in this process, yielding (episode, filepath, success)"""
+    for idx, (ep, filepath) in enumerate(items, 1):
+        cancellation.check()
+        ep_id = ep["id"]
+        job.current_episode = ep_id
+        job.add_log("INFO", f"Processing episode {ep_id} ({idx}/{len(items)})")
+
+        # Download episode, sharing it with any job already producing the same file
+        with tracing.context(episode=ep_id), tracing.span(f"episode {ep_id}", "episode") as span:
+            span["ok"] = download_episode_shared(job, downloader, ep, filepath, download_folder,
+                                                 prefer_type, prefer_server)
+        yield ep, filepath, span["ok"]
+
+def sync_existing_episodes(job: DownloadJob, downloader: AnimeDownloader, selected, season_dir,
+                           download_folder, downloaded_files):
+    """
+    Match the selected episodes against files already in the season folder.
+    Intact files are counted as completed; returns the episodes still to download
+    and the ids of those whose existing file is corrupt.
+    """
+    existing = downloader.find_existing_episodes(season_dir, job.season)
+    probe_cache = get_probe_cache(download_folder)
+    pending = []
+    repair_ids = set()
+
+    # One cache write for the whole folder instead of one per file
+    try:
+        for ep in selected:
+            ep_id = ep["id"]
+            path = existing.get(downloader.format_episode_number(ep_id))
+            if not path:
+                pending.append(ep)
+                continue
+
+            ok, reason = verify_media_file(path, probe_cache, persist=False)
+            if ok:
+                downloaded_files.append(path)
+                job.skipped_episodes += 1
+                job.completed_episodes += 1
+                job.downloaded_files.append(os.path.relpath(path, download_folder))
+                continue
+
+            job.add_log("WARN", f"Episode {ep_id} is corrupt ({reason}), re-downloading")
+            try:
+                os.remove(path)
+            except OSError as e:
+                job.add_log("WARN", f"Could not remove {os.path.relpath(path, download_folder)}: {e}")
+            repair_ids.add(ep_id)
+            pending.append(ep)
+    finally:
+        probe_cache.flush()
+
+    job.progress = int((job.completed_episodes / job.total_episodes) * 100)
+    return pending, repair_ids
+
+def start_transcode(job: DownloadJob, ep_id, filepath, profile, download_folder):
+    """Queue a downloaded episode for transcoding, reporting its progress in the job"""
+    def on_progress(percent):
+        # Replace rather than mutate: the dict may be serialized from another thread
+        job.transcode_progress = {**job.transcode_progress, ep_id: percent}
+        job.publish()
+
+    job.transcode_progress = {**job.transcode_progress, ep_id: 0}
+    return get_transcode_queue(download_folder).submit(
+        filepath, profile, on_progress, cancellation.current_token()
+    )
+
+def wait_for_transcodes(job: DownloadJob, transcodes):
+    """Wait for queued transcodes of a job and record their outcome"""
+    job.status = "transcoding"
+    job.add_log("INFO", f"Waiting for {len(transcodes)} transcode(s) to finish...")
+    for ep_id, future in transcodes:
+        cancellation.check()
+        try:
+            result = future.result()
+        except Exception as e:
+            job.add_log("ERROR", f"Transcode of episode {ep_id} crashed: {e}")
+            continue
+        if result.ok:
+            job.transcoded_episodes += 1
+            job.transcode_saved_bytes += result.saved_bytes
+            job.add_log("INFO", f"🎞️ Transcoded episode {ep_id}: {result.reason}")
+        else:
+            job.add_log("WARN", f"Transcode of episode {ep_id} failed, original kept: {result.reason}")
+
+def run_download_job(job: DownloadJob, download_folder, trace_folder=None, cancel_folder=None):
+    """
+    Execute the download job, recording its trace (see app.tracing) in trace_folder.
+    The job stops early once cancelled with app.cancellation.request_cancel(job_id, cancel_folder).
+    """
+    tracer = tracing.start_trace(
+        job.job_id, trace_folder or get_app_data_folder(download_folder, "traces"), anime_url=job.anime_url
+    )
+    cancel_folder = cancel_folder or get_app_data_folder(download_folder, "cancel")
+    token = cancellation.CancelToken(job.job_id, cancellation.marker_path(cancel_folder, job.job_id))
+    try:
+        with cancellation.activate(token), tracing.activate(tracer):
+            with tracing.span("job", "job", anime_url=job.anime_url):
+                execute_download_job(job, download_folder)
+    finally:
+        cancellation.clear_cancel(job.job_id, cancel_folder)
+
+def execute_download_job(job: DownloadJob, download_folder):
+    """Execute the download job in a separate thread"""
+    transcodes = []
+    try:
+        # Cancelled while queued
+        cancellation.check()
+
+        # Initialize downloader
+        downloader = AnimeDownloader(config={
+            "download_method": job.config.get("download_method", "yt-dlp"),
+            "max_retries": job.config.get("max_retries", 7),
+            "timeout": job.config.get("timeout", 300),
+            "max_workers": job.config.get("max_workers", 15),
+            "priority": job.config.get("priority", "normal"),
+            "quality_policy": job.config.get("quality_policy") or DEFAULT_QUALITY_POLICY,
+        })
+
+        # Set up callbacks
+        def log_callback(level, msg):
+            job.add_log(level, msg)
+
+        def stall_callback(stall):
+            # Replace rather than mutate: the list may be serialized from another thread
+            job.stall_events = (job.stall_events + [stall])[-MAX_STALL_EVENTS:]
+            job.publish()
+
+        downloader.set_log_callback(log_callback)
+        downloader.set_stall_callback(stall_callback)
+
+        # Get anime details
+        job.status = "fetching_info"
+        job.add_log("INFO", f"Fetching anime details from {job.anime_url}")
+        
+        anime_id, anime_title = downloader.get_anime_details(job.anime_url)
+        if not anime_id:
+            raise Exception("Could not extract anime ID from URL")
+
+        job.anime_title = anime_title
+        job.add_log("INFO", f"Found anime: {anime_title}")
+
+        # Detect season
+        detected_season = downloader.detect_season_from_title(anime_title)
+        job.season = job.config.get("season_number", 0)
+        if job.season == 0:
+            job.season = detected_season
+        job.add_log("INFO", f"Season: {job.season}")
+
+        # Get episodes
+        job.status = "fetching_episodes"
+        cancellation.check()
+        episodes = downloader.get_episode_list(anime_id)
+        if not episodes:
+            raise Exception("No episodes found")
+
+        job.add_log("INFO", f"Found {len(episodes)} episodes")
+        try:
+            get_catalog(download_folder).record_series(job.anime_url, anime_title, len(episodes))
+        except OSError as e:
+            job.add_log("WARN", f"Could not update the catalog: {e}")
+
+        # Filter episodes based on selection mode
+        download_mode = job.config.get("download_mode", "All Episodes")
+        if download_mode == "Single Episode":
+            single_ep = job.config.get("single_episode", "1")
+            selected = [ep for ep in episodes if ep["id"] == single_ep]
+        elif download_mode == "Episode Range":
+            start_ep = job.config.get("start_episode", "1")
+            end_ep = job.config.get("end_episode", "1")
+            
+            def in_range(ep_id, start_id, end_id):
+                start_key = downloader.safe_episode_key(start_id)
+                end_key = downloader.safe_episode_key(end_id)
+                key = downloader.safe_episode_key(ep_id)
+                return start_key <= key <= end_key
+            
+            selected = [ep for ep in episodes if in_range(ep["id"], start_ep, end_ep)]
+        elif download_mode == "Episode List":
+            episode_ids = set(job.config.get("episode_ids", []))
+            selected = [ep for ep in episodes if ep["id"] in episode_ids]
+        else:  # All Episodes
+            selected = episodes
+
+        if not selected:
+            raise Exception("No episodes match your selection")
+
+        job.total_episodes = len(selected)
+        job.add_log("INFO", f"Will download {job.total_episodes} episode(s)")
+
+        # Create download directory
+        anime_dir = os.path.join(
+            download_folder,
+            downloader.generate_anime_folder_name(anime_title),
+        )
+        season_dir = os.path.join(
+            anime_dir,
+            downloader.generate_season_folder_name(job.season),
+        )
+        os.makedirs(season_dir, exist_ok=True)
+
+        downloaded_files = []
+        pending = selected
+        repair_ids = set()
+
+        # Sync mode: keep episodes that are already in the season folder and intact
+        if job.config.get("sync_mode", False):
+            job.status = "verifying"
+            with tracing.span("sync", "job"):
+                pending, repair_ids = sync_existing_episodes(
+                    job, downloader, selected, season_dir, download_folder, downloaded_files
+                )
+            job.add_log(
+                "INFO",
+                f"Sync: {job.skipped_episodes} episode(s) up to date, "
+                f"{len(repair_ids)} to repair, {len(pending) - len(repair_ids)} missing",
+            )
+
+        # Download episodes
+        job.status = "downloading"
+        prefer_type = job.config.get("prefer_type", "Soft Sub")
+        prefer_server = job.config.get("prefer_server", "Server 1")
+
+        # Optional post-download transcode, overlapping with the remaining downloads
+        transcode_profile = job.config.get("transcode_profile") or DEFAULT_PROFILE
+        if transcode_profile and transcode_profile not in PROFILES:
+            job.add_log("WARN", f"Unknown transcode profile '{transcode_profile}', not transcoding")
+            transcode_profile = None
+
+        items = [
+            (ep, os.path.join(season_dir, downloader.generate_episode_filename(
+                anime_title, job.season, ep["id"], ep.get("title", ""),
+            )))
+            for ep in pending
+        ]
+        if cluster.CLUSTER_DISTRIBUTE and cluster.CLUSTER_TOKEN:
+            results = cluster.distribute_episodes(job, items, download_folder)
+        else:
+            results = download_episodes_locally(job, downloader, items, download_folder, prefer_type, prefer_server)
+
+        update_eta(job, len(items), download_folder)
+        for done, (ep, filepath, success) in enumerate(results, 1):
+            update_eta(job, len(items) - done, download_folder)
+            ep_id = ep["id"]
+            if success:
+                downloaded_files.append(filepath)
+                job.completed_episodes += 1
+                if ep_id in repair_ids:
+                    job.repaired_episodes += 1
+                else:
+                    job.fresh_episodes += 1
+                job.progress = int((job.completed_episodes / job.total_episodes) * 100)
+                job.downloaded_files.append(os.path.relpath(filepath, download_folder))
+                job.add_log("INFO", f"✅ Successfully downloaded episode {ep_id}")
+                get_library_index(download_folder).invalidate()
+                if transcode_profile:
+                    transcodes.append((ep_id, start_transcode(
+                        job, ep_id, filepath, transcode_profile, download_folder
+                    )))
+            else:
+                job.add_log("ERROR", f"❌ Failed to download episode {ep_id}")
+
+        if transcodes:
+            with tracing.span("transcodes", "wait", count=len(transcodes)):
+                wait_for_transcodes(job, transcodes)
+
+        # Merge if requested and multiple episodes
+        merge_episodes = job.config.get("merge_episodes", False)
+        if merge_episodes and len(downloaded_files) > 1:
+            cancellation.check()
+            job.status = "merging"
+            job.add_log("INFO", f"Merging {len(downloaded_files)} episodes...")
+            
+            first_ep_id = selected[0]["id"]
+            last_ep_id = selected[-1]["id"]
+            
+            staged_merge = downloader.merge_videos(
+                downloaded_files,
+                anime_title,
+                job.season,
+                first_ep_id,
+                last_ep_id,
+                work_dir=get_staging_folder(download_folder)
+            )
+
+            merged_file = None
+            if staged_merge:
+                merged_file = os.path.join(season_dir, os.path.basename(staged_merge))
+                try:
+                    publish_file(staged_merge, merged_file)
+                except OSError as e:
+                    job.add_log("ERROR", f"Could not publish merged file: {e}")
+                    discard_staged(staged_merge)
+                    merged_file = None
+
+            if merged_file:
+                get_library_index(download_folder).invalidate()
+                job.merged_file = os.path.relpath(merged_file, download_folder)
+                job.add_log("INFO", f"✅ Successfully merged into {job.merged_file}")
+                
+                # Remove individual files if requested
+                if not job.config.get("keep_individual_files", False):
+                    job.add_log("INFO", "Removing individual episode files...")
+                    for f in downloaded_files:
+                        try:
+                            os.remove(f)
+                            job.downloaded_files.remove(os.path.relpath(f, download_folder))
+                        except Exception as e:
+                            job.add_log("WARN", f"Could not remove {os.path.relpath(f, download_folder)}: {e}")
+            else:
+                job.add_log("ERROR", "❌ Merge failed")
+
+        # Complete
+        job.status = "completed"
+        job.progress = 100
+        job.end_time = datetime.now()
+        summary = f"🎉 Download job completed! Downloaded {job.completed_episodes}/{job.total_episodes} episodes"
+        if job.config.get("sync_mode", False):
+            summary += f" ({job.fresh_episodes} new, {job.repaired_episodes} repaired, {job.skipped_episodes} skipped)"
+        if transcodes:
+            summary += f", transcoded {job.transcoded_episodes} ({job.transcode_saved_bytes / (1024 * 1024):.0f} MB saved)"
+        job.add_log("INFO", summary)
+
+    except cancellation.JobCancelled:
+        for _, future in transcodes:
+            future.cancel()
+        job.status = "cancelled"
+        job.end_time = datetime.now()
+        job.add_log("WARN", f"🛑 Job cancelled after {job.completed_episodes}/{job.total_episodes} episodes")
+
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
+        job.end_time = datetime.now()
+        job.add_log("ERROR", f"Job failed: {e}")
+        import traceback
+        job.add_log("ERROR", traceback.format_exc())
@@ -0,0 +1,215 @@
+"""
+Download Job Store
+Registry of download jobs. By default jobs only live in this process; with a
+shared folder every job is also published as a JSON file so that all HTTP
+worker processes see the same jobs and job ids.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: only single-process serving is supported
+    fcntl = None
+
+from app.utils import hold_instance_lock, instance_alive
+
+# How often jobs running in this process are written to the shared folder
+FLUSH_INTERVAL_SECONDS = 1.0
+
+FINISHED_STATUSES = ["completed", "failed", "cancelled"]
+
+
+class StoredJob:
+    """Read-only view of a job published by another process"""
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self.job_id = data["job_id"]
+        self.status = data["status"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self.data
+
+
+class JobStore:
+    """Dict-like job registry, optionally shared between processes through a folder"""
+    def __init__(self):
+        self.folder: Optional[str] = None
+        self.owners_folder: Optional[str] = None
+        self.instance: Optional[str] = None
+        self._local: Dict[int, Any] = {}
+        self._published: Dict[int, str] = {}  # job_id -> last written JSON
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # request threads and the flusher publish the same jobs
+        self._flusher = None
+
+    def enable_shared_folder(self, folder: str):
+        """Share jobs through a folder and start publishing local jobs to it"""
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.owners_folder = os.path.join(folder, "owners")
+        self.instance = hold_instance_lock(self.owners_folder)
+        self._mark_orphans_failed()
+        if not self._flusher:
+            self._flusher = threading.Thread(target=self._flush_loop, name="job-store-flush", daemon=True)
+            self._flusher.start()
+
+    def _job_file(self, job_id: int) -> str:
+        return os.path.join(self.folder, f"{job_id}.json")
+
+    def next_job_id(self) -> int:
+        """Allocate a job id that is unique across all processes sharing the folder"""
+        if not self.folder:
+            with self._lock:
+                self._counter += 1
+                return self._counter
+
+        counter_file = os.path.join(self.folder, "counter")
+        with self._lock, open(counter_file, "a+", encoding="utf-8") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                value = int(f.read().strip() or 0) + 1
+                f.seek(0)
+                f.truncate()
+                f.write(str(value))
+                f.flush()
+                return value
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self, job_id: int) -> Optional[StoredJob]:
+        try:
+            with open(self._job_file(job_id), "r", encoding="utf-8") as f:
+                return StoredJob(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, job) -> bool:
+        """Publish a local job if it changed since the last write"""
+        with self._write_lock:
+            data = job.to_dict()
+            data["owner_instance"] = self.instance
+            payload = json.dumps(data, default=str)
+            if self._published.get(job.job_id) == payload:
+                return False
+            job_file = self._job_file(job.job_id)
+            tmp_file = f"{job_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_file, job_file)
+            self._published[job.job_id] = payload
+            return True
+
+    def flush(self):
+        """Write changed local jobs; finished jobs are then served from the folder only"""
+        if not self.folder:
+            return
+        with self._lock:
+            local = list(self._local.items())
+        for job_id, job in local:
+            try:
+                changed = self._write(job)
+            except OSError as e:
+                print(f"Could not publish job {job_id}: {e}")
+                continue
+            # Evict only once a finished job has stopped changing, so final logs are kept
+            if not changed and job.status in FINISHED_STATUSES:
+                with self._lock:
+                    self._local.pop(job_id, None)
+                    self._published.pop(job_id, None)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+            self.flush()
+
+    def _mark_orphans_failed(self):
+        """
+        Jobs whose owning process is gone (e.g. after a restart) can never finish.
+        Owners are tracked by instance lock rather than PID, which restarted containers reuse.
+        """
+        for name in os.listdir(self.folder):
+            if not name.endswith(".json"):
+                continue
+            job_file = os.path.join(self.folder, name)
+            try:
+                with open(job_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get("status") in FINISHED_STATUSES or instance_alive(self.owners_folder, data.get("owner_instance")):
+                continue
+            data["status"] = "failed"
+            data["error"] = "Server stopped while the job was running"
+            tmp_file = f"{job_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_file, job_file)
+
+    # Dict-style access used by the routes and the worker pool
+
+    def __setitem__(self, job_id: int, job):
+        with self._lock:
+            self._local[job_id] = job
+        # Publish right away so the next status request may hit any process
+        if self.folder:
+            try:
+                self._write(job)
+            except OSError as e:
+                print(f"Could not publish job {job_id}: {e}")
+
+    def get(self, job_id: int, default=None):
+        with self._lock:
+            job = self._local.get(job_id)
+        if job is not None:
+            return job
+        if self.folder:
+            stored = self._read(job_id)
+            if stored is not None:
+                return stored
+        return default
+
+    def __getitem__(self, job_id: int):
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    def __contains__(self, job_id: int) -> bool:
+        return self.get(job_id) is not None
+
+    def __delitem__(self, job_id: int):
+        with self._lock:
+            self._local.pop(job_id, None)
+            self._published.pop(job_id, None)
+        if self.folder:
+            try:
+                os.remove(self._job_file(job_id))
+            except FileNotFoundError:
+                pass
+
+    def values(self) -> Iterator[Any]:
+        with self._lock:
+            local = dict(self._local)
+        jobs = dict(local)
+        if self.folder:
+            for name in os.listdir(self.folder):
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    job_id = int(name[:-len(".json")])
+                except ValueError:
+                    continue
+                if job_id in jobs:
+                    continue
+                stored = self._read(job_id)
+                if stored is not None:
+                    jobs[job_id] = stored
+        return iter(list(jobs.values()))
@@ -0,0 +1,209 @@
+"""
+Library Index
+In-memory snapshot of the download folder with precomputed sort orders, so
+library listings can be filtered and paged without walking and sorting the
+whole collection on every request. The snapshot is rebuilt when it is older
+than LIBRARY_INDEX_TTL seconds or after a download publishes new files.
+"""
+import base64
+import bisect
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.utils import is_hidden_entry
+
+# Seconds a snapshot is reused before the download folder is scanned again
+LIBRARY_INDEX_TTL = float(os.environ.get("LIBRARY_INDEX_TTL", "30"))
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Sort name -> key of an entry; sizes and times sort largest/newest first
+SORT_KEYS = {
+    "name": lambda e: (e["name"].lower(), e["name"]),
+    "size": lambda e: (-e["size"], e["name"].lower(), e["name"]),
+    "modified": lambda e: (-e["mtime"], e["name"].lower(), e["name"]),
+}
+
+
+def scan_media_files(base_path: str) -> List[Dict[str, Any]]:
+    """Recursively collect visible files under a directory with one stat per file"""
+    files = []
+    stack = [base_path]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+        for entry in entries:
+            if is_hidden_entry(entry.name):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=True):
+                    stack.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=True):
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            files.append({
+                "name": entry.name,
+                "absolute_path": entry.path,
+                "relative_path": os.path.relpath(entry.path, base_path).replace(os.sep, "/"),
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+            })
+    files.sort(key=lambda f: f["relative_path"])
+    return files
+
+
+def encode_cursor(key: Tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple:
+    try:
+        return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode("ascii"))))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+class SortedView:
+    """Entries in one sort order, with their keys kept alongside for bisecting"""
+    def __init__(self, entries: List[Dict[str, Any]], sort: str):
+        key = SORT_KEYS[sort]
+        self.entries = sorted(entries, key=key)
+        self.keys = [key(e) for e in self.entries]
+
+    def page(self, cursor: Optional[str], limit: int, prefix: str = "",
+             query: str = "") -> Tuple[List[Dict[str, Any]], Optional[str], int]:
+        """
+        Return (items, next_cursor, total_matching). The cursor is the key of the
+        last returned entry, so pages stay consistent while the library changes.
+        """
+        prefix, query = prefix.lower(), query.lower()
+        start = 0
+        if cursor:
+            try:
+                start = bisect.bisect_right(self.keys, decode_cursor(cursor))
+            except TypeError:
+                raise ValueError("Invalid cursor")
+
+        def matches(entry):
+            name = entry["name"].lower()
+            return name.startswith(prefix) and query in name
+
+        if not prefix and not query:
+            total = len(self.entries)
+            end = start + limit
+            items = self.entries[start:end]
+            next_cursor = encode_cursor(self.keys[end - 1]) if end < total else None
+            return items, next_cursor, total
+
+        items, last_index, total = [], None, 0
+        for i, entry in enumerate(self.entries):
+            if not matches(entry):
+                continue
+            total += 1
+            if i >= start and len(items) < limit:
+                items.append(entry)
+                last_index = i
+        has_more = last_index is not None and any(
+            matches(e) for e in self.entries[last_index + 1:]
+        )
+        return items, encode_cursor(self.keys[last_index]) if has_more else None, total
+
+
+class SeriesFiles:
+    """Files of one series and their sort orders"""
+    def __init__(self, files: List[Dict[str, Any]]):
+        self.files = files
+        self.total_size = sum(f["size"] for f in files)
+        self._views: Dict[str, SortedView] = {}
+        self._lock = threading.Lock()
+
+    def view(self, sort: str) -> SortedView:
+        with self._lock:
+            if sort not in self._views:
+                self._views[sort] = SortedView(self.files, sort)
+            return self._views[sort]
+
+
+class LibraryIndex:
+    """Cached snapshot of the series in a download folder"""
+    def __init__(self, download_folder: str, ttl: float = LIBRARY_INDEX_TTL):
+        self.download_folder = download_folder
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._built_at = 0.0
+        self._series: Dict[str, Dict[str, Any]] = {}
+        self._files: Dict[str, SeriesFiles] = {}
+        self._views: Dict[str, SortedView] = {}
+
+    def invalidate(self):
+        """Force a rescan on the next request, e.g. after new files were published"""
+        with self._lock:
+            self._built_at = 0.0
+
+    def _ensure_fresh(self):
+        with self._lock:
+            if time.time() - self._built_at < self.ttl:
+                return
+            series, files = {}, {}
+            if os.path.isdir(self.download_folder):
+                for entry in os.scandir(self.download_folder):
+                    if is_hidden_entry(entry.name) or not entry.is_dir():
+                        continue
+                    media_files = scan_media_files(entry.path)
+                    files[entry.name] = SeriesFiles(media_files)
+                    series[entry.name] = {
+                        "name": entry.name,
+                        "total_files": len(media_files),
+                        "size": files[entry.name].total_size,
+                        "mtime": max((f["mtime"] for f in media_files), default=entry.stat().st_mtime),
+                        "seasons": sorted({
+                            f["relative_path"].split("/", 1)[0]
+                            for f in media_files if "/" in f["relative_path"]
+                        }),
+                    }
+            self._series = series
+            self._files = files
+            self._views = {sort: SortedView(list(series.values()), sort) for sort in SORT_KEYS}
+            self._built_at = time.time()
+
+    def series_view(self, sort: str) -> SortedView:
+        self._ensure_fresh()
+        with self._lock:
+            return self._views[sort]
+
+    def series_files(self, name: str) -> Optional[SeriesFiles]:
+        self._ensure_fresh()
+        with self._lock:
+            return self._files.get(name)
+
+    def totals(self) -> Dict[str, Any]:
+        self._ensure_fresh()
+        with self._lock:
+            series = list(self._series.values())
+        return {
+            "series": len(series),
+            "files": sum(s["total_files"] for s in series),
+            "size_mb": round(sum(s["size"] for s in series) / (1024 * 1024), 2),
+        }
+
+
+_indexes: Dict[str, LibraryIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_library_index(download_folder: str) -> LibraryIndex:
+    """Return the shared library index for a download folder"""
+    key = os.path.abspath(download_folder)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = LibraryIndex(download_folder)
+        return _indexes[key]
@@ -0,0 +1,191 @@
+"""
+Upstream Mirrors
+Pool of interchangeable base URLs of the site (UPSTREAM_MIRRORS; the first is
+the canonical one). The app builds every site URL on the canonical base and
+the upstream session routes each request to the mirror it currently uses,
+failing over to the fastest other healthy mirror when a request can't
+connect, times out or gets a gateway error.
+
+A background thread probes the latency and health of every mirror. The
+session stays on its mirror until that mirror fails (sticky routing): cookies
+such as cf_clearance are per host, so hopping between mirrors for a few
+milliseconds would mean solving a new challenge each time.
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+# Base URLs of the site, canonical first
+UPSTREAM_MIRRORS = [
+    url.strip().rstrip("/") for url in os.environ.get("UPSTREAM_MIRRORS", "https://anikai.to").split(",")
+    if url.strip()
+] or ["https://anikai.to"]
+
+# Seconds between two probes of every mirror
+MIRROR_PROBE_SECONDS = int(os.environ.get("MIRROR_PROBE_SECONDS", "60"))
+
+PROBE_TIMEOUT = 10
+
+# Seconds a mirror that failed a request is skipped, unless a probe finds it healthy first
+MIRROR_COOLDOWN_SECONDS = 120
+
+# Responses meaning the mirror (or the CDN in front of it) is down rather than the request wrong
+FAILOVER_STATUSES = {502, 503, 504, 520, 521, 522, 523, 524}
+
+# Smoothing of measured latencies
+LATENCY_SMOOTHING = 0.3
+
+
+def _base(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class Mirror:
+    """One base URL and what is known about its health"""
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.host = urlsplit(base_url).hostname or base_url
+        self.latency: Optional[float] = None
+        self.healthy = True
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error: Optional[str] = None
+        self.last_probe: Optional[float] = None
+
+    def usable(self, now: float) -> bool:
+        return self.healthy and now >= self.down_until
+
+    def record_latency(self, seconds: float):
+        self.latency = seconds if self.latency is None else (
+            LATENCY_SMOOTHING * seconds + (1 - LATENCY_SMOOTHING) * self.latency
+        )
+
+    def to_dict(self, now: float) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "latency_ms": round(self.latency * 1000) if self.latency is not None else None,
+            "healthy": self.healthy,
+            "cooling_down_seconds": round(self.down_until - now) if self.down_until > now else 0,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_probe_seconds_ago": round(now - self.last_probe) if self.last_probe else None,
+        }
+
+
+class MirrorPool:
+    """Sticky choice of the mirror the upstream session talks to"""
+    def __init__(self, base_urls: List[str]):
+        self.mirrors = [Mirror(url) for url in base_urls]
+        self.canonical = self.mirrors[0]
+        self._by_base = {_base(m.base_url): m for m in self.mirrors}
+        self._current = self.canonical
+        self._lock = threading.Lock()
+        self._prober: Optional[threading.Thread] = None
+        self.switches = 0
+
+    def mirror_of(self, url: str) -> Optional[Mirror]:
+        """The mirror a URL points at, if any"""
+        return self._by_base.get(_base(url))
+
+    def current(self) -> Mirror:
+        """The mirror requests go to, switching away from it once it is unusable"""
+        with self._lock:
+            if not self._current.usable(time.time()):
+                self._switch()
+            return self._current
+
+    def _switch(self):
+        """Move to the fastest usable mirror (the one back soonest if none is usable)"""
+        now = time.time()
+        usable = [m for m in self.mirrors if m.usable(now)]
+        if usable:
+            best = min(usable, key=lambda m: (m.latency is None, m.latency or 0))
+        else:
+            best = min(self.mirrors, key=lambda m: (m.healthy is False, m.down_until))
+        if best is not self._current:
+            print(f"Upstream mirror: switching from {self._current.base_url} to {best.base_url}")
+            self._current = best
+            self.switches += 1
+
+    def rewrite(self, url: str, mirror: Mirror) -> str:
+        """Point a URL of any mirror at the given one"""
+        source = self.mirror_of(url)
+        if source is None or source is mirror:
+            return url
+        return mirror.base_url + url[len(_base(url)):]
+
+    def rewrite_headers(self, headers: Optional[Dict[str, str]], mirror: Mirror) -> Optional[Dict[str, str]]:
+        """Referer and Origin naming another mirror, pointed at the given one"""
+        if not headers:
+            return headers
+        rewritten = dict(headers)
+        for name in ("Referer", "Origin"):
+            if rewritten.get(name):
+                rewritten[name] = self.rewrite(rewritten[name], mirror)
+        return rewritten
+
+    def report_success(self, mirror: Mirror, seconds: float):
+        with self._lock:
+            mirror.record_latency(seconds)
+
+    def report_failure(self, mirror: Mirror, error: str) -> Mirror:
+        """Put a mirror on cooldown after a failed request; returns the mirror to retry on"""
+        with self._lock:
+            mirror.failures += 1
+            mirror.last_error = error
+            mirror.down_until = time.time() + MIRROR_COOLDOWN_SECONDS
+            if mirror is self._current:
+                self._switch()
+            return self._current
+
+    def probe(self, mirror: Mirror, send):
+        """Time a request to the mirror's front page with an unrouted request function"""
+        started = time.time()
+        try:
+            response = send("GET", mirror.base_url + "/", timeout=PROBE_TIMEOUT)
+            healthy = response.status_code not in FAILOVER_STATUSES and response.status_code < 500
+            error = None if healthy else f"HTTP {response.status_code}"
+        except Exception as e:
+            healthy, error = False, str(e)
+        elapsed = time.time() - started
+        with self._lock:
+            mirror.last_probe = time.time()
+            mirror.healthy = healthy
+            if healthy:
+                mirror.record_latency(elapsed)
+                mirror.down_until = 0.0
+            else:
+                mirror.last_error = error
+
+    def start_probing(self, send):
+        """Probe all mirrors in the background (only worth it with more than one)"""
+        if len(self.mirrors) < 2:
+            return
+        with self._lock:
+            if self._prober:
+                return
+            self._prober = threading.Thread(target=self._probe_loop, args=(send,), name="mirror-probe", daemon=True)
+            self._prober.start()
+
+    def _probe_loop(self, send):
+        while True:
+            for mirror in self.mirrors:
+                self.probe(mirror, send)
+            time.sleep(MIRROR_PROBE_SECONDS)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            return {
+                "current": self._current.base_url,
+                "canonical": self.canonical.base_url,
+                "switches": self.switches,
+                "probing": self._prober is not None,
+                "mirrors": [m.to_dict(now) for m in self.mirrors],
+            }
+
+
+mirror_pool = MirrorPool(UPSTREAM_MIRRORS)
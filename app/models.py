@@ -14,6 +14,14 @@ class DownloadJob:
         self.current_episode = None
         self.total_episodes = 0
         self.completed_episodes = 0
+        self.skipped_episodes = 0
+        self.repaired_episodes = 0
+        self.fresh_episodes = 0
+        self.transcoded_episodes = 0
+        self.transcode_progress = {}
+        self.transcode_saved_bytes = 0
+        self.stall_events = []
+        self.eta_seconds = None
         self.logs = []
         self.error = None
         self.downloaded_files = []
@@ -35,6 +43,9 @@ class DownloadJob:
         if len(self.logs) > 100:
             self.logs = self.logs[-100:]
 
+    def publish(self, log_entry=None):
+        """Report state changed outside add_log; only needed when the job runs in a worker process"""
+
     def to_dict(self):
         """Convert job to dictionary for JSON serialization"""
         elapsed = None
@@ -53,11 +64,20 @@ class DownloadJob:
             "current_episode": self.current_episode,
             "total_episodes": self.total_episodes,
             "completed_episodes": self.completed_episodes,
+            "skipped_episodes": self.skipped_episodes,
+            "repaired_episodes": self.repaired_episodes,
+            "fresh_episodes": self.fresh_episodes,
+            "transcoded_episodes": self.transcoded_episodes,
+            "transcode_progress": self.transcode_progress,
+            "transcode_saved_bytes": self.transcode_saved_bytes,
+            "stall_events": self.stall_events,
             "logs": self.logs[-20:],  # Return last 20 logs
             "error": self.error,
             "downloaded_files": self.downloaded_files,
             "merged_file": self.merged_file,
             "elapsed_seconds": int(elapsed) if elapsed else None,
+            # Estimated seconds until the episodes are downloaded (see app.stats)
+            "eta_seconds": self.eta_seconds if self.status == "downloading" else None,
             "start_time": self.start_time.isoformat(),
             "end_time": self.end_time.isoformat() if self.end_time else None
         }
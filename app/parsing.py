@@ -0,0 +1,275 @@
+"""
+HTML Parsing Backends
+Extracts only the attributes we read from AnimeKai pages (ids, tokens, episode
+numbers, language flags, server ids, titles, links and posters).
+
+The lxml backend uses libxml2's C parser with targeted XPath queries; the bs4
+backend is the original BeautifulSoup/html.parser code path and is used when
+lxml is not installed. Select one with HTML_PARSER=auto|lxml|bs4.
+"""
+import importlib.util
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+# lxml is imported by the backend itself, on first use
+LXML_AVAILABLE = importlib.util.find_spec("lxml") is not None
+
+# CSS-class fallbacks tried in order to find search result items
+SEARCH_ITEM_SELECTORS = [
+    ".aitem-wrapper .aitem",
+    ".anime-item",
+    ".film_list-wrap .flw-item",
+    ".block_area-content .item",
+    "article",
+    ".anime-card",
+    '[class*="anime"]',
+    '[class*="item"]',
+]
+
+
+def _has_class(name: str) -> str:
+    """XPath predicate equivalent to the CSS class selector `.name`"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+class Bs4Backend:
+    """BeautifulSoup with the pure-Python html.parser"""
+    name = "bs4"
+
+    def __init__(self):
+        from bs4 import BeautifulSoup
+        self.BeautifulSoup = BeautifulSoup
+
+    def anime_details(self, html: str) -> Tuple[Optional[str], Optional[str]]:
+        soup = self.BeautifulSoup(html, "html.parser")
+        anime_div = soup.select_one("div[data-id]")
+        anime_id = anime_div.get("data-id") if anime_div else None
+
+        title_elem = (
+            soup.select_one("div.title-wrapper h1.title span")
+            or soup.select_one("h1.title")
+            or soup.select_one(".anime-title")
+        )
+        title = title_elem.get("title") if title_elem and title_elem.get("title") else (
+            title_elem.text.strip() if title_elem else None
+        )
+        return anime_id, title
+
+    def episodes(self, html: str) -> List[Dict[str, str]]:
+        soup = self.BeautifulSoup(html, "html.parser")
+        episodes = []
+        for ep in soup.select("div.eplist a"):
+            episodes.append({
+                "token": ep.get("token", ""),
+                "num": ep.get("num", ""),
+                "langs": ep.get("langs", "0"),
+                "title": (
+                    ep.get("title")
+                    or ep.get("data-title")
+                    or ep.get("data-name")
+                    or ep.get("data-ep-title")
+                    or " ".join(ep.stripped_strings)
+                ),
+            })
+        return episodes
+
+    def servers(self, html: str) -> List[Dict[str, str]]:
+        soup = self.BeautifulSoup(html, "html.parser")
+        servers = []
+        for type_div in soup.select("div.server-items[data-id]"):
+            type_id = type_div.get("data-id", "")
+            for server in type_div.select("span.server[data-lid]"):
+                servers.append({
+                    "type": type_id,
+                    "server_id": server.get("data-lid", ""),
+                    "server_name": server.text.strip(),
+                })
+        return servers
+
+    def search_results(self, html: str, max_items: int) -> List[Dict[str, str]]:
+        soup = self.BeautifulSoup(html, "html.parser")
+        anime_items = []
+        for selector in SEARCH_ITEM_SELECTORS:
+            anime_items = soup.select(selector)
+            if anime_items:
+                break
+
+        results = []
+        for item in anime_items[:max_items]:
+            link_elem = (
+                item.select_one('a[href*="/watch/"]') or
+                item.select_one('a[href*="/anime/"]') or
+                item.select_one('a.film-poster-ahref') or
+                item.select_one('.film-name a') or
+                item.select_one('a')
+            )
+            if not link_elem:
+                continue
+            title_elem = (
+                item.select_one('.film-name') or
+                item.select_one('.title') or
+                item.select_one('h3') or
+                item.select_one('.anime-name') or
+                item.select_one('[class*="title"]')
+            )
+            img_elem = item.select_one('img')
+            results.append({
+                "href": link_elem.get('href', ''),
+                "title": title_elem.get_text(strip=True) if title_elem else link_elem.get_text(strip=True),
+                "image": (img_elem.get('src', '') or img_elem.get('data-src', '')) if img_elem else '',
+            })
+        return results
+
+
+class LxmlBackend:
+    """lxml (libxml2) with XPath queries that only visit the elements we need"""
+    name = "lxml"
+
+    SEARCH_ITEM_XPATHS = [
+        f"//*[{_has_class('aitem-wrapper')}]//*[{_has_class('aitem')}]",
+        f"//*[{_has_class('anime-item')}]",
+        f"//*[{_has_class('film_list-wrap')}]//*[{_has_class('flw-item')}]",
+        f"//*[{_has_class('block_area-content')}]//*[{_has_class('item')}]",
+        "//article",
+        f"//*[{_has_class('anime-card')}]",
+        "//*[contains(@class, 'anime')]",
+        "//*[contains(@class, 'item')]",
+    ]
+    SEARCH_LINK_XPATHS = [
+        ".//a[contains(@href, '/watch/')]",
+        ".//a[contains(@href, '/anime/')]",
+        f".//a[{_has_class('film-poster-ahref')}]",
+        f".//*[{_has_class('film-name')}]//a",
+        ".//a",
+    ]
+    SEARCH_TITLE_XPATHS = [
+        f".//*[{_has_class('film-name')}]",
+        f".//*[{_has_class('title')}]",
+        ".//h3",
+        f".//*[{_has_class('anime-name')}]",
+        ".//*[contains(@class, 'title')]",
+    ]
+
+    def __init__(self):
+        import lxml.html
+        from lxml import etree
+        self.lxml_html = lxml.html
+        compile_all = lambda paths: [etree.XPath(p) for p in paths]
+        self._anime_div = etree.XPath("(//div[@data-id])[1]")
+        self._title_elems = compile_all([
+            f"(//div[{_has_class('title-wrapper')}]//h1[{_has_class('title')}]//span)[1]",
+            f"(//h1[{_has_class('title')}])[1]",
+            f"(//*[{_has_class('anime-title')}])[1]",
+        ])
+        self._episode_links = etree.XPath(f"//div[{_has_class('eplist')}]//a")
+        self._server_types = etree.XPath(f"//div[{_has_class('server-items')}][@data-id]")
+        self._servers = etree.XPath(f".//span[{_has_class('server')}][@data-lid]")
+        self._search_items = compile_all(self.SEARCH_ITEM_XPATHS)
+        self._search_links = compile_all(self.SEARCH_LINK_XPATHS)
+        self._search_titles = compile_all(self.SEARCH_TITLE_XPATHS)
+        self._search_img = etree.XPath("(.//img)[1]")
+
+    def _parse(self, html: str):
+        try:
+            return self.lxml_html.document_fromstring(html)
+        except ValueError:
+            # Unicode strings with an XML encoding declaration must be passed as bytes
+            return self.lxml_html.document_fromstring(html.encode("utf-8"))
+
+    @staticmethod
+    def _first(xpaths, node):
+        for xpath in xpaths:
+            found = xpath(node)
+            if found:
+                return found[0]
+        return None
+
+    @staticmethod
+    def _text(node) -> str:
+        return "".join(node.itertext())
+
+    @staticmethod
+    def _stripped_text(node, separator: str = "") -> str:
+        return separator.join(s.strip() for s in node.itertext() if s.strip())
+
+    def anime_details(self, html: str) -> Tuple[Optional[str], Optional[str]]:
+        root = self._parse(html)
+        anime_div = self._anime_div(root)
+        anime_id = anime_div[0].get("data-id") if anime_div else None
+
+        title_elem = self._first(self._title_elems, root)
+        title = None
+        if title_elem is not None:
+            title = title_elem.get("title") or self._text(title_elem).strip()
+        return anime_id, title
+
+    def episodes(self, html: str) -> List[Dict[str, str]]:
+        root = self._parse(html)
+        episodes = []
+        for ep in self._episode_links(root):
+            attrs = ep.attrib
+            episodes.append({
+                "token": attrs.get("token", ""),
+                "num": attrs.get("num", ""),
+                "langs": attrs.get("langs", "0"),
+                "title": (
+                    attrs.get("title")
+                    or attrs.get("data-title")
+                    or attrs.get("data-name")
+                    or attrs.get("data-ep-title")
+                    or self._stripped_text(ep, " ")
+                ),
+            })
+        return episodes
+
+    def servers(self, html: str) -> List[Dict[str, str]]:
+        root = self._parse(html)
+        servers = []
+        for type_div in self._server_types(root):
+            type_id = type_div.get("data-id", "")
+            for server in self._servers(type_div):
+                servers.append({
+                    "type": type_id,
+                    "server_id": server.get("data-lid", ""),
+                    "server_name": self._text(server).strip(),
+                })
+        return servers
+
+    def search_results(self, html: str, max_items: int) -> List[Dict[str, str]]:
+        root = self._parse(html)
+        anime_items = []
+        for xpath in self._search_items:
+            anime_items = xpath(root)
+            if anime_items:
+                break
+
+        results = []
+        for item in anime_items[:max_items]:
+            link_elem = self._first(self._search_links, item)
+            if link_elem is None:
+                continue
+            title_elem = self._first(self._search_titles, item)
+            img = self._search_img(item)
+            results.append({
+                "href": link_elem.get("href", ""),
+                "title": self._stripped_text(title_elem if title_elem is not None else link_elem),
+                "image": (img[0].get("src", "") or img[0].get("data-src", "")) if img else "",
+            })
+        return results
+
+
+BACKENDS = {
+    "lxml": LxmlBackend,
+    "bs4": Bs4Backend,
+}
+
+_backends: Dict[str, Any] = {}
+
+def get_parser(name: str = None):
+    """Return a parsing backend: the configured one, or lxml when available"""
+    name = name or os.environ.get("HTML_PARSER", "auto")
+    if name == "auto":
+        name = "lxml" if LXML_AVAILABLE else "bs4"
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
@@ -0,0 +1,359 @@
+"""
+Media Probing
+Cheap integrity checks for downloaded episodes backed by a cached ffprobe result,
+and a background pool that probes library files for the library listings
+"""
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.utils import get_app_data_folder
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process only
+    fcntl = None
+
+# Files smaller than this cannot be a real episode
+MIN_EPISODE_SIZE = 1024 * 1024
+
+# Allowed difference between container and stream duration before a file is considered truncated
+DURATION_TOLERANCE = 0.05
+
+# Background ffprobe processes used to fill the cache for library listings
+PROBE_WORKERS = max(1, int(os.environ.get("PROBE_WORKERS", "2")))
+
+# Seconds between cache writes while the background pool is busy
+PROBE_SAVE_INTERVAL = 5
+
+# Seconds between checks whether another process changed the cache file
+RELOAD_CHECK_SECONDS = 1.0
+
+
+def run_ffprobe(path: str, timeout: int = 30) -> Optional[Dict[str, Any]]:
+    """
+    Run ffprobe on a file and return its format and stream info, None if it cannot be read.
+    Raises FileNotFoundError when ffprobe is not installed.
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "format=duration,size,bit_rate:stream=index,codec_type,codec_name,width,height,duration:stream_tags=language,title",
+        "-of", "json",
+        path,
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None
+    if result.returncode != 0:
+        return None
+    try:
+        return json.loads(result.stdout or "{}")
+    except ValueError:
+        return None
+
+
+class ProbeCache:
+    """
+    Thread-safe ffprobe result cache keyed by (path, size, mtime), persisted as
+    JSON and shared by every process: saves merge this process's changes into
+    the file under a file lock, and the file is reloaded when another process changed it
+    """
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._changes: Dict[str, Optional[Dict[str, Any]]] = {}  # unsaved: path -> entry, None if removed
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._reload(force=True)
+
+    def _reload(self, force: bool = False):
+        """Load the file if another process changed it, keeping this process's unsaved changes (lock held)"""
+        now = time.time()
+        if not force and now - self._checked < RELOAD_CHECK_SECONDS:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.cache_file)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load probe cache: {e}")
+            return
+        self._mtime = mtime
+        for path, entry in self._changes.items():
+            if entry is None:
+                entries.pop(path, None)
+            else:
+                entries[path] = entry
+        self._entries = entries
+
+    def _save(self):
+        """Merge unsaved changes into the file under the file lock (lock held)"""
+        with open(f"{self.cache_file}.lock", "a+") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._reload(force=True)
+                tmp_file = f"{self.cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(self._entries, f)
+                os.replace(tmp_file, self.cache_file)
+                self._mtime = os.path.getmtime(self.cache_file)
+                self._changes.clear()
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Tuple[int, float]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def get(self, path: str, stat: Tuple[int, float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached probe result if the file has not changed since it was probed.
+        Callers that already know the file's (size, mtime) can pass it to skip the stat.
+        """
+        stat = stat or self._stat(path)
+        if not stat:
+            return None
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(os.path.abspath(path))
+        if entry and entry["size"] == stat[0] and entry["mtime"] == stat[1]:
+            return entry["probe"]
+        return None
+
+    def put(self, path: str, probe: Optional[Dict[str, Any]], persist: bool = True):
+        """Store a probe result for the current version of a file"""
+        stat = self._stat(path)
+        if not stat:
+            return
+        with self._lock:
+            key = os.path.abspath(path)
+            self._entries[key] = self._changes[key] = {
+                "size": stat[0],
+                "mtime": stat[1],
+                "probe": probe,
+            }
+            if persist:
+                self._save_logged()
+
+    def flush(self):
+        """Write this process's unsaved results to disk"""
+        with self._lock:
+            if self._changes:
+                self._save_logged()
+
+    def _save_logged(self):
+        try:
+            self._save()
+        except OSError as e:
+            print(f"Could not save probe cache: {e}")
+
+    def move(self, src: str, dst: str):
+        """Carry a cached result over to a file's new path after a rename"""
+        with self._lock:
+            entry = self._entries.pop(os.path.abspath(src), None)
+            if entry is None:
+                return
+            self._changes[os.path.abspath(src)] = None
+            self._entries[os.path.abspath(dst)] = self._changes[os.path.abspath(dst)] = entry
+            self._save_logged()
+
+    def probe(self, path: str, persist: bool = True) -> Optional[Dict[str, Any]]:
+        """Return a probe result, running ffprobe only for new or changed files"""
+        cached = self.get(path)
+        if cached is not None:
+            return cached
+        probe = run_ffprobe(path)
+        self.put(path, probe if probe is not None else {"error": "unreadable"}, persist)
+        return probe
+
+
+_probe_caches: Dict[str, ProbeCache] = {}
+_probe_caches_lock = threading.Lock()
+
+def get_probe_cache(download_folder: str) -> ProbeCache:
+    """Return the shared probe cache for a download folder"""
+    key = os.path.abspath(download_folder)
+    with _probe_caches_lock:
+        if key not in _probe_caches:
+            cache_file = os.path.join(get_app_data_folder(download_folder), "probe_cache.json")
+            _probe_caches[key] = ProbeCache(cache_file)
+        return _probe_caches[key]
+
+
+def summarize_probe(probe: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Reduce an ffprobe result to the fields shown in the library"""
+    if not probe or "error" in probe:
+        return None
+    fmt = probe.get("format", {})
+    streams = probe.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+
+    def as_number(value, cast=float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        "duration": as_number(fmt.get("duration")),
+        "bit_rate": as_number(fmt.get("bit_rate"), int),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "video_codec": video.get("codec_name"),
+        "audio_codecs": [s.get("codec_name") for s in streams if s.get("codec_type") == "audio"],
+        "subtitles": [
+            {
+                "language": s.get("tags", {}).get("language"),
+                "title": s.get("tags", {}).get("title"),
+            }
+            for s in streams if s.get("codec_type") == "subtitle"
+        ],
+    }
+
+
+class ProbePool:
+    """
+    Background ffprobe workers that fill a ProbeCache for library listings.
+    Requests only read the cache and queue unknown files, so they never wait on ffprobe.
+    """
+    def __init__(self, cache: ProbeCache, workers: int = PROBE_WORKERS):
+        self.cache = cache
+        self.workers = workers
+        self.available = True
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def _start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"probe-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def lookup(self, path: str, stat: Tuple[int, float] = None) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """
+        Return (summary, pending) for a file from the cache.
+        Files not probed yet (or changed since) are queued and reported as pending.
+        """
+        probe = self.cache.get(path, stat)
+        if probe is not None:
+            return summarize_probe(probe), False
+        if not self.available:
+            return None, False
+        with self._lock:
+            if path not in self._pending:
+                self._pending.add(path)
+                self._start()
+                self._queue.put(path)
+        return None, True
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _work(self):
+        last_save = time.time()
+        dirty = False
+        while True:
+            try:
+                path = self._queue.get(timeout=PROBE_SAVE_INTERVAL)
+            except queue.Empty:
+                if dirty:
+                    self.cache.flush()
+                    dirty, last_save = False, time.time()
+                continue
+            try:
+                self.cache.probe(path, persist=False)
+                dirty = True
+            except FileNotFoundError:
+                if self.available:
+                    print("ffprobe not found; library media info is disabled")
+                self.available = False
+            except Exception as e:
+                print(f"Could not probe {path}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(path)
+            if dirty and time.time() - last_save >= PROBE_SAVE_INTERVAL:
+                self.cache.flush()
+                dirty, last_save = False, time.time()
+
+
+_probe_pools: Dict[str, ProbePool] = {}
+
+def get_probe_pool(download_folder: str) -> ProbePool:
+    """Return the background probe pool for a download folder"""
+    key = os.path.abspath(download_folder)
+    cache = get_probe_cache(download_folder)
+    with _probe_caches_lock:
+        if key not in _probe_pools:
+            _probe_pools[key] = ProbePool(cache)
+        return _probe_pools[key]
+
+
+def verify_media_file(path: str, cache: ProbeCache, persist: bool = True) -> Tuple[bool, str]:
+    """
+    Check that a downloaded episode is complete.
+    Returns (ok, reason). Falls back to a size-only check when ffprobe is not installed.
+    Callers verifying many files pass persist=False and flush the cache once afterwards.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False, "missing"
+    if size < MIN_EPISODE_SIZE:
+        return False, f"too small ({size} bytes)"
+
+    try:
+        probe = cache.probe(path, persist)
+    except FileNotFoundError:
+        return True, "size ok (ffprobe not available)"
+    if not probe or "error" in probe:
+        return False, "unreadable by ffprobe"
+
+    streams = probe.get("streams", [])
+    if not any(s.get("codec_type") == "video" for s in streams):
+        return False, "no video stream"
+    if not any(s.get("codec_type") == "audio" for s in streams):
+        return False, "no audio stream"
+
+    try:
+        duration = float(probe.get("format", {}).get("duration", 0))
+    except (TypeError, ValueError):
+        duration = 0
+    if duration <= 0:
+        return False, "no duration"
+
+    for stream in streams:
+        if stream.get("codec_type") != "video":
+            continue
+        try:
+            stream_duration = float(stream.get("duration", 0))
+        except (TypeError, ValueError):
+            continue
+        if stream_duration and stream_duration < duration * (1 - DURATION_TOLERANCE):
+            return False, f"video stream truncated ({stream_duration:.0f}s of {duration:.0f}s)"
+
+    return True, f"ok ({duration:.0f}s)"
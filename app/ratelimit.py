@@ -0,0 +1,202 @@
+"""
+Upstream Rate Limiting
+Token buckets per upstream host, applied to every request of the shared
+upstream session. Limits are configured in one place (UPSTREAM_RATE_LIMITS) and,
+once a state folder is set, the buckets are shared by all processes through
+flock-protected state files so concurrent jobs and searches draw from the same budget.
+
+Requests reserve a token and sleep until it is due, so waiting requests are
+served in arrival order and the bucket never bursts above its size.
+"""
+import collections
+import json
+import os
+import threading
+import time
+from typing import Deque, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from app.mirrors import mirror_pool
+
+try:
+    import fcntl
+except ImportError:  # Windows: buckets are per process
+    fcntl = None
+
+# host -> (requests per second, burst)
+DEFAULT_RATE_LIMITS = {
+    "anikai.to": (5.0, 10),
+    "enc-dec.app": (3.0, 6),
+}
+
+# Recent waits kept per host for percentiles
+WAIT_SAMPLES = 500
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, int]]:
+    """
+    Parse "host=rate[:burst],..." (e.g. "anikai.to=5:10,enc-dec.app=3").
+    A rate of 0 removes the limit for that host. Mirrors of the site (see
+    app.mirrors) without a limit of their own get the canonical host's.
+    """
+    limits = dict(DEFAULT_RATE_LIMITS)
+    removed = set()
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        host, _, value = item.partition("=")
+        rate, _, burst = value.partition(":")
+        try:
+            rate = float(rate)
+            burst = int(burst) if burst else max(1, int(rate * 2))
+        except ValueError:
+            print(f"Ignoring invalid rate limit '{item}'")
+            continue
+        if rate <= 0:
+            limits.pop(host.strip(), None)
+            removed.add(host.strip())
+        else:
+            limits[host.strip()] = (rate, burst)
+    canonical = limits.get(mirror_pool.canonical.host)
+    if canonical:
+        for mirror in mirror_pool.mirrors:
+            if mirror.host not in removed:
+                limits.setdefault(mirror.host, canonical)
+    return limits
+
+
+class TokenBucket:
+    """Token bucket whose state lives in memory, or in a locked file when shared"""
+    def __init__(self, rate: float, burst: int, state_path: str = None):
+        self.rate = rate
+        self.burst = burst
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def _reserve_from(self, tokens: float, updated: float, now: float) -> Tuple[float, float]:
+        """Take one token; returns (tokens left, seconds until the token is due)"""
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        return tokens, max(0.0, -tokens / self.rate)
+
+    def reserve(self) -> float:
+        """Reserve a token and return how long the caller must wait before using it"""
+        with self._lock:
+            now = time.time()
+            if not self.state_path or fcntl is None:
+                self._tokens, wait = self._reserve_from(self._tokens, self._updated, now)
+                self._updated = now
+                return wait
+
+            with open(self.state_path, "a+", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    tokens, wait = self._reserve_from(
+                        state.get("tokens", float(self.burst)), state.get("updated", now), now
+                    )
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({"tokens": tokens, "updated": now}))
+                    f.flush()
+                    return wait
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class HostStats:
+    """Wait statistics of one host in this process"""
+    def __init__(self):
+        self.requests = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent: Deque[float] = collections.deque(maxlen=WAIT_SAMPLES)
+
+    def record(self, wait: float):
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent.append(wait)
+        if wait > 0:
+            self.delayed += 1
+
+    def to_dict(self) -> Dict:
+        recent = sorted(self.recent)
+        percentile = lambda p: round(recent[min(len(recent) - 1, int(len(recent) * p))], 3) if recent else 0.0
+        return {
+            "requests": self.requests,
+            "delayed": self.delayed,
+            "total_wait_seconds": round(self.total_wait, 3),
+            "avg_wait_seconds": round(self.total_wait / self.requests, 3) if self.requests else 0.0,
+            "p50_wait_seconds": percentile(0.5),
+            "p95_wait_seconds": percentile(0.95),
+            "max_wait_seconds": round(self.max_wait, 3),
+        }
+
+
+class RateLimiter:
+    """Per-host token buckets for upstream requests"""
+    def __init__(self, limits: Dict[str, Tuple[float, int]]):
+        self.limits = limits
+        self.state_folder: Optional[str] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._stats: Dict[str, HostStats] = {}
+        self._lock = threading.Lock()
+
+    def share_state(self, folder: str):
+        """Keep bucket state in a folder so all processes using it share the limits"""
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            self.state_folder = folder
+            self._buckets.clear()
+
+    def _limited_host(self, url: str) -> Optional[str]:
+        host = (urlparse(url).hostname or "").lower()
+        for limited in self.limits:
+            if host == limited or host.endswith("." + limited):
+                return limited
+        return None
+
+    def _bucket(self, host: str) -> TokenBucket:
+        with self._lock:
+            if host not in self._buckets:
+                rate, burst = self.limits[host]
+                state_path = os.path.join(self.state_folder, f"{host}.bucket") if self.state_folder else None
+                self._buckets[host] = TokenBucket(rate, burst, state_path)
+                self._stats.setdefault(host, HostStats())
+            return self._buckets[host]
+
+    def acquire(self, url: str) -> float:
+        """Block until a request to url is allowed; returns the seconds waited"""
+        host = self._limited_host(url)
+        if host is None:
+            return 0.0
+        try:
+            wait = self._bucket(host).reserve()
+        except OSError as e:
+            print(f"Rate limiter state unavailable for {host}: {e}")
+            return 0.0
+        if wait > 0:
+            time.sleep(wait)
+        with self._lock:
+            self._stats[host].record(wait)
+        return wait
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                host: {
+                    "rate_per_second": rate,
+                    "burst": burst,
+                    "shared": self.state_folder is not None and fcntl is not None,
+                    **(self._stats[host].to_dict() if host in self._stats else HostStats().to_dict()),
+                }
+                for host, (rate, burst) in self.limits.items()
+            }
+
+
+rate_limiter = RateLimiter(parse_rate_limits(os.environ.get("UPSTREAM_RATE_LIMITS", "")))
@@ -0,0 +1,140 @@
+"""
+Cluster API Routes
+Task leasing, heartbeats, results and file uploads for remote download workers
+(see app.cluster), authenticated with the CLUSTER_TOKEN shared secret
+"""
+import hmac
+import os
+from functools import wraps
+from flask import Blueprint, jsonify, request, current_app
+from app.utils import login_required
+from app import cluster
+from app.library_index import get_library_index
+from app.probe import get_probe_cache, verify_media_file
+from app.staging import staging_path, publish_file, discard_staged
+
+cluster_bp = Blueprint('cluster', __name__, url_prefix='/api/cluster')
+
+# Bytes read per chunk of an uploaded episode
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def worker_auth_required(f):
+    """Decorator requiring the cluster token (Authorization: Bearer <token>)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not cluster.CLUSTER_TOKEN:
+            return jsonify({"error": "Cluster mode is disabled (set CLUSTER_TOKEN)"}), 404
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(token, cluster.CLUSTER_TOKEN):
+            return jsonify({"error": "Invalid cluster token"}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def task_target(task):
+    """Absolute path of a task's episode file on this server"""
+    download_folder = current_app.config['DOWNLOAD_FOLDER']
+    target = os.path.abspath(os.path.join(download_folder, *task['path'].split('/')))
+    if not target.startswith(os.path.abspath(download_folder) + os.sep):
+        raise ValueError("Task path outside the download folder")
+    return target
+
+
+@cluster_bp.route('/lease', methods=['POST'])
+@worker_auth_required
+def lease_tasks():
+    """Lease pending episode tasks to a worker"""
+    data = request.json or {}
+    worker_id = data.get('worker_id')
+    if not worker_id:
+        return jsonify({"error": "No worker_id provided"}), 400
+    info = {key: data.get(key) for key in ('host', 'slots', 'shared_storage')}
+    tasks = cluster.get_task_board(current_app.config['DOWNLOAD_FOLDER']).lease(
+        worker_id, int(data.get('max_tasks', 1)), info
+    )
+    return jsonify({"tasks": tasks, "lease_seconds": cluster.LEASE_SECONDS})
+
+
+@cluster_bp.route('/heartbeat', methods=['POST'])
+@worker_auth_required
+def heartbeat():
+    """Extend a worker's leases; reports the tasks it no longer holds"""
+    data = request.json or {}
+    lost = cluster.get_task_board(current_app.config['DOWNLOAD_FOLDER']).heartbeat(
+        data.get('worker_id', ''), data.get('task_ids', [])
+    )
+    return jsonify({"lost": lost})
+
+
+@cluster_bp.route('/tasks/<task_id>/file', methods=['PUT'])
+@worker_auth_required
+def upload_task_file(task_id):
+    """Receive the downloaded episode of a leased task, verify it and publish it to the library"""
+    download_folder = current_app.config['DOWNLOAD_FOLDER']
+    task = cluster.get_task_board(download_folder).holds_lease(task_id, request.headers.get('X-Worker-Id', ''))
+    if not task:
+        return jsonify({"error": "Task is not leased to this worker"}), 409
+
+    try:
+        target = task_target(task)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    staged = staging_path(download_folder, target)
+    try:
+        with open(staged, 'wb') as f:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        probe_cache = get_probe_cache(download_folder)
+        ok, reason = verify_media_file(staged, probe_cache)
+        if not ok:
+            return jsonify({"error": f"Uploaded file failed verification: {reason}"}), 422
+        publish_file(staged, target)
+        probe_cache.move(staged, target)
+        get_library_index(download_folder).invalidate()
+        return jsonify({"message": "File published", "size": os.path.getsize(target)})
+    except OSError as e:
+        return jsonify({"error": f"Could not store upload: {e}"}), 500
+    finally:
+        discard_staged(staged)
+
+
+@cluster_bp.route('/tasks/<task_id>/complete', methods=['POST'])
+@worker_auth_required
+def complete_task(task_id):
+    """Record a worker's result; a success is only accepted once the file is in the library"""
+    download_folder = current_app.config['DOWNLOAD_FOLDER']
+    board = cluster.get_task_board(download_folder)
+    data = request.json or {}
+    ok, error = bool(data.get('ok')), data.get('error')
+    task = board.holds_lease(task_id, data.get('worker_id', ''))
+    if not task:
+        return jsonify({"error": "Task is not leased to this worker", "accepted": False}), 409
+
+    if ok:
+        try:
+            target = task_target(task)
+            ok, reason = verify_media_file(target, get_probe_cache(download_folder))
+        except ValueError as e:
+            ok, reason = False, str(e)
+        if not ok:
+            error = f"File missing or broken on the coordinator: {reason}"
+
+    accepted = board.complete(task_id, data.get('worker_id', ''), ok, error, data.get('logs'))
+    if ok and accepted:
+        get_library_index(download_folder).invalidate()
+    return jsonify({"accepted": accepted, "ok": ok})
+
+
+@cluster_bp.route('/status', methods=['GET'])
+@login_required
+def cluster_status():
+    """Task counts and the workers seen by this coordinator"""
+    status = cluster.get_task_board(current_app.config['DOWNLOAD_FOLDER']).status()
+    status["enabled"] = bool(cluster.CLUSTER_TOKEN)
+    status["distribute"] = cluster.CLUSTER_DISTRIBUTE and bool(cluster.CLUSTER_TOKEN)
+    return jsonify(status)
@@ -2,99 +2,159 @@
 Library API Routes
 Handles listing and serving downloaded anime files
 """
-from flask import Blueprint, jsonify, send_file, current_app
+from flask import Blueprint, jsonify, send_file, current_app, request
 from datetime import datetime
 import os
-from app.utils import login_required
+from app.utils import is_hidden_entry, login_required
+from app.probe import get_probe_pool
+from app.library_index import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, SORT_KEYS, SeriesFiles, get_library_index, scan_media_files
+)
 
 library_bp = Blueprint('library', __name__, url_prefix='/api/library')
 
-def collect_media_files(base_path):
-    """Recursively collect media files under a directory."""
-    media_files = []
+def read_page_params():
+    """
+    Read the sort, filter and pagination query parameters shared by the listing endpoints.
+    Without `limit` or `cursor` the full (filtered, sorted) listing is returned.
+    """
+    sort = request.args.get('sort', 'name')
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Invalid sort '{sort}', expected one of: {', '.join(SORT_KEYS)}")
+    paginated = 'limit' in request.args or 'cursor' in request.args
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return {
+        "sort": sort,
+        "cursor": request.args.get('cursor') or None,
+        "limit": max(1, min(limit, MAX_PAGE_SIZE)) if paginated else None,
+        "prefix": request.args.get('prefix', ''),
+        "query": request.args.get('q', ''),
+        "paginated": paginated,
+    }
 
-    for root, _, files in os.walk(base_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            if not os.path.isfile(file_path):
-                continue
+def library_path(download_folder, relative_path):
+    """
+    Absolute path of a library entry, or None if it leaves the download folder or
+    goes through a hidden entry (.appdata holds cookies, keys and job state)
+    """
+    download_root = os.path.abspath(download_folder)
+    path = os.path.abspath(os.path.join(download_root, relative_path))
+    if not path.startswith(download_root + os.sep):
+        return None
+    if any(is_hidden_entry(part) for part in os.path.relpath(path, download_root).split(os.sep)):
+        return None
+    return path
 
-            relative_path = os.path.relpath(file_path, base_path).replace(os.sep, "/")
-            media_files.append({
-                "absolute_path": file_path,
-                "relative_path": relative_path,
-            })
-
-    media_files.sort(key=lambda item: item["relative_path"])
-    return media_files
+def page_of(view, params):
+    """Apply the requested window to a sorted view"""
+    limit = params["limit"] or max(1, len(view.entries))
+    return view.page(params["cursor"], limit, params["prefix"], params["query"])
 
 @library_bp.route('/list', methods=['GET'])
 @login_required
 def list_library():
-    """List all downloaded anime titles"""
+    """
+    List downloaded anime titles.
+    Supports ?sort=name|size|modified, ?prefix=, ?q= and cursor pagination via ?limit=&cursor=
+    """
+    try:
+        params = read_page_params()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     try:
-        library = []
         download_folder = current_app.config['DOWNLOAD_FOLDER']
-        
-        if os.path.exists(download_folder):
-            for anime_dir in os.listdir(download_folder):
-                anime_path = os.path.join(download_folder, anime_dir)
-                if os.path.isdir(anime_path):
-                    media_files = collect_media_files(anime_path)
-                    file_count = len(media_files)
-                    total_size = sum(os.path.getsize(file["absolute_path"]) for file in media_files)
-                    seasons = sorted({
-                        file["relative_path"].split("/", 1)[0]
-                        for file in media_files
-                        if "/" in file["relative_path"]
-                    })
-                    
-                    library.append({
-                        "name": anime_dir,
-                        "total_files": file_count,
-                        "total_size_mb": round(total_size / (1024 * 1024), 2),
-                        "seasons": seasons,
-                    })
-        
-        # Sort by name
-        library.sort(key=lambda x: x['name'])
-        return jsonify(library)
+        index = get_library_index(download_folder)
+        probe_pool = get_probe_pool(download_folder)
+        items, next_cursor, total = page_of(index.series_view(params["sort"]), params)
+
+        library = []
+        for series in items:
+            # Only the titles on this page are looked up in the probe cache
+            total_duration = 0
+            for file in index.series_files(series["name"]).files:
+                media, _ = probe_pool.lookup(file["absolute_path"], (file["size"], file["mtime"]))
+                if media and media["duration"]:
+                    total_duration += media["duration"]
+
+            library.append({
+                "name": series["name"],
+                "total_files": series["total_files"],
+                "total_size_mb": round(series["size"] / (1024 * 1024), 2),
+                "total_duration_seconds": int(total_duration),
+                "modified": datetime.fromtimestamp(series["mtime"]).isoformat(),
+                "seasons": series["seasons"],
+            })
+
+        if not params["paginated"]:
+            return jsonify(library)
+        return jsonify({
+            "items": library,
+            "next_cursor": next_cursor,
+            "total_matching": total,
+            "totals": index.totals(),
+        })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @library_bp.route('/anime/<path:anime_name>', methods=['GET'])
 @login_required
 def get_anime_files(anime_name):
-    """Get all files for a specific anime"""
+    """Get the files of a specific anime, with the same sorting, filtering and pagination as /list"""
+    try:
+        params = read_page_params()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     try:
         download_folder = current_app.config['DOWNLOAD_FOLDER']
-        anime_path = os.path.join(download_folder, anime_name)
-        
-        if not os.path.exists(anime_path) or not os.path.isdir(anime_path):
+        anime_path = library_path(download_folder, anime_name)
+
+        if not anime_path or not os.path.isdir(anime_path):
             return jsonify({"error": "Anime not found"}), 404
-        
+
+        series = get_library_index(download_folder).series_files(anime_name)
+        if series is None:
+            # Not in the current snapshot yet (new or nested folder): scan it directly
+            series = SeriesFiles(scan_media_files(anime_path))
+        items, next_cursor, total = page_of(series.view(params["sort"]), params)
+
+        probe_pool = get_probe_pool(download_folder)
         files = []
-        for media_file in collect_media_files(anime_path):
+        for media_file in items:
             file_path = media_file["absolute_path"]
-            size = os.path.getsize(file_path)
+            size = media_file["size"]
+            # Media info comes from the probe cache; unknown files are probed in the background
+            media, media_pending = probe_pool.lookup(file_path, (size, media_file["mtime"]))
             relative_path = media_file["relative_path"]
             season_folder = relative_path.split("/", 1)[0] if "/" in relative_path else None
             files.append({
-                "name": os.path.basename(file_path),
+                "name": media_file["name"],
                 "relative_path": relative_path,
                 "season_folder": season_folder,
                 "size": size,
                 "size_mb": round(size / (1024 * 1024), 2),
                 "size_gb": round(size / (1024 * 1024 * 1024), 2),
-                "modified": datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat()
+                "modified": datetime.fromtimestamp(media_file["mtime"]).isoformat(),
+                "media": media,
+                "media_pending": media_pending,
             })
         
-        return jsonify({
+        response = {
             "anime_name": anime_name,
             "files": files,
-            "total_files": len(files),
-            "total_size_mb": round(sum(f['size'] for f in files) / (1024 * 1024), 2)
-        })
+            "total_files": len(series.files),
+            "total_size_mb": round(series.total_size / (1024 * 1024), 2),
+            "media_pending": sum(1 for f in files if f['media_pending']),
+        }
+        if params["paginated"]:
+            response["next_cursor"] = next_cursor
+            response["total_matching"] = total
+        return jsonify(response)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -105,10 +165,8 @@ def download_file(relative_path):
     try:
         download_folder = current_app.config['DOWNLOAD_FOLDER']
 
-        filepath = os.path.abspath(os.path.join(download_folder, relative_path))
-        download_root = os.path.abspath(download_folder)
-
-        if not filepath.startswith(download_root + os.sep):
+        filepath = library_path(download_folder, relative_path)
+        if not filepath:
             return jsonify({"error": "Invalid file path"}), 400
 
         if os.path.isfile(filepath):
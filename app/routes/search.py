@@ -2,27 +2,86 @@
 Search API Routes
 Handles anime search on AnimeKai
 """
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, send_file, current_app
 from app.utils import login_required
 from app.search import search_anime
+from app.catalog import get_catalog
+from app.thumbnails import get_thumbnail_cache, verify_image_url
+
+# Cached posters never change for a given upstream URL
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
 
 search_bp = Blueprint('search', __name__, url_prefix='/api/search')
 
 @search_bp.route('/anime', methods=['GET'])
 @login_required
 def search_anime_api():
-    """Search for anime by keyword"""
-    query = request.args.get('q', '')
+    """
+    Search for anime by keyword from the local catalog (typo tolerant). Only a
+    query the catalog knows nothing about waits for upstream; stale ones are
+    refreshed in the background.
+    """
+    query = request.args.get('q', '').strip()
     
     if not query or len(query) < 2:
         return jsonify({"error": "Query must be at least 2 characters"}), 400
     
     try:
-        results = search_anime(query)
+        catalog = get_catalog(current_app.config['DOWNLOAD_FOLDER'])
+        results = catalog.search(query)
+        source, refreshing = "catalog", False
+        if not results:
+            catalog.refresh(query, search_anime)
+            results = catalog.search(query)
+            source = "upstream"
+        elif catalog.is_stale(query):
+            catalog.refresh_in_background(query, search_anime)
+            refreshing = True
         return jsonify({
             "query": query,
             "results": results,
-            "count": len(results)
+            "count": len(results),
+            "source": source,
+            "refreshing": refreshing,
+            "refreshed_at": catalog.last_refreshed(query),
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+@search_bp.route('/catalog', methods=['GET'])
+@login_required
+def catalog_stats():
+    """Size and sources of the local anime catalog"""
+    return jsonify(get_catalog(current_app.config['DOWNLOAD_FOLDER']).stats())
+
+@search_bp.route('/image', methods=['GET'])
+@login_required
+def search_image():
+    """Serve a search result poster from the local thumbnail cache"""
+    image_url = request.args.get('url', '')
+
+    if not image_url:
+        return jsonify({"error": "No image URL provided"}), 400
+
+    # Only posters listed by this server, never arbitrary URLs
+    if not verify_image_url(image_url, request.args.get('sig', '')):
+        return jsonify({"error": "Invalid image signature"}), 403
+
+    try:
+        cache = get_thumbnail_cache(current_app.config['DOWNLOAD_FOLDER'])
+        path, mimetype = cache.get(image_url)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Could not fetch image: {e}"}), 502
+
+    # The cache key is a stable ETag; the file's mtime moves on every hit (LRU clock)
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        max_age=THUMBNAIL_MAX_AGE,
+        conditional=True,
+        etag=cache.make_key(image_url),
+    )
+    response.headers['Cache-Control'] = f"private, max-age={THUMBNAIL_MAX_AGE}, immutable"
+    return response
@@ -0,0 +1,57 @@
+"""
+Subscription API Routes
+Manages subscriptions to airing series that are polled for new episodes
+"""
+from flask import Blueprint, jsonify, request
+from app.utils import login_required
+from app import subscriptions
+
+subscriptions_bp = Blueprint('subscriptions', __name__, url_prefix='/api/subscriptions')
+
+@subscriptions_bp.route('/list', methods=['GET'])
+@login_required
+def list_subscriptions():
+    """List all subscriptions and poller statistics"""
+    subs = subscriptions.subscription_store.list()
+    subs.sort(key=lambda s: (s.get('title') or s['anime_url']).lower())
+    return jsonify({
+        "subscriptions": subs,
+        "stats": subscriptions.subscription_poller.stats,
+    })
+
+@subscriptions_bp.route('/add', methods=['POST'])
+@login_required
+def add_subscription():
+    """Subscribe to a series"""
+    try:
+        data = request.json or {}
+        anime_url = data.get('anime_url')
+
+        if not anime_url:
+            return jsonify({"error": "No URL provided"}), 400
+
+        sub = subscriptions.subscription_store.add(anime_url, data)
+        subscriptions.subscription_poller.wake()
+        return jsonify(sub)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@subscriptions_bp.route('/<sub_id>', methods=['DELETE'])
+@login_required
+def remove_subscription(sub_id):
+    """Unsubscribe from a series"""
+    if subscriptions.subscription_store.remove(sub_id):
+        return jsonify({"message": "Subscription removed"})
+    return jsonify({"error": "Subscription not found"}), 404
+
+@subscriptions_bp.route('/<sub_id>/check', methods=['POST'])
+@login_required
+def check_subscription(sub_id):
+    """Poll a subscription right away"""
+    try:
+        sub = subscriptions.subscription_poller.poll(sub_id)
+        if not sub:
+            return jsonify({"error": "Subscription not found"}), 404
+        return jsonify(sub)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
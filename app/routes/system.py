@@ -0,0 +1,31 @@
+"""
+System API Routes
+Runtime diagnostics used to tune the server (upstream rate limits, cookie reuse, bandwidth)
+and download throughput history for capacity planning
+"""
+from flask import Blueprint, current_app, jsonify, request
+from app.bandwidth import bandwidth_manager
+from app.utils import login_required
+from app.upstream import upstream_stats
+from app.stats import DEFAULT_REPORT_HOURS, get_download_stats
+
+system_bp = Blueprint('system', __name__, url_prefix='/api/system')
+
+@system_bp.route('/upstream', methods=['GET'])
+@login_required
+def get_upstream_stats():
+    """Rate limiter wait times per upstream host, cookie reuse and warm-up state of this process"""
+    return jsonify(upstream_stats())
+
+@system_bp.route('/bandwidth', methods=['GET'])
+@login_required
+def get_bandwidth():
+    """Current bandwidth cap against the aggregate download throughput of all processes"""
+    return jsonify(bandwidth_manager.report())
+
+@system_bp.route('/stats', methods=['GET'])
+@login_required
+def get_download_stats_report():
+    """Download throughput per server and per hour over the last `hours` (default one week)"""
+    hours = request.args.get('hours', DEFAULT_REPORT_HOURS, type=int)
+    return jsonify(get_download_stats(current_app.config['DOWNLOAD_FOLDER']).report(hours))
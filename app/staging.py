@@ -0,0 +1,104 @@
+"""
+Download Staging Area
+Episodes are downloaded into a per-process staging folder inside the download
+folder (same filesystem as the library), verified, and then published into the
+library with an atomic rename, so library scans never see half-written files.
+"""
+import errno
+import glob
+import os
+import shutil
+
+from app.utils import get_app_data_folder, hold_instance_lock, instance_alive
+
+STAGING_DIR_NAME = "staging"
+
+# Copy buffer used when staging and library are on different filesystems
+COPY_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def get_staging_folder(download_folder: str) -> str:
+    """Staging folder owned by this process, named after its instance id and kept alive by its lock"""
+    root = get_app_data_folder(download_folder, STAGING_DIR_NAME)
+    return get_app_data_folder(download_folder, STAGING_DIR_NAME, hold_instance_lock(root))
+
+
+def staging_path(download_folder: str, target_path: str) -> str:
+    """Where to write a file before it is published to target_path"""
+    return os.path.join(get_staging_folder(download_folder), os.path.basename(target_path))
+
+
+def preallocate(fd: int, size: int) -> bool:
+    """
+    Reserve disk space for a file of known size so it is laid out contiguously.
+    Returns False where the platform or filesystem does not support it.
+    """
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError:
+        return False
+
+
+def write_preallocated(path: str, data: bytes):
+    """Write a file whose full size is known up front"""
+    with open(path, "wb") as f:
+        preallocate(f.fileno(), len(data))
+        f.write(data)
+
+
+def _copy_preallocated(src: str, dst: str):
+    size = os.path.getsize(src)
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        preallocate(fout.fileno(), size)
+        shutil.copyfileobj(fin, fout, COPY_CHUNK_BYTES)
+    shutil.copystat(src, dst)
+
+
+def publish_file(staged_path: str, target_path: str):
+    """
+    Atomically move a finished file from staging into the library.
+    Falls back to a preallocated copy plus rename when the two are on different filesystems.
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.replace(staged_path, target_path)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    folder, name = os.path.split(target_path)
+    tmp_path = os.path.join(folder, f".{name}.publishing")
+    try:
+        _copy_preallocated(staged_path, tmp_path)
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    os.remove(staged_path)
+
+
+def discard_staged(path: str):
+    """Remove a staged file and its scratch files (temp video, subtitles, yt-dlp parts)"""
+    base, _ = os.path.splitext(path)
+    for scratch in glob.glob(f"{glob.escape(base)}*"):
+        try:
+            os.remove(scratch)
+        except OSError:
+            pass
+
+
+def cleanup_orphaned_staging(download_folder: str) -> int:
+    """Delete staging folders left behind by processes that no longer exist (their lock can be taken)"""
+    root = get_app_data_folder(download_folder, STAGING_DIR_NAME)
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not os.path.isdir(path) or instance_alive(root, name):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    return removed
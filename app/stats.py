@@ -0,0 +1,209 @@
+"""
+Download Statistics
+Records every downloaded episode (size, duration, server, CDN host, retries)
+and aggregates them per server and per hour. Jobs estimate their remaining
+time from recent comparable episodes (same series and server when there are
+enough of them), and /api/system/stats reports sustained throughput per
+server and hour for capacity planning.
+
+The statistics are a JSON file under the download folder's app data, shared
+by every process: only the last MAX_EPISODE_RECORDS episodes are kept, and
+hourly aggregates for STATS_RETENTION_DAYS. Changes are made under a file lock.
+"""
+import collections
+import json
+import os
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process only
+    fcntl = None
+
+# Days hourly aggregates are kept
+STATS_RETENTION_DAYS = int(os.environ.get("STATS_RETENTION_DAYS", "90"))
+
+# Episode records kept for estimates; the oldest are dropped first
+MAX_EPISODE_RECORDS = 2000
+
+# Recent comparable episodes an estimate is based on, and the fewest it trusts
+ETA_SAMPLE_SIZE = 20
+ETA_MIN_SAMPLES = 3
+
+# Seconds between checks whether another process changed the stats file
+RELOAD_CHECK_SECONDS = 1.0
+
+# Default and largest window of the stats report
+DEFAULT_REPORT_HOURS = 168
+
+
+def _throughput_kbps(total_bytes: float, seconds: float) -> Optional[float]:
+    return round(total_bytes / seconds / 1024, 1) if seconds > 0 else None
+
+
+class DownloadStats:
+    """Episode records and per-server hourly aggregates of one download folder"""
+    def __init__(self, folder: str):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, "throughput.json")
+        self._lock = threading.RLock()
+        self._episodes: List[Dict[str, Any]] = []
+        self._hourly: Dict[str, Dict[str, Any]] = {}
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._reload(force=True)
+
+    def _reload(self, force: bool = False):
+        """Load the file if another process changed it"""
+        now = time.time()
+        if not force and now - self._checked < RELOAD_CHECK_SECONDS:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load download stats: {e}")
+            return
+        self._mtime = mtime
+        self._episodes = data.get("episodes", [])
+        self._hourly = data.get("hourly", {})
+
+    @contextmanager
+    def _update(self) -> Iterator[None]:
+        """Change the stats under the process and file locks, then write them"""
+        with self._lock, open(f"{self.path}.lock", "a+") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._reload(force=True)
+                yield
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"episodes": self._episodes, "hourly": self._hourly}, f)
+                os.replace(tmp_path, self.path)
+                self._mtime = os.path.getmtime(self.path)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def record_episode(self, series: str, episode: str, server: str, cdn_host: str, size: int,
+                       seconds: float, download_seconds: float, retries: int):
+        """
+        Record a downloaded episode: seconds covers resolving, downloading and
+        verifying it, download_seconds the transfer alone
+        """
+        now = time.time()
+        record = {
+            "time": now, "series": series, "episode": episode, "server": server, "cdn_host": cdn_host,
+            "bytes": size, "seconds": round(seconds, 2), "download_seconds": round(download_seconds, 2),
+            "retries": retries,
+        }
+        hour = int(now // 3600 * 3600)
+        with self._update():
+            self._episodes = (self._episodes + [record])[-MAX_EPISODE_RECORDS:]
+            bucket = self._hourly.setdefault(f"{hour}|{server}", {
+                "hour": hour, "server": server, "episodes": 0, "bytes": 0, "download_seconds": 0.0, "retries": 0,
+            })
+            bucket["episodes"] += 1
+            bucket["bytes"] += size
+            bucket["download_seconds"] = round(bucket["download_seconds"] + download_seconds, 2)
+            bucket["retries"] += retries
+            cutoff = now - STATS_RETENTION_DAYS * 86400
+            self._hourly = {k: b for k, b in self._hourly.items() if b["hour"] >= cutoff}
+
+    def estimate_episode_seconds(self, series: Optional[str] = None, server: Optional[str] = None) -> Optional[float]:
+        """
+        Median time of recent comparable episodes: of the same series and server,
+        else the same server (matched like the downloader's server preference), else any
+        """
+        with self._lock:
+            self._reload()
+            episodes = list(self._episodes)
+        if not episodes:
+            return None
+        server = (server or "").lower()
+        tiers = [
+            [e for e in episodes if e["series"] == series and server in e["server"].lower()],
+            [e for e in episodes if server in e["server"].lower()],
+            episodes,
+        ]
+        for candidates in tiers:
+            if len(candidates) >= ETA_MIN_SAMPLES or candidates is episodes:
+                return statistics.median(e["seconds"] for e in candidates[-ETA_SAMPLE_SIZE:])
+        return None
+
+    def report(self, hours: int = DEFAULT_REPORT_HOURS) -> Dict[str, Any]:
+        """Throughput per server and per hour over the last hours, and over the last day against that"""
+        hours = max(1, min(hours, STATS_RETENTION_DAYS * 24))
+        now = time.time()
+        since = now - hours * 3600
+        with self._lock:
+            self._reload()
+            buckets = [dict(b) for b in self._hourly.values() if b["hour"] >= since - 3600]
+            episodes = [e for e in self._episodes if e["time"] >= since]
+
+        servers: Dict[str, Dict[str, Any]] = {}
+        series: Dict[int, Dict[str, Any]] = {}
+        for bucket in buckets:
+            for totals in (
+                servers.setdefault(bucket["server"], {
+                    "episodes": 0, "bytes": 0, "download_seconds": 0.0, "retries": 0,
+                    "recent_bytes": 0, "recent_download_seconds": 0.0,
+                }),
+                series.setdefault(bucket["hour"], {"episodes": 0, "bytes": 0, "download_seconds": 0.0, "retries": 0}),
+            ):
+                for key in ("episodes", "bytes", "download_seconds", "retries"):
+                    totals[key] += bucket[key]
+            if bucket["hour"] >= now - 86400 - 3600:
+                servers[bucket["server"]]["recent_bytes"] += bucket["bytes"]
+                servers[bucket["server"]]["recent_download_seconds"] += bucket["download_seconds"]
+
+        return {
+            "window_hours": hours,
+            "servers": {
+                name: {
+                    "episodes": t["episodes"],
+                    "downloaded_mb": round(t["bytes"] / (1024 * 1024), 1),
+                    "throughput_kbps": _throughput_kbps(t["bytes"], t["download_seconds"]),
+                    "last_day_throughput_kbps": _throughput_kbps(t["recent_bytes"], t["recent_download_seconds"]),
+                    "retries_per_episode": round(t["retries"] / t["episodes"], 2) if t["episodes"] else None,
+                }
+                for name, t in sorted(servers.items())
+            },
+            "hourly": [
+                {
+                    "hour": time.strftime("%Y-%m-%d %H:00", time.localtime(hour)),
+                    "episodes": t["episodes"],
+                    "downloaded_mb": round(t["bytes"] / (1024 * 1024), 1),
+                    "throughput_kbps": _throughput_kbps(t["bytes"], t["download_seconds"]),
+                }
+                for hour, t in sorted(series.items())
+            ],
+            "cdn_hosts": dict(collections.Counter(e["cdn_host"] for e in episodes).most_common()),
+            "episode_seconds_median": round(statistics.median(e["seconds"] for e in episodes)) if episodes else None,
+        }
+
+
+_stats: Dict[str, DownloadStats] = {}
+_stats_lock = threading.Lock()
+
+def get_download_stats(download_folder: str) -> DownloadStats:
+    """Return the download statistics of a download folder, loading them on first use"""
+    from app.utils import get_app_data_folder
+
+    folder = get_app_data_folder(download_folder, "stats")
+    with _stats_lock:
+        if folder not in _stats:
+            _stats[folder] = DownloadStats(folder)
+        return _stats[folder]
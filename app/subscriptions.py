@@ -0,0 +1,375 @@
+"""
+Series Subscriptions
+Server-side subscriptions for airing series and the background poller that
+enqueues newly released episodes
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process only
+    fcntl = None
+
+from app.downloader import AnimeDownloader
+from app.utils import get_app_data_folder, try_acquire_process_lock
+
+# Default time between two polls of the same subscription
+DEFAULT_INTERVAL_MINUTES = int(os.environ.get("SUBSCRIPTION_INTERVAL_MINUTES", "60"))
+
+# Each poll is rescheduled within +/- this fraction of the interval to spread load
+POLL_JITTER = 0.2
+
+# Minimum spacing between two upstream polls, so many due subscriptions don't burst
+MIN_POLL_SPACING_SECONDS = 2
+
+# Longest the poller sleeps before looking for due subscriptions again
+MAX_IDLE_SECONDS = 30
+
+# Hours an encoded episode list token (enc-dec.app) is reused before it is requested again
+TOKEN_CACHE_HOURS = 24
+
+# Seconds between checks whether another process changed the subscriptions file
+RELOAD_CHECK_SECONDS = 1.0
+
+
+def episode_fingerprint(episodes: List[Dict[str, Any]]) -> str:
+    """Hash the episode ids and tokens so unchanged episode lists can be detected cheaply"""
+    digest = hashlib.sha1()
+    for ep in sorted(episodes, key=lambda e: e["id"]):
+        digest.update(f"{ep['id']}:{ep['token']}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def next_poll_time(interval_minutes: int, now: float = None) -> float:
+    """Schedule the next poll one interval from now, with jitter"""
+    now = now if now is not None else time.time()
+    interval = interval_minutes * 60
+    return now + interval * (1 + random.uniform(-POLL_JITTER, POLL_JITTER))
+
+
+class SubscriptionStore:
+    """
+    Thread-safe subscription storage persisted as JSON and shared by every
+    server process: changes are made under a file lock and other processes
+    reload the file when it changes
+    """
+    def __init__(self, store_file: str):
+        self.store_file = store_file
+        self._lock = threading.RLock()
+        self._subscriptions: Dict[str, Dict[str, Any]] = {}
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._reload(force=True)
+
+    def _reload(self, force: bool = False):
+        """Load the file if another process changed it"""
+        now = time.time()
+        if not force and now - self._checked < RELOAD_CHECK_SECONDS:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.store_file)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.store_file, "r", encoding="utf-8") as f:
+                self._subscriptions = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load subscriptions: {e}")
+            return
+        self._mtime = mtime
+
+    @contextmanager
+    def _update(self) -> Iterator[None]:
+        """Change the subscriptions under the process and file locks, then write them"""
+        with self._lock, open(f"{self.store_file}.lock", "a+") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._reload(force=True)
+                yield
+                tmp_file = f"{self.store_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(self._subscriptions, f, indent=2)
+                os.replace(tmp_file, self.store_file)
+                self._mtime = os.path.getmtime(self.store_file)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._reload()
+            return [dict(sub) for sub in self._subscriptions.values()]
+
+    def get(self, sub_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._reload()
+            sub = self._subscriptions.get(sub_id)
+            return dict(sub) if sub else None
+
+    def add(self, anime_url: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        """Create a subscription, polling it soon but not all at once"""
+        interval = int(options.get("interval_minutes") or DEFAULT_INTERVAL_MINUTES)
+        sub = {
+            "id": hashlib.sha1(anime_url.encode("utf-8")).hexdigest()[:12],
+            "anime_url": anime_url,
+            "anime_id": None,
+            "title": None,
+            "season_number": int(options.get("season_number", 0) or 0),
+            "prefer_type": options.get("prefer_type", "Soft Sub"),
+            "prefer_server": options.get("prefer_server", "Server 1"),
+            "interval_minutes": max(1, interval),
+            "enabled": True,
+            "fingerprint": None,
+            "missing_episodes": [],
+            "token_cache_hits": 0,
+            "list_cache_hits": 0,
+            "last_job_id": None,
+            "last_checked": None,
+            "last_changed": None,
+            "last_error": None,
+            "next_check": time.time() + random.uniform(0, 60),
+            "created": datetime.now().isoformat(),
+        }
+        with self._update():
+            existing = self._subscriptions.get(sub["id"])
+            if existing:
+                return dict(existing)
+            self._subscriptions[sub["id"]] = sub
+        return dict(sub)
+
+    def update(self, sub_id: str, **fields) -> Optional[Dict[str, Any]]:
+        with self._update():
+            sub = self._subscriptions.get(sub_id)
+            if not sub:
+                return None
+            sub.update(fields)
+        return dict(sub)
+
+    def remove(self, sub_id: str) -> bool:
+        with self._update():
+            if sub_id not in self._subscriptions:
+                return False
+            del self._subscriptions[sub_id]
+        return True
+
+    def due(self, now: float = None) -> List[Dict[str, Any]]:
+        """Return enabled subscriptions whose next poll time has passed, oldest first"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._reload()
+            subs = [
+                dict(sub) for sub in self._subscriptions.values()
+                if sub.get("enabled", True) and sub.get("next_check", 0) <= now
+            ]
+        subs.sort(key=lambda s: s.get("next_check", 0))
+        return subs
+
+    def seconds_until_next(self, now: float = None) -> float:
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._reload()
+            times = [
+                sub.get("next_check", 0) for sub in self._subscriptions.values()
+                if sub.get("enabled", True)
+            ]
+        if not times:
+            return MAX_IDLE_SECONDS
+        return max(0.0, min(times) - now)
+
+
+class SubscriptionPoller:
+    """
+    Background thread polling subscriptions one at a time through a shared session.
+    `enqueue(anime_url, episode_ids, sub, download_folder)` starts a download job and returns it.
+    `job_active(job_id)` tells whether a previously enqueued job is still running.
+    """
+    def __init__(self, store: SubscriptionStore, download_folder: str,
+                 enqueue: Callable[..., Any], job_active: Callable[[int], bool]):
+        self.store = store
+        self.download_folder = download_folder
+        self.enqueue = enqueue
+        self.job_active = job_active
+        self.downloader = AnimeDownloader()
+        self.stats = {"polls": 0, "unchanged": 0, "changed": 0, "errors": 0, "enqueued_episodes": 0,
+                      "token_cache_hits": 0, "list_cache_hits": 0}
+        self._wakeup = threading.Event()
+        self._poll_lock = threading.Lock()
+        self._thread = None
+        self._leader_lock = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="subscription-poller", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """Re-check due subscriptions immediately, e.g. after one was added"""
+        self._wakeup.set()
+
+    def _run(self):
+        # With several server processes only the one holding the lock polls
+        lock_path = os.path.join(get_app_data_folder(self.download_folder), "subscriptions.lock")
+        while self._leader_lock is None:
+            self._leader_lock = try_acquire_process_lock(lock_path)
+            if self._leader_lock is None:
+                time.sleep(MAX_IDLE_SECONDS)
+
+        while True:
+            for sub in self.store.due():
+                self.poll(sub["id"])
+                time.sleep(MIN_POLL_SPACING_SECONDS)
+            self._wakeup.wait(min(MAX_IDLE_SECONDS, self.store.seconds_until_next()))
+            self._wakeup.clear()
+
+    def _season_dir(self, sub: Dict[str, Any]) -> str:
+        return os.path.join(
+            self.download_folder,
+            self.downloader.generate_anime_folder_name(sub["title"]),
+            self.downloader.generate_season_folder_name(sub["season"]),
+        )
+
+    def _list_token(self, sub: Dict[str, Any], updates: Dict[str, Any], refresh: bool = False) -> Tuple[str, bool]:
+        """Encoded episode list token of the subscription, reused for TOKEN_CACHE_HOURS; returns (token, reused)"""
+        now = time.time()
+        if not refresh and sub.get("list_token") and now - sub.get("list_token_time", 0) < TOKEN_CACHE_HOURS * 3600:
+            self.stats["token_cache_hits"] += 1
+            updates["token_cache_hits"] = sub.get("token_cache_hits", 0) + 1
+            return sub["list_token"], True
+        enc = self.downloader.enc_kai(sub["anime_id"])
+        if not enc:
+            raise Exception("Could not encode the episode list request")
+        updates.update(list_token=enc, list_token_time=now)
+        return enc, False
+
+    def _fetch_episode_list(self, sub: Dict[str, Any], updates: Dict[str, Any]) -> Tuple[Optional[str], Dict[str, Any]]:
+        """
+        Episode list HTML and its validators (ETag, Last-Modified, content hash);
+        the HTML is None when upstream answers 304 or returns the same content as last time
+        """
+        refresh = False
+        while True:
+            enc, reused = self._list_token(sub, updates, refresh)
+            headers = dict(self.downloader.HEADERS)
+            if sub.get("list_etag"):
+                headers["If-None-Match"] = sub["list_etag"]
+            if sub.get("list_last_modified"):
+                headers["If-Modified-Since"] = sub["list_last_modified"]
+            r = self.downloader.scraper.get(
+                self.downloader.episode_list_url(sub["anime_id"], enc), headers=headers, timeout=30
+            )
+            if r.status_code == 304:
+                return None, {}
+            html = ""
+            if r.ok:
+                try:
+                    html = r.json().get("result", "")
+                except ValueError:
+                    pass
+            if html or not reused:
+                break
+            # The cached token may have gone stale
+            refresh = True
+        r.raise_for_status()
+        if not html:
+            raise Exception("No episodes found")
+        list_hash = hashlib.sha1(html.encode("utf-8")).hexdigest()
+        if list_hash == sub.get("list_hash"):
+            return None, {}
+        return html, {
+            "list_hash": list_hash,
+            "list_etag": r.headers.get("ETag"),
+            "list_last_modified": r.headers.get("Last-Modified"),
+        }
+
+    def poll(self, sub_id: str) -> Optional[Dict[str, Any]]:
+        """Poll one subscription and enqueue any episodes missing from the library"""
+        with self._poll_lock:
+            sub = self.store.get(sub_id)
+            if not sub:
+                return None
+            self.stats["polls"] += 1
+            now = time.time()
+            updates = {"last_checked": datetime.now().isoformat(),
+                       "next_check": next_poll_time(sub["interval_minutes"], now)}
+
+            # A job from the previous poll is still working through the missing episodes
+            if sub.get("last_job_id") and self.job_active(sub["last_job_id"]):
+                return self.store.update(sub_id, **updates)
+
+            try:
+                if not sub.get("anime_id"):
+                    anime_id, title = self.downloader.get_anime_details(sub["anime_url"])
+                    if not anime_id:
+                        raise Exception("Could not extract anime ID from URL")
+                    season = sub["season_number"] or self.downloader.detect_season_from_title(title)
+                    sub.update(anime_id=anime_id, title=title, season=season)
+                    updates.update(anime_id=anime_id, title=title, season=season)
+
+                html, validators = self._fetch_episode_list(sub, updates)
+                if html is None:
+                    # Same response as last poll: no parsing, the episode ids are kept from then
+                    self.stats["list_cache_hits"] += 1
+                    updates["list_cache_hits"] = sub.get("list_cache_hits", 0) + 1
+                    episode_ids = sub.get("episode_ids") or []
+                    fingerprint = sub.get("fingerprint")
+                else:
+                    episodes = self.downloader.parse_episode_list(html)
+                    if not episodes:
+                        raise Exception("No episodes found")
+                    episode_ids = [ep["id"] for ep in episodes]
+                    fingerprint = episode_fingerprint(episodes)
+                    updates.update(validators, episode_ids=episode_ids)
+
+                # Unchanged episode list and nothing left to fetch: no filesystem scan needed
+                if fingerprint == sub.get("fingerprint") and not sub.get("missing_episodes"):
+                    self.stats["unchanged"] += 1
+                    updates["last_error"] = None
+                    return self.store.update(sub_id, **updates)
+
+                self.stats["changed"] += 1
+                existing = self.downloader.find_existing_episodes(self._season_dir(sub), sub["season"])
+                missing = [
+                    ep_id for ep_id in episode_ids
+                    if self.downloader.format_episode_number(ep_id) not in existing
+                ]
+                updates.update(fingerprint=fingerprint, missing_episodes=missing, last_error=None)
+
+                if missing:
+                    job = self.enqueue(sub["anime_url"], missing, sub, self.download_folder)
+                    self.stats["enqueued_episodes"] += len(missing)
+                    updates.update(last_job_id=job.job_id, last_changed=datetime.now().isoformat())
+                    print(f"Subscription '{sub['title']}': enqueued {len(missing)} episode(s) as job #{job.job_id}")
+            except Exception as e:
+                self.stats["errors"] += 1
+                updates["last_error"] = str(e)
+                print(f"Subscription poll failed for {sub['anime_url']}: {e}")
+
+            return self.store.update(sub_id, **updates)
+
+
+subscription_store: Optional[SubscriptionStore] = None
+subscription_poller: Optional[SubscriptionPoller] = None
+
+def init_subscriptions(download_folder: str, enqueue: Callable[..., Any],
+                       job_active: Callable[[int], bool], start_poller: bool = True):
+    """Load the subscription store and start the background poller"""
+    global subscription_store, subscription_poller
+    store_file = os.path.join(get_app_data_folder(download_folder), "subscriptions.json")
+    subscription_store = SubscriptionStore(store_file)
+    subscription_poller = SubscriptionPoller(subscription_store, download_folder, enqueue, job_active)
+    if start_poller:
+        subscription_poller.start()
+    return subscription_poller
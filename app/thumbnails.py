@@ -0,0 +1,223 @@
+"""
+Poster Thumbnail Cache
+Fetches search result posters from the upstream CDN once, stores resized
+thumbnails on disk and evicts the least recently used ones beyond a size budget.
+Resizing needs Pillow (imported on first resize); without it the original
+image is cached as is.
+
+Cache URLs carry an HMAC of the poster URL, so the route only fetches posters
+the server itself listed and can't be used to make arbitrary requests. The
+key is kept in the download folder's app data and shared by every process.
+"""
+import hashlib
+import hmac
+import io
+import os
+import secrets
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote, urlparse
+
+from app.upstream import BASE_URL, get_session
+from app.utils import get_app_data_folder
+
+# Route that serves cached posters
+THUMBNAIL_ROUTE = "/api/search/image"
+
+# Largest poster accepted from upstream
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+
+# Evict down to this fraction of the budget so eviction doesn't run on every insert
+EVICT_TARGET_RATIO = 0.9
+
+# No User-Agent: the upstream session sends the one its clearance cookies are bound to
+HEADERS = {
+    "Referer": f"{BASE_URL}/",
+    "Accept": "image/avif,image/webp,image/*,*/*;q=0.8",
+}
+
+
+_signing_key: Optional[bytes] = None
+
+def configure_thumbnails(download_folder: str):
+    """Load the key signing thumbnail URLs, creating it on first use (idempotent)"""
+    global _signing_key
+    path = os.path.join(get_app_data_folder(download_folder), "thumbnail_key")
+    if not os.path.exists(path):
+        # Link a complete key into place so concurrent processes agree on one
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_bytes(32))
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, "rb") as f:
+        _signing_key = f.read()
+
+
+def sign_image_url(image_url: str) -> Optional[str]:
+    if _signing_key is None:
+        return None
+    return hmac.new(_signing_key, image_url.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def verify_image_url(image_url: str, signature: str) -> bool:
+    expected = sign_image_url(image_url)
+    return expected is not None and hmac.compare_digest(expected, signature or "")
+
+
+def thumbnail_url(image_url: str) -> str:
+    """
+    Rewrite an upstream poster URL to go through the local thumbnail cache
+    (left as is until configure_thumbnails has loaded the signing key)
+    """
+    if not image_url or urlparse(image_url).scheme not in ("http", "https"):
+        return image_url
+    signature = sign_image_url(image_url)
+    if signature is None:
+        return image_url
+    return f"{THUMBNAIL_ROUTE}?url={quote(image_url, safe='')}&sig={signature}"
+
+
+class ThumbnailCache:
+    """Size-bounded LRU cache of poster thumbnails on disk"""
+    def __init__(self, folder: str, max_bytes: int, width: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.width = width
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._total_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(folder) if entry.is_file()
+        )
+
+    @staticmethod
+    def make_key(url: str) -> str:
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.img")
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, url: str) -> Tuple[str, str]:
+        """
+        Return (path, mimetype) of the cached thumbnail, fetching it on first use.
+        Concurrent requests for the same poster wait for a single fetch.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc:
+            raise ValueError("Invalid image URL")
+
+        key = self.make_key(url)
+        path = self._path(key)
+        with self._key_lock(key):
+            if os.path.exists(path):
+                # Touch on hit: mtime is the LRU clock
+                os.utime(path, None)
+            else:
+                self._store(path, self._fetch(url))
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return path, self._mimetype(path)
+
+    def _fetch(self, url: str) -> bytes:
+        r = get_session().get(url, headers=HEADERS, timeout=15, stream=True)
+        r.raise_for_status()
+        if not r.headers.get("Content-Type", "image/").startswith("image/"):
+            raise ValueError("Upstream response is not an image")
+        data = bytearray()
+        for chunk in r.iter_content(64 * 1024):
+            data.extend(chunk)
+            if len(data) > MAX_SOURCE_BYTES:
+                raise ValueError("Image too large")
+        return self._resize(bytes(data))
+
+    def _resize(self, data: bytes) -> bytes:
+        """Shrink to the thumbnail width as JPEG; keep the original if it can't be decoded"""
+        try:
+            from PIL import Image
+        except ImportError:
+            return data
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                if img.width <= self.width:
+                    return data
+                img.thumbnail((self.width, self.width * 4))
+                out = io.BytesIO()
+                img.convert("RGB").save(out, "JPEG", quality=82, optimize=True)
+                return out.getvalue()
+        except Exception as e:
+            print(f"Could not resize thumbnail: {e}")
+            return data
+
+    def _store(self, path: str, data: bytes):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total_bytes += len(data)
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict(keep=path)
+
+    def evict(self, keep: str = None):
+        """Delete least recently used thumbnails until the cache is back under budget"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.is_file() and entry.name.endswith(".img"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * EVICT_TARGET_RATIO
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._total_bytes = total
+
+    @staticmethod
+    def _mimetype(path: str) -> str:
+        with open(path, "rb") as f:
+            head = f.read(12)
+        if head.startswith(b"\x89PNG"):
+            return "image/png"
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "image/webp"
+        if head.startswith(b"GIF8"):
+            return "image/gif"
+        return "image/jpeg"
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"total_bytes": self._total_bytes, "max_bytes": self.max_bytes}
+
+
+thumbnail_cache: Optional[ThumbnailCache] = None
+_init_lock = threading.Lock()
+
+def get_thumbnail_cache(download_folder: str) -> ThumbnailCache:
+    """Return the shared thumbnail cache, creating it on first use"""
+    global thumbnail_cache
+    with _init_lock:
+        if thumbnail_cache is None:
+            thumbnail_cache = ThumbnailCache(
+                get_app_data_folder(download_folder, "thumbnails"),
+                max_bytes=int(os.environ.get("THUMBNAIL_CACHE_MB", "200")) * 1024 * 1024,
+                width=int(os.environ.get("THUMBNAIL_WIDTH", "300")),
+            )
+        return thumbnail_cache
@@ -0,0 +1,215 @@
+"""
+Job Tracing
+Span timeline of a download job: one span per job phase, downloader call, HTTP
+request, subprocess and sleep, tagged with the episode and attempt they belong
+to. Exported as Chrome trace-event JSON (chrome://tracing, ui.perfetto.dev) to
+see where a slow job spends its time.
+
+The tracer of a job is bound to the thread running it, so instrumented code
+only needs span() and costs nothing outside a traced job. Each job keeps at
+most MAX_TRACE_EVENTS spans and writes its trace to the download folder's app
+data, so it can be served from any process and after the job has finished.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Optional
+
+# Spans kept per job; the oldest are dropped first
+MAX_TRACE_EVENTS = int(os.environ.get("MAX_TRACE_EVENTS", "20000"))
+
+# Seconds between writes of a running job's trace file
+TRACE_FLUSH_SECONDS = 5
+
+# Tracers kept in memory after their job finished
+MAX_TRACED_JOBS = 50
+
+# Trace files kept per folder; the oldest are removed when a new trace starts
+MAX_TRACE_FILES = 200
+
+_local = threading.local()
+
+
+class Tracer:
+    """Bounded span buffer of one job"""
+    def __init__(self, job_id: int, path: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None):
+        self.job_id = job_id
+        self.path = path
+        self.metadata = metadata or {}
+        self.events: Deque[Dict[str, Any]] = collections.deque(maxlen=MAX_TRACE_EVENTS)
+        self.dropped = 0
+        self._threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def record(self, name: str, cat: str, start: float, duration: float, args: Dict[str, Any]):
+        """Add a completed span (times in seconds since the epoch)"""
+        thread = threading.current_thread()
+        tid = threading.get_native_id()
+        with self._lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append({
+                "name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": tid,
+                "ts": int(start * 1_000_000), "dur": max(1, int(duration * 1_000_000)), "args": args,
+            })
+            self._threads.setdefault(tid, thread.name)
+        if self.path and time.time() - self._last_flush >= TRACE_FLUSH_SECONDS:
+            self.flush()
+
+    def export(self) -> Dict[str, Any]:
+        """Chrome trace-event JSON of the job"""
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+            dropped = self.dropped
+        names = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        return {
+            "traceEvents": names + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"job_id": self.job_id, "dropped_events": dropped, **self.metadata},
+        }
+
+    def flush(self):
+        """Write the trace file so other processes can serve it"""
+        self._last_flush = time.time()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.export(), f, default=str)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not write trace of job {self.job_id}: {e}")
+
+
+_tracers: "collections.OrderedDict[int, Tracer]" = collections.OrderedDict()
+_tracers_lock = threading.Lock()
+
+def start_trace(job_id: int, trace_folder: Optional[str] = None, **metadata) -> Tracer:
+    """Create the tracer of a job, kept in memory and written to trace_folder/<job_id>.json"""
+    path = None
+    if trace_folder:
+        os.makedirs(trace_folder, exist_ok=True)
+        path = os.path.join(trace_folder, f"{job_id}.json")
+        prune_trace_files(trace_folder, MAX_TRACE_FILES - 1)
+    tracer = Tracer(job_id, path, metadata)
+    with _tracers_lock:
+        _tracers[job_id] = tracer
+        while len(_tracers) > MAX_TRACED_JOBS:
+            _tracers.popitem(last=False)
+    return tracer
+
+
+def prune_trace_files(trace_folder: str, keep: int):
+    """Remove all but the newest `keep` trace files of a folder"""
+    try:
+        entries = [e for e in os.scandir(trace_folder) if e.name.endswith(".json") and e.is_file()]
+    except OSError:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    for entry in entries[keep:]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def get_trace(job_id: int, trace_folder: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Trace of a job from this process, or from the file written by the process that ran it"""
+    with _tracers_lock:
+        tracer = _tracers.get(job_id)
+    if tracer is not None:
+        return tracer.export()
+    if trace_folder:
+        try:
+            with open(os.path.join(trace_folder, f"{job_id}.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def remove_trace(job_id: int, trace_folder: Optional[str] = None):
+    with _tracers_lock:
+        _tracers.pop(job_id, None)
+    if trace_folder:
+        try:
+            os.remove(os.path.join(trace_folder, f"{job_id}.json"))
+        except OSError:
+            pass
+
+
+def current_tracer() -> Optional[Tracer]:
+    return getattr(_local, "tracer", None)
+
+
+@contextmanager
+def activate(tracer: Tracer) -> Iterator[Tracer]:
+    """Bind a tracer to the current thread; its trace file is written when the block ends"""
+    previous, previous_args = current_tracer(), getattr(_local, "args", {})
+    _local.tracer, _local.args = tracer, {}
+    try:
+        yield tracer
+    finally:
+        _local.tracer, _local.args = previous, previous_args
+        if tracer.path:
+            tracer.flush()
+
+
+@contextmanager
+def context(**args) -> Iterator[None]:
+    """Attach arguments (e.g. episode, attempt) to every span started inside the block"""
+    previous = getattr(_local, "args", {})
+    _local.args = {**previous, **args}
+    try:
+        yield
+    finally:
+        _local.args = previous
+
+
+@contextmanager
+def span(name: str, cat: str, **args) -> Iterator[Dict[str, Any]]:
+    """
+    Time the block as a span of the current job. Yields the span's arguments so the
+    block can add results (e.g. a status code); a no-op outside a traced job.
+    """
+    tracer = current_tracer()
+    if tracer is None:
+        yield args
+        return
+    args = {**getattr(_local, "args", {}), **args}
+    start = time.time()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = repr(e)
+        raise
+    finally:
+        tracer.record(name, cat, start, time.time() - start, args)
+
+
+def record_span(name: str, cat: str, start: float, duration: float, **args):
+    """Add a span measured by the caller, e.g. a wait that is only known afterwards"""
+    tracer = current_tracer()
+    if tracer is not None:
+        tracer.record(name, cat, start, duration, {**getattr(_local, "args", {}), **args})
+
+
+def traced(cat: str):
+    """Decorator recording every call of a function as a span named after it"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_tracer() is None:
+                return func(*args, **kwargs)
+            with span(func.__name__, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,234 @@
+"""
+Post-Download Transcoding
+Optional stage that re-encodes or remuxes finished episodes into a configured
+profile. Encodes run as low-priority ffmpeg processes (nice/ionice), and at most
+TRANSCODE_WORKERS of them run at once across all server and worker processes,
+so downloads keep their network and disk bandwidth while encoding happens.
+The library file is only replaced once the encoded copy passes verification.
+"""
+import os
+import shutil
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from app import cancellation
+from app.probe import DURATION_TOLERANCE, get_probe_cache, verify_media_file
+from app.staging import discard_staged, publish_file, staging_path
+from app.utils import get_app_data_folder, try_acquire_process_lock
+
+# Number of encodes allowed to run at the same time
+TRANSCODE_WORKERS = max(1, int(os.environ.get("TRANSCODE_WORKERS", "1")))
+
+# Encoder threads per encode (0 = let ffmpeg decide)
+TRANSCODE_THREADS = int(os.environ.get("TRANSCODE_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+# CPU priority of encodes (nice value, 0-19)
+TRANSCODE_NICE = int(os.environ.get("TRANSCODE_NICE", "10"))
+
+# Profile applied to jobs that don't choose one (empty = no transcoding)
+DEFAULT_PROFILE = os.environ.get("TRANSCODE_PROFILE", "")
+
+# Seconds between attempts to get an encode slot held by another process
+SLOT_RETRY_SECONDS = 2
+
+# Streams carried over from the source: video, audio and any subtitle tracks
+STREAM_ARGS = ["-map", "0:v", "-map", "0:a", "-map", "0:s?", "-c:s", "copy"]
+
+PROFILES: Dict[str, Dict] = {
+    "remux": {
+        "description": "Remux into a fresh MP4 (no re-encode)",
+        "args": ["-c:v", "copy", "-c:a", "copy"],
+        "encodes": False,
+    },
+    "hevc": {
+        "description": "HEVC (x265) CRF 26, audio copied",
+        "args": ["-c:v", "libx265", "-crf", "26", "-preset", "medium", "-tag:v", "hvc1", "-c:a", "copy"],
+        "encodes": True,
+    },
+    "hevc-small": {
+        "description": "HEVC (x265) CRF 30, smallest files",
+        "args": ["-c:v", "libx265", "-crf", "30", "-preset", "slow", "-tag:v", "hvc1", "-c:a", "copy"],
+        "encodes": True,
+    },
+    "h264": {
+        "description": "H.264 (x264) CRF 23, audio copied",
+        "args": ["-c:v", "libx264", "-crf", "23", "-preset", "medium", "-c:a", "copy"],
+        "encodes": True,
+    },
+}
+
+
+def probe_duration(probe: Optional[Dict]) -> float:
+    try:
+        return float((probe or {}).get("format", {}).get("duration", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def low_priority_prefix() -> List[str]:
+    """Command prefix running a process at idle I/O and reduced CPU priority"""
+    prefix = []
+    if shutil.which("ionice"):
+        prefix += ["ionice", "-c", "3"]
+    if shutil.which("nice"):
+        prefix += ["nice", "-n", str(TRANSCODE_NICE)]
+    return prefix
+
+
+def build_command(source: str, output: str, profile: Dict) -> List[str]:
+    args = list(profile["args"])
+    if profile["encodes"] and TRANSCODE_THREADS > 0:
+        if "libx265" in args:
+            args += ["-x265-params", f"pools={TRANSCODE_THREADS}"]
+        else:
+            args += ["-threads", str(TRANSCODE_THREADS)]
+    return low_priority_prefix() + [
+        "ffmpeg", "-nostdin", "-y",
+        "-loglevel", "error",
+        "-i", source,
+        *STREAM_ARGS,
+        *args,
+        "-movflags", "+faststart",
+        "-progress", "pipe:1", "-nostats",
+        output,
+    ]
+
+
+class TranscodeResult:
+    """Outcome of transcoding one file"""
+    def __init__(self, ok: bool, reason: str, saved_bytes: int = 0):
+        self.ok = ok
+        self.reason = reason
+        self.saved_bytes = saved_bytes
+
+
+class TranscodeQueue:
+    """Bounded queue of ffmpeg encodes sharing a machine-wide slot limit"""
+    def __init__(self, download_folder: str, workers: int):
+        self.download_folder = download_folder
+        self.workers = workers
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+        self._slots_folder = get_app_data_folder(download_folder, "transcode")
+
+    def submit(self, path: str, profile_name: str,
+               on_progress: Callable[[int], None] = None,
+               cancel_token: Optional[cancellation.CancelToken] = None):
+        """
+        Queue a library file for transcoding and return a Future of its TranscodeResult.
+        on_progress receives whole percentages; cancelling cancel_token (the job's)
+        drops the encode from the queue or stops its ffmpeg.
+        """
+        return self._executor.submit(self._run, path, profile_name, on_progress, cancel_token)
+
+    def _acquire_slot(self, cancel_token: Optional[cancellation.CancelToken] = None):
+        """Block until one of the encode slots shared by all processes is free (None if cancelled meanwhile)"""
+        while True:
+            if cancel_token is not None and cancel_token.cancelled:
+                return None
+            for i in range(self.workers):
+                lock = try_acquire_process_lock(os.path.join(self._slots_folder, f"slot-{i}.lock"))
+                if lock:
+                    return lock
+            time.sleep(SLOT_RETRY_SECONDS)
+
+    def _run(self, path: str, profile_name: str, on_progress, cancel_token=None) -> TranscodeResult:
+        profile = PROFILES.get(profile_name)
+        if not profile:
+            return TranscodeResult(False, f"unknown profile '{profile_name}'")
+        if cancel_token is not None and cancel_token.cancelled:
+            return TranscodeResult(False, "job cancelled")
+
+        cache = get_probe_cache(self.download_folder)
+        try:
+            source_duration = probe_duration(cache.probe(path))
+        except FileNotFoundError:
+            return TranscodeResult(False, "ffprobe is not installed")
+        output = os.path.splitext(staging_path(self.download_folder, path))[0] + ".transcode.mp4"
+
+        slot = self._acquire_slot(cancel_token)
+        if slot is None:
+            return TranscodeResult(False, "job cancelled")
+        try:
+            if not self._encode(path, output, profile, source_duration, on_progress, cancel_token):
+                if cancel_token is not None and cancel_token.cancelled:
+                    return TranscodeResult(False, "job cancelled")
+                return TranscodeResult(False, "ffmpeg failed")
+
+            ok, reason = verify_media_file(output, cache)
+            if not ok:
+                return TranscodeResult(False, f"output failed verification: {reason}")
+            output_duration = probe_duration(cache.probe(output))
+            if source_duration and abs(output_duration - source_duration) > source_duration * DURATION_TOLERANCE:
+                return TranscodeResult(
+                    False, f"duration changed ({source_duration:.0f}s -> {output_duration:.0f}s)"
+                )
+
+            source_size = os.path.getsize(path)
+            output_size = os.path.getsize(output)
+            if profile["encodes"] and output_size >= source_size:
+                return TranscodeResult(True, "kept original (encoded file was not smaller)")
+
+            publish_file(output, path)
+            cache.move(output, path)
+            return TranscodeResult(True, f"ok ({profile_name})", source_size - output_size)
+        except OSError as e:
+            return TranscodeResult(False, str(e))
+        finally:
+            slot.close()
+            discard_staged(output)
+
+    @staticmethod
+    def _encode(source: str, output: str, profile: Dict, duration: float, on_progress,
+                cancel_token: Optional[cancellation.CancelToken] = None) -> bool:
+        cmd = build_command(source, output, profile)
+        try:
+            process = cancellation.start_process(
+                cmd, cancel_token, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+        except (FileNotFoundError, cancellation.JobCancelled):
+            return False
+
+        # Drain stderr in the background so ffmpeg never blocks on a full pipe
+        stderr_lines: List[str] = []
+        drain = threading.Thread(
+            target=lambda: stderr_lines.extend(process.stderr), daemon=True
+        )
+        drain.start()
+
+        last_percent = -1
+        for line in process.stdout:
+            key, _, value = line.strip().partition("=")
+            if key != "out_time_us" or not duration or not on_progress:
+                continue
+            try:
+                percent = min(99, int(int(value) / 1e6 / duration * 100))
+            except ValueError:
+                continue
+            if percent > last_percent:
+                last_percent = percent
+                on_progress(percent)
+
+        process.wait()
+        cancellation.finish_process(process, cancel_token)
+        drain.join(timeout=5)
+        if process.returncode != 0:
+            print(f"ffmpeg transcode failed: {''.join(stderr_lines[-5:]).strip()}")
+            return False
+        if on_progress:
+            on_progress(100)
+        return os.path.exists(output)
+
+
+transcode_queue: Optional[TranscodeQueue] = None
+_init_lock = threading.Lock()
+
+def get_transcode_queue(download_folder: str) -> TranscodeQueue:
+    """Return this process's transcode queue, creating it on first use"""
+    global transcode_queue
+    with _init_lock:
+        if transcode_queue is None:
+            transcode_queue = TranscodeQueue(download_folder, TRANSCODE_WORKERS)
+        return transcode_queue
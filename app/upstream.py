@@ -0,0 +1,312 @@
+"""
+Upstream Session
+One cloudscraper session per process, shared by the downloader, search and
+thumbnail fetches so the Cloudflare challenge is solved once and pooled
+connections to the site are reused. cloudscraper (and requests under it) is
+only imported when the session is first needed, and can be warmed up in the
+background at startup so the first user request doesn't pay for the challenge.
+
+Cookies (including cf_clearance) are persisted in the download folder's app
+data, so a solved challenge is reused by every process and survives restarts
+until the cookie expires. Every request passes through the per-host rate
+limiter in app.ratelimit, and requests to the site are routed to the mirror
+app.mirrors currently picks, failing over to another mirror when it is down;
+every attempt takes a token for the host it is sent to.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from app import tracing
+from app.bandwidth import bandwidth_manager
+from app.mirrors import FAILOVER_STATUSES, mirror_pool
+from app.ratelimit import rate_limiter
+from app.utils import get_app_data_folder
+
+BASE_URL = mirror_pool.canonical.base_url
+
+BROWSER = {"browser": "chrome", "platform": "windows", "desktop": True}
+
+# Connections kept open per upstream host
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", "16"))
+
+# Solve the challenge in the background at startup (UPSTREAM_WARMUP=0 to disable)
+UPSTREAM_WARMUP = os.environ.get("UPSTREAM_WARMUP", "1") == "1"
+
+WARMUP_TIMEOUT = 30
+
+# Cookies that prove a solved Cloudflare challenge
+CLEARANCE_COOKIES = ("cf_clearance",)
+
+# Seconds between checks for cookies saved by other processes
+COOKIE_REFRESH_SECONDS = 5
+
+_session = None
+_session_lock = threading.Lock()
+
+warmup_status: Dict[str, Any] = {"state": "idle", "seconds": None, "error": None}
+
+
+class CookieStore:
+    """
+    Thread-safe cookie jar persisted as JSON and shared by every upstream session.
+    The User-Agent is stored alongside because clearance cookies are bound to it.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._saved: Optional[Tuple] = None
+        self._file_mtime: Optional[float] = None
+        self._last_check = 0.0
+        self.stats = {"clearances_obtained": 0, "solves_avoided": 0, "cookies_loaded": 0}
+
+    @staticmethod
+    def _snapshot(session) -> Tuple:
+        now = time.time()
+        return tuple(sorted(
+            (c.domain, c.path, c.name, c.value, c.expires, c.secure)
+            for c in session.cookies
+            if c.expires is None or c.expires > now
+        ))
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load_into(self, session):
+        """Copy unexpired stored cookies (and their User-Agent) into a session"""
+        with self._lock:
+            data = self._read()
+            try:
+                self._file_mtime = os.path.getmtime(self.path)
+            except OSError:
+                self._file_mtime = None
+            now = time.time()
+            cookies = [c for c in data.get("cookies", []) if not c["expires"] or c["expires"] > now]
+            if not cookies:
+                return
+            if data.get("user_agent"):
+                session.headers["User-Agent"] = data["user_agent"]
+            had_clearance = self._has_clearance(session)
+            for c in cookies:
+                session.cookies.set(
+                    c["name"], c["value"], domain=c["domain"], path=c["path"],
+                    expires=c["expires"], secure=c["secure"],
+                )
+            self.stats["cookies_loaded"] += len(cookies)
+            if not had_clearance and any(c["name"] in CLEARANCE_COOKIES for c in cookies):
+                self.stats["solves_avoided"] += 1
+            self._saved = self._snapshot(session)
+
+    def refresh(self, session):
+        """Pick up cookies another process saved since this session last loaded them"""
+        now = time.time()
+        if now - self._last_check < COOKIE_REFRESH_SECONDS:
+            return
+        self._last_check = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._file_mtime:
+            self.load_into(session)
+
+    def save_from(self, session):
+        """Persist the session's cookies if they changed since the last save"""
+        snapshot = self._snapshot(session)
+        with self._lock:
+            if snapshot == self._saved:
+                return
+            previous = {(d, p, n): v for d, p, n, v, _, _ in (self._saved or ())}
+            for d, p, n, v, _, _ in snapshot:
+                if n in CLEARANCE_COOKIES and previous.get((d, p, n)) != v:
+                    self.stats["clearances_obtained"] += 1
+            data = {
+                "user_agent": session.headers.get("User-Agent"),
+                "cookies": [
+                    {"domain": d, "path": p, "name": n, "value": v, "expires": e, "secure": sec}
+                    for d, p, n, v, e, sec in snapshot
+                ],
+            }
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+                self._file_mtime = os.path.getmtime(self.path)
+            except OSError as e:
+                print(f"Could not save upstream cookies: {e}")
+                return
+            self._saved = snapshot
+
+    @staticmethod
+    def _has_clearance(session) -> bool:
+        return any(c.name in CLEARANCE_COOKIES for c in session.cookies)
+
+    def attach(self, session):
+        """Load stored cookies into a session and save them whenever a response changes them"""
+        self.load_into(session)
+        session.hooks["response"].append(lambda response, *args, **kwargs: self.save_from(session))
+
+
+cookie_store: Optional[CookieStore] = None
+
+def configure_upstream(download_folder: str):
+    """
+    Keep upstream cookies, rate limiter and bandwidth budget state under a
+    download folder, shared by every process using it (idempotent)
+    """
+    global cookie_store
+    path = os.path.join(get_app_data_folder(download_folder), "upstream_cookies.json")
+    with _session_lock:
+        if cookie_store is not None and cookie_store.path == path:
+            return
+        cookie_store = CookieStore(path)
+        rate_limiter.share_state(get_app_data_folder(download_folder, "ratelimit"))
+        bandwidth_manager.share_state(get_app_data_folder(download_folder, "bandwidth"))
+        if _session is not None:
+            cookie_store.attach(_session)
+
+
+def cookie_stats() -> Dict[str, int]:
+    return dict(cookie_store.stats) if cookie_store else {}
+
+
+def create_scraper():
+    """New cloudscraper session with a connection pool sized for concurrent jobs"""
+    import cloudscraper
+
+    scraper = cloudscraper.create_scraper(browser=BROWSER)
+    # Resize the existing adapters in place: the https one carries cloudscraper's TLS setup
+    for adapter in scraper.adapters.values():
+        adapter._pool_connections = UPSTREAM_POOL_SIZE
+        adapter._pool_maxsize = UPSTREAM_POOL_SIZE
+        adapter.init_poolmanager(UPSTREAM_POOL_SIZE, UPSTREAM_POOL_SIZE)
+    return scraper
+
+
+def _wrap_requests(session):
+    """
+    Run the rate limiter and cookie refresh before every request of a session,
+    route requests to the site to its current mirror, and trace all of it
+    """
+    send = session.request
+
+    def traced_send(method, url, *args, **kwargs):
+        parsed = urlparse(url)
+        with tracing.span(f"{method.upper()} {parsed.path}", f"http:{parsed.hostname}", url=url) as span:
+            response = send(method, url, *args, **kwargs)
+            span["status"] = response.status_code
+            if not kwargs.get("stream"):
+                span["bytes"] = len(response.content)
+            return response
+
+    def limit(url):
+        started = time.time()
+        waited = rate_limiter.acquire(url)
+        if waited:
+            tracing.record_span("rate limit", "wait", started, waited, host=urlparse(url).hostname)
+
+    def request(method, url, *args, **kwargs):
+        if cookie_store is not None:
+            cookie_store.refresh(session)
+        if mirror_pool.mirror_of(url) is None:
+            limit(url)
+            return traced_send(method, url, *args, **kwargs)
+
+        import requests
+
+        tried = set()
+        mirror = mirror_pool.current()
+        while True:
+            tried.add(mirror)
+            routed_url = mirror_pool.rewrite(url, mirror)
+            routed_kwargs = dict(kwargs, headers=mirror_pool.rewrite_headers(kwargs.get("headers"), mirror))
+            limit(routed_url)
+            sent = time.time()
+            try:
+                response = traced_send(method, routed_url, *args, **routed_kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                response, error = None, e
+            else:
+                if response.status_code not in FAILOVER_STATUSES:
+                    mirror_pool.report_success(mirror, time.time() - sent)
+                    return response
+                error = None
+            next_mirror = mirror_pool.report_failure(
+                mirror, str(error) if error else f"HTTP {response.status_code}"
+            )
+            if next_mirror in tried:
+                if response is not None:
+                    return response
+                raise error
+            print(f"Upstream mirror {mirror.base_url} failed, retrying on {next_mirror.base_url}")
+            mirror = next_mirror
+
+    session.request = request
+    # Unrouted and unlimited, for probing the mirrors themselves
+    session.request_direct = send
+
+
+def get_session():
+    """Return the shared upstream session of this process, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_scraper()
+            _wrap_requests(_session)
+            if cookie_store is not None:
+                cookie_store.attach(_session)
+            mirror_pool.start_probing(_session.request_direct)
+        return _session
+
+
+def user_agent() -> str:
+    """
+    User-Agent of the shared session (restored with its cookies). Clearance cookies
+    are bound to it, so callers never send their own.
+    """
+    return get_session().headers["User-Agent"]
+
+
+def warm_up(timeout: int = WARMUP_TIMEOUT) -> bool:
+    """Solve the Cloudflare challenge and open a pooled connection to the site"""
+    warmup_status.update(state="running", error=None)
+    started = time.time()
+    try:
+        get_session().get(BASE_URL, timeout=timeout).raise_for_status()
+        warmup_status.update(state="done")
+        return True
+    except Exception as e:
+        warmup_status.update(state="failed", error=str(e))
+        print(f"Upstream warm-up failed: {e}")
+        return False
+    finally:
+        warmup_status["seconds"] = round(time.time() - started, 2)
+
+
+def start_warm_up() -> Optional[threading.Thread]:
+    """Warm up the upstream session in a background thread if enabled"""
+    if not UPSTREAM_WARMUP:
+        return None
+    thread = threading.Thread(target=warm_up, name="upstream-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def upstream_stats() -> Dict[str, Any]:
+    """Rate limiter waits, mirror health, cookie reuse and warm-up state of this process"""
+    return {
+        "pid": os.getpid(),
+        "rate_limits": rate_limiter.stats(),
+        "mirrors": mirror_pool.stats(),
+        "cookies": cookie_stats(),
+        "warmup": dict(warmup_status),
+    }
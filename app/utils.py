@@ -1,12 +1,21 @@
 """
 Utility Functions and Decorators
 """
-from flask import session, redirect, url_for
 from functools import wraps
 import os
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 def login_required(f):
     """Decorator to require login for routes"""
+    # Imported here so the job code using this module also runs without the web app (app.cli)
+    from flask import session, redirect, url_for
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if not session.get('logged_in'):
@@ -18,3 +27,82 @@ def create_download_folder(folder_path):
     """Create downloads folder if it doesn't exist"""
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
+
+# Hidden folder inside the download folder for application state (caches, stores)
+APP_DATA_DIR_NAME = ".appdata"
+
+def get_app_data_folder(download_folder, *parts):
+    """Return (and create) a folder for application state inside the download folder"""
+    folder_path = os.path.join(download_folder, APP_DATA_DIR_NAME, *parts)
+    os.makedirs(folder_path, exist_ok=True)
+    return folder_path
+
+def is_hidden_entry(name):
+    """Hidden files and folders hold application state, not library media"""
+    return name.startswith(".")
+
+def try_acquire_process_lock(lock_path):
+    """
+    Take an exclusive, non-blocking lock held for the life of this process.
+    Returns the open lock file, or None if another process already holds it.
+    Without fcntl (Windows) the lock always succeeds.
+    """
+    lock_file = open(lock_path, "a+")
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+# (pid, instance id) of this process; regenerated in forked children
+_instance = None
+_instance_locks = {}
+_instance_lock = threading.Lock()
+
+def instance_id():
+    """
+    Id of this process that is unique across restarts. PIDs are not: a restarted
+    container usually gets the same PIDs as the previous one.
+    """
+    global _instance
+    with _instance_lock:
+        if _instance is None or _instance[0] != os.getpid():
+            _instance = (os.getpid(), f"{os.getpid()}-{uuid.uuid4().hex[:12]}")
+        return _instance[1]
+
+def hold_instance_lock(folder):
+    """Lock <folder>/<instance id>.lock for the life of this process; returns the instance id"""
+    iid = instance_id()
+    path = os.path.join(folder, f"{iid}.lock")
+    with _instance_lock:
+        if path not in _instance_locks:
+            os.makedirs(folder, exist_ok=True)
+            _instance_locks[path] = try_acquire_process_lock(path)
+    return iid
+
+def instance_alive(folder, iid):
+    """
+    Whether the process with this instance id still holds its lock in folder
+    (see hold_instance_lock). A dead instance's lock file is removed.
+    """
+    if not iid:
+        return False
+    if iid == instance_id():
+        return True
+    path = os.path.join(folder, f"{iid}.lock")
+    if not os.path.exists(path):
+        return False
+    if fcntl is None:  # Windows: a single server process only
+        return False
+    lock_file = try_acquire_process_lock(path)
+    if lock_file is None:
+        return True
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    lock_file.close()
+    return False
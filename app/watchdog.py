@@ -0,0 +1,132 @@
+"""
+Stall Watchdog
+Detects yt-dlp transfers that are still connected but barely moving, which
+--socket-timeout never catches while a CDN trickles a few KB/s. A transfer
+whose throughput stays below STALL_MIN_KBPS for STALL_WINDOW_SECONDS is
+stopped so the downloader can restart it; yt-dlp then resumes from its .part
+files instead of starting the episode over.
+
+Time a transfer spends held below the threshold by the bandwidth budget (see
+app.bandwidth) doesn't count towards a stall.
+"""
+import collections
+import os
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app import cancellation
+
+# Throughput in KB/s below which a transfer counts as stalled
+STALL_MIN_KBPS = float(os.environ.get("STALL_MIN_KBPS", "32"))
+
+# Seconds the throughput must stay below STALL_MIN_KBPS (0 disables the watchdog)
+STALL_WINDOW_SECONDS = int(os.environ.get("STALL_WINDOW_SECONDS", "120"))
+
+# Restarts of a stalled transfer before the download attempt is given up
+STALL_MAX_RESTARTS = int(os.environ.get("STALL_MAX_RESTARTS", "3"))
+
+# Seconds between throughput checks
+CHECK_INTERVAL = 2
+
+
+class StallDetector:
+    """Sliding-window throughput check of one transfer"""
+    def __init__(self, min_rate: float, window: float):
+        self.min_rate = min_rate  # bytes/s
+        self.window = window
+        self._samples: Deque[Tuple[float, int]] = collections.deque()
+
+    def reset(self):
+        self._samples.clear()
+
+    def observe(self, now: float, total_bytes: int, throttled: bool = False) -> bool:
+        """Add a sample of the transfer's byte count; True once it has stalled"""
+        if throttled:
+            # Slow on purpose: start a fresh window once it may run freely again
+            self.reset()
+            return False
+        self._samples.append((now, total_bytes))
+        while len(self._samples) > 1 and self._samples[1][0] <= now - self.window:
+            self._samples.popleft()
+        start, start_bytes = self._samples[0]
+        if now - start < self.window:
+            return False
+        return total_bytes - start_bytes < self.min_rate * (now - start)
+
+    def rate(self) -> float:
+        """Bytes/s over the current window"""
+        if len(self._samples) < 2:
+            return 0.0
+        (start, start_bytes), (end, end_bytes) = self._samples[0], self._samples[-1]
+        return (end_bytes - start_bytes) / (end - start) if end > start else 0.0
+
+
+class Watch:
+    """A transfer under the watchdog; `stall` is set once it was stopped for stalling"""
+    def __init__(self, transfer, label: str):
+        self.transfer = transfer
+        self.label = label
+        self.detector = StallDetector(STALL_MIN_KBPS * 1024, STALL_WINDOW_SECONDS)
+        self.stall: Optional[Dict[str, Any]] = None
+
+
+class StallWatchdog:
+    """Background thread checking the throughput of every watched transfer"""
+    def __init__(self):
+        self._watches: List[Watch] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return STALL_WINDOW_SECONDS > 0 and STALL_MIN_KBPS > 0
+
+    def watch(self, transfer, label: str) -> Watch:
+        """Watch a registered bandwidth Transfer, whose process runs in its own process group"""
+        watch = Watch(transfer, label)
+        if not self.enabled:
+            return watch
+        with self._lock:
+            self._watches.append(watch)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._loop, name="stall-watchdog", daemon=True)
+                self._thread.start()
+        return watch
+
+    def unwatch(self, watch: Watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _loop(self):
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            now = time.time()
+            with self._lock:
+                watches = list(self._watches)
+            for watch in watches:
+                transfer = watch.transfer
+                if watch.stall or transfer.process.poll() is not None:
+                    continue
+                # Short pauses under a budget above the threshold average out over the window
+                throttled = 0 < transfer.allowed < watch.detector.min_rate
+                if watch.detector.observe(now, transfer.bytes, throttled):
+                    self._stop(watch, now)
+
+    def _stop(self, watch: Watch, now: float):
+        watch.stall = {
+            "timestamp": time.strftime("%H:%M:%S", time.localtime(now)),
+            "episode": watch.label,
+            "rate_kbps": round(watch.detector.rate() / 1024, 1),
+            "window_seconds": STALL_WINDOW_SECONDS,
+            "downloaded_mb": round(watch.transfer.bytes / (1024 * 1024), 1),
+        }
+        print(f"Transfer of episode {watch.label} stalled at {watch.stall['rate_kbps']} KB/s, stopping it")
+        # Don't hold up the checks of other transfers during the grace period
+        threading.Thread(
+            target=cancellation.terminate_process_groups, args=([watch.transfer.process],), daemon=True
+        ).start()
+
+
+stall_watchdog = StallWatchdog()
@@ -0,0 +1,166 @@
+"""
+Download Worker Processes
+Runs download jobs in a pool of separate processes fed from a local job queue.
+Job progress and logs are streamed back to the server process over a queue.
+"""
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from datetime import datetime
+from typing import Dict, Optional
+
+from app.jobstore import FINISHED_STATUSES
+from app.models import DownloadJob
+
+# Seconds between checks for worker processes that died mid-job
+WORKER_MONITOR_SECONDS = 2
+
+
+def job_state(job: DownloadJob) -> Dict:
+    """Public attributes of a job that change while it runs"""
+    return {
+        key: value for key, value in vars(job).items()
+        if not key.startswith("_") and key not in ("job_id", "anime_url", "config", "logs", "start_time")
+    }
+
+
+class JobProxy(DownloadJob):
+    """Stand-in for a DownloadJob inside a worker process that reports every change back"""
+    def __init__(self, job_id, anime_url, config, events):
+        self._events = events
+        super().__init__(job_id, anime_url, config)
+
+    def add_log(self, level, message):
+        super().add_log(level, message)
+        self.publish(self.logs[-1])
+
+    def publish(self, log_entry=None):
+        """Send the current job state, and optionally a new log entry, to the server process"""
+        self._events.put(("update", self.job_id, job_state(self), log_entry))
+
+
+def worker_main(tasks, events):
+    """Entry point of a worker process: run jobs from the task queue until told to stop"""
+    from app.jobs import run_download_job
+    from app.upstream import configure_upstream
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, anime_url, config, download_folder = task
+        configure_upstream(download_folder)
+        events.put(("started", job_id, os.getpid(), None))
+        job = JobProxy(job_id, anime_url, config, events)
+        try:
+            run_download_job(job, download_folder)
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            job.end_time = datetime.now()
+            job.add_log("ERROR", traceback.format_exc())
+        job.publish()
+        events.put(("finished", job_id, os.getpid(), None))
+
+
+class WorkerPool:
+    """Pool of download worker processes and the thread applying their events to jobs"""
+    def __init__(self, num_workers: int, jobs: Dict[int, DownloadJob]):
+        self.num_workers = num_workers
+        self.jobs = jobs
+        self._ctx = multiprocessing.get_context("spawn")
+        self._tasks = self._ctx.Queue()
+        self._events = self._ctx.Queue()
+        self._processes = []
+        self._running: Dict[int, int] = {}  # pid -> job_id
+        self._lock = threading.Lock()
+
+    def start(self):
+        for _ in range(self.num_workers):
+            self._spawn_worker()
+        threading.Thread(target=self._apply_events, name="worker-events", daemon=True).start()
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+    def _spawn_worker(self):
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(self._tasks, self._events),
+            name="download-worker",
+            daemon=True,
+        )
+        process.start()
+        self._processes.append(process)
+
+    def submit(self, job: DownloadJob, download_folder: str):
+        """Queue a job for the next free worker process"""
+        job.status = "queued"
+        job.add_log("INFO", "Queued for a download worker")
+        self._tasks.put((job.job_id, job.anime_url, job.config, download_folder))
+
+    def _apply_events(self):
+        while True:
+            kind, job_id, payload, log_entry = self._events.get()
+            if kind == "started":
+                with self._lock:
+                    self._running[payload] = job_id
+                continue
+            if kind == "finished":
+                with self._lock:
+                    self._running.pop(payload, None)
+                continue
+
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            for key, value in payload.items():
+                setattr(job, key, value)
+            if log_entry:
+                job.logs.append(log_entry)
+                if len(job.logs) > 100:
+                    job.logs = job.logs[-100:]
+
+    def _monitor(self):
+        """Fail the jobs of crashed workers and replace those workers"""
+        while True:
+            time.sleep(WORKER_MONITOR_SECONDS)
+            for process in list(self._processes):
+                if process.is_alive():
+                    continue
+                self._processes.remove(process)
+                with self._lock:
+                    job_id = self._running.pop(process.pid, None)
+                job = self.jobs.get(job_id) if job_id is not None else None
+                if job and job.status not in FINISHED_STATUSES:
+                    job.status = "failed"
+                    job.error = f"Worker process exited with code {process.exitcode}"
+                    job.end_time = datetime.now()
+                    job.add_log("ERROR", f"Job failed: {job.error}")
+                print(f"Download worker {process.pid} exited ({process.exitcode}), starting a replacement")
+                self._spawn_worker()
+
+    def stats(self):
+        with self._lock:
+            running = dict(self._running)
+        try:
+            queued = self._tasks.qsize()
+        except NotImplementedError:
+            queued = None
+        return {
+            "workers": [
+                {"pid": p.pid, "alive": p.is_alive(), "job_id": running.get(p.pid)}
+                for p in self._processes
+            ],
+            "queued_jobs": queued,
+        }
+
+
+worker_pool: Optional[WorkerPool] = None
+
+def init_worker_pool(num_workers: int, jobs: Dict[int, DownloadJob]) -> WorkerPool:
+    """Start the download worker processes"""
+    global worker_pool
+    worker_pool = WorkerPool(num_workers, jobs)
+    worker_pool.start()
+    return worker_pool
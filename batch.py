@@ -0,0 +1,12 @@
+"""
+AnimeKai Downloader - Batch Entry Point
+Downloads the anime listed in a file without the web interface, e.g. from cron:
+    python batch.py urls.txt --parallel 4 > progress.ndjson
+See app/cli.py for the file format.
+"""
+import sys
+
+from app.cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
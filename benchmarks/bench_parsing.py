@@ -0,0 +1,83 @@
+"""
+Micro-benchmark for the HTML parsing backends
+Parses the saved fixture pages with each available backend and reports the
+parse time and peak Python heap allocated (tracemalloc; libxml2's own C buffers
+are not included), after checking both backends return the same data.
+
+Run from the repository root: python benchmarks/bench_parsing.py [repeats]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.parsing import BACKENDS
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# (fixture file, backend method, extra arguments)
+CASES = [
+    ("anime_page.html", "anime_details", ()),
+    ("episode_list.html", "episodes", ()),
+    ("servers.html", "servers", ()),
+    ("search_results.html", "search_results", (40,)),
+]
+
+
+def load_backends():
+    backends = {}
+    for name, backend_class in BACKENDS.items():
+        try:
+            backends[name] = backend_class()
+        except ImportError as e:
+            print(f"Skipping {name}: {e}")
+    return backends
+
+
+def time_parse(func, html, args, repeats):
+    """Best wall time of several runs, in milliseconds"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(html, *args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def peak_allocation(func, html, args):
+    """Peak Python memory allocated during one parse, in KiB"""
+    tracemalloc.start()
+    func(html, *args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    backends = load_backends()
+
+    print(f"{'fixture':<22}{'backend':<8}{'time (ms)':>12}{'peak alloc (KiB)':>20}")
+    for fixture, method, args in CASES:
+        with open(os.path.join(FIXTURES_DIR, fixture), "r", encoding="utf-8") as f:
+            html = f.read()
+
+        outputs = {name: getattr(b, method)(html, *args) for name, b in backends.items()}
+        if len({repr(o) for o in outputs.values()}) > 1:
+            print(f"WARNING: backends disagree on {fixture}")
+
+        timings = {}
+        for name, backend in backends.items():
+            func = getattr(backend, method)
+            timings[name] = time_parse(func, html, args, repeats)
+            alloc = peak_allocation(func, html, args)
+            print(f"{fixture:<22}{name:<8}{timings[name]:>12.2f}{alloc:>20.0f}")
+
+        if "bs4" in timings and "lxml" in timings:
+            print(f"{'':<22}speedup {timings['bs4'] / timings['lxml']:>11.1f}x")
+
+
+if __name__ == "__main__":
+    main()
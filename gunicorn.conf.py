@@ -0,0 +1,21 @@
+"""
+Gunicorn configuration for production serving
+Run with: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# HTTP worker processes; download jobs are shared between them through the download folder
+workers = int(os.environ.get('WEB_WORKERS', '4'))
+
+# Threads per worker, so long API calls (anime info, search) don't block other requests
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '8'))
+
+# Upstream calls (Cloudflare challenge, episode lists) can take a while
+timeout = 120
+graceful_timeout = 30
+
+accesslog = '-'
+errorlog = '-'
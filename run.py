@@ -2,10 +2,18 @@
 AnimeKai Downloader - Application Entry Point
 Run this file to start the web server
 """
-from app import create_app
+from app.importtime import ImportTimer
+
+# Heavy modules that should only be imported when first needed
+DEFERRED_MODULES = ["cloudscraper", "requests", "bs4", "lxml", "concurrent.futures", "PIL"]
 
 if __name__ == '__main__':
-    app = create_app()
+    with ImportTimer() as startup:
+        from werkzeug.serving import is_running_from_reloader
+        from app import create_app
+
+        # The reloader parent only watches files; background services run in the serving child
+        app = create_app(start_background_services=is_running_from_reloader())
     
     print("=" * 70)
     print("🎬 AnimeKai Downloader Web Interface")
@@ -15,7 +23,12 @@ if __name__ == '__main__':
     print("\n🔐 Default Login: admin / admin")
     print("⚠️  Requires: ffmpeg and yt-dlp")
     print("\n💡 Customize with environment variables:")
-    print("   ANIME_USER, ANIME_PASS, SECRET_KEY, DOWNLOAD_FOLDER")
+    print("   ANIME_USER, ANIME_PASS, SECRET_KEY, DOWNLOAD_FOLDER,")
+    print("   SUBSCRIPTION_INTERVAL_MINUTES, DOWNLOAD_WORKERS,")
+    print("   TRANSCODE_PROFILE, TRANSCODE_WORKERS, TRANSCODE_THREADS,")
+    print("   UPSTREAM_WARMUP, UPSTREAM_POOL_SIZE,")
+    print("   BANDWIDTH_LIMIT_MBPS, BANDWIDTH_SCHEDULE")
+    print("\n⏱️  " + "\n".join(startup.report(deferred=DEFERRED_MODULES)))
     print("=" * 70)
     
     app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
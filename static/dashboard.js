@@ -2,42 +2,18 @@
 
 async function loadDashboard() {
     try {
-        // Load library stats
-        const libraryResponse = await fetch('/api/library/list');
+        // Load library totals and the most recently updated titles
+        const libraryResponse = await fetch('/api/library/list?sort=modified&limit=5');
         const library = await libraryResponse.json();
         
-        let totalAnime = 0;
-        let totalEpisodes = 0;
-        let totalSizeMB = 0;
-        let recentItems = [];
-        
-        if (Array.isArray(library)) {
-            // New API format returns array
-            totalAnime = library.length;
-            library.forEach(anime => {
-                totalEpisodes += anime.total_files;
-                totalSizeMB += anime.total_size_mb;
-                
-                recentItems.push({
-                    name: anime.name,
-                    episodes: anime.total_files,
-                    size: anime.total_size_mb
-                });
-            });
-        } else {
-            // Old API format returns object
-            for (const [animeName, data] of Object.entries(library)) {
-                totalAnime++;
-                totalEpisodes += data.total_files;
-                totalSizeMB += data.total_size_mb;
-                
-                recentItems.push({
-                    name: animeName,
-                    episodes: data.total_files,
-                    size: data.total_size_mb
-                });
-            }
-        }
+        const totalAnime = library.totals.series;
+        const totalEpisodes = library.totals.files;
+        const totalSizeMB = library.totals.size_mb;
+        const recentItems = library.items.map(anime => ({
+            name: anime.name,
+            episodes: anime.total_files,
+            size: anime.total_size_mb
+        }));
         
         // Update stats
         document.getElementById('totalAnime').textContent = totalAnime;
@@ -51,6 +27,8 @@ async function loadDashboard() {
             d.status === 'downloading' || 
             d.status === 'fetching_info' || 
             d.status === 'fetching_episodes' ||
+            d.status === 'verifying' ||
+            d.status === 'transcoding' ||
             d.status === 'merging'
         ).length;
         
@@ -62,7 +40,10 @@ async function loadDashboard() {
             d.status === 'downloading' || 
             d.status === 'fetching_info' || 
             d.status === 'fetching_episodes' ||
+            d.status === 'verifying' ||
+            d.status === 'transcoding' ||
             d.status === 'merging' ||
+            d.status === 'queued' ||
             d.status === 'initializing'
         );
         
@@ -0,0 +1,44 @@
+"""
+AnimeKai Downloader - Remote Worker Entry Point
+Leases episode downloads from a coordinator running with CLUSTER_TOKEN and
+CLUSTER_DISTRIBUTE=1, e.g.
+    python worker.py http://coordinator:5000 --slots 2
+See app/cluster.py for how tasks, leases and uploads work.
+"""
+import argparse
+import os
+import sys
+
+from app.cluster import ClusterWorker
+
+
+def main(argv=None):
+    default_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
+    parser = argparse.ArgumentParser(description="Download episodes for a coordinator server")
+    parser.add_argument("coordinator", help="base URL of the coordinator, e.g. http://coordinator:5000")
+    parser.add_argument("--token", default=os.environ.get("CLUSTER_TOKEN", ""),
+                        help="cluster token of the coordinator (default: CLUSTER_TOKEN)")
+    parser.add_argument("--slots", type=int, default=int(os.environ.get("WORKER_SLOTS", "2")),
+                        help="episodes downloaded at the same time (default: 2)")
+    parser.add_argument("--download-folder", default=os.environ.get("DOWNLOAD_FOLDER", default_folder),
+                        help="working folder, or the coordinator's library with --shared-storage")
+    parser.add_argument("--shared-storage", action="store_true",
+                        help="the download folder is the coordinator's library (e.g. NFS); skip uploads")
+    parser.add_argument("--worker-id", help="name shown on the coordinator (default: host-pid)")
+    args = parser.parse_args(argv)
+
+    if not args.token:
+        parser.error("a cluster token is required (--token or CLUSTER_TOKEN)")
+    os.makedirs(args.download_folder, exist_ok=True)
+
+    worker = ClusterWorker(args.coordinator, args.token, args.download_folder,
+                           args.slots, args.shared_storage, args.worker_id)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
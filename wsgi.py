@@ -0,0 +1,12 @@
+"""
+AnimeKai Downloader - WSGI Entry Point
+Used by production servers, e.g. `gunicorn -c gunicorn.conf.py wsgi:app`
+"""
+import os
+
+# Several HTTP worker processes must see the same download jobs
+os.environ.setdefault('SHARED_JOB_STATE', '1')
+
+from app import create_app
+
+app = create_app()